@@ -1,8 +1,11 @@
 from .base import Component, ComponentLoader
-from .executor import Executor
+from .executor import AsyncExecutor, Executor
+from .stream import Stream
+from .sweep import Sweep
 
 
-__all__ = ['Component', 'ComponentLoader', 'Executor']
+__all__ = ['AsyncExecutor', 'Component', 'ComponentLoader', 'Executor',
+           'Stream', 'Sweep']
 
 
 __version__ = '0.3'
@@ -1,6 +1,8 @@
+import asyncio
 from hashlib import sha256
 
 from .cache.core import UNHASHABLE, hash_value
+from .stream import Stream
 
 
 class StepInputConnection(object):
@@ -50,22 +52,53 @@ class Component(object):
         self.pickling = pickling
 
     def set_output(self, name, value, hash=None):
-        if not hash:
+        if isinstance(value, Stream):
+            # The executor hashes streams from the step hash
+            hash = None
+        elif not hash:
             hash = hash_value(value, self.pickling)
         self.outputs[name] = value, hash
 
-    def execute(self, inputs, output_names, **kwargs):
+    def set_output_stream(self, name, chunks):
+        """Set an output to a `Stream`, whose chunks are produced on demand.
+
+        `chunks` is an iterable, usually a generator, which will be iterated
+        on as the downstream components read the stream.
+        """
+        self.set_output(name, Stream(chunks))
+
+    def execute(self, inputs, output_names=None, **kwargs):
         """Run on the inputs to provide outputs.
+
+        Components that only implement `execute_async()` get it run in a new
+        event loop.
         """
+        if self.is_async():
+            return asyncio.run(self.execute_async(inputs, **kwargs))
         raise NotImplementedError
 
+    async def execute_async(self, inputs, **kwargs):
+        """Run on the inputs to provide outputs, asynchronously.
+
+        Components spending their time waiting on I/O can implement this, in
+        which case `AsyncExecutor` will await it instead of calling
+        `execute()` from a thread.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def is_async(cls):
+        """Whether this component implements `execute_async()`.
+        """
+        return cls.execute_async is not Component.execute_async
+
     @classmethod
     def compute_hash(cls, input_hashes):
         fqdn = ('%s.%s\n' % (cls.__module__, cls.__name__))
         h = sha256(fqdn.encode())
         for i_n, i_hs in sorted(input_hashes.items()):
             for i_h in i_hs:
-                if i_h == UNHASHABLE:
+                if i_h is UNHASHABLE:
                     return UNHASHABLE
                 h.update(('%s\n%s\n' % (i_n, i_h)).encode())
         return h.hexdigest()
@@ -112,6 +145,7 @@ class _SimpleComponentLoaderNamespace(object):
                     'inputs': inputs or [], 'outputs': outputs or [],
                 },
             )
+            return cls
 
         return wrapper
 
@@ -1,6 +1,8 @@
+import asyncio
 import os
 import requests
 import shutil
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 from urllib.parse import urlparse
 
 from .base import Component, SimpleComponentLoader
@@ -10,6 +12,10 @@ from .cache.core import TemporaryFile
 register = SimpleComponentLoader()
 
 
+# Tornado's HTTP client refuses bigger responses (100 MB by default)
+_MAX_DOWNLOAD_SIZE = 1 << 50
+
+
 # TODO: More builtin components
 # WriteFile: write a string to a temporary file
 # ShellCommand: execute a command
@@ -22,7 +28,8 @@ register = SimpleComponentLoader()
 class Download(Component):
     """Downloads a file.
     """
-    def execute(self, inputs, temp_dir, **kwargs):
+    @staticmethod
+    def _prepare(inputs, temp_dir):
         url, = inputs['url']
         headers = {}
         for header in inputs.get('headers', ()):
@@ -34,6 +41,11 @@ class Download(Component):
         extension = os.path.splitext(path)[1]
         temp_file = TemporaryFile(temp_dir, suffix=extension)
 
+        return url, headers, temp_file
+
+    def execute(self, inputs, temp_dir, **kwargs):
+        url, headers, temp_file = self._prepare(inputs, temp_dir)
+
         if url.startswith('file://'):
             shutil.copyfile(url[7:], temp_file.name)
         else:
@@ -47,6 +59,32 @@ class Download(Component):
 
         self.set_output('file', temp_file)
 
+    async def execute_async(self, inputs, temp_dir, **kwargs):
+        url, headers, temp_file = self._prepare(inputs, temp_dir)
+
+        if url.startswith('file://'):
+            await asyncio.get_event_loop().run_in_executor(
+                None,
+                shutil.copyfile, url[7:], temp_file.name,
+            )
+        else:
+            # Download with Tornado, writing chunks to disk as they arrive.
+            # Its size limit applies even when streaming, don't use the
+            # shared client so we can lift it
+            client = AsyncHTTPClient(force_instance=True,
+                                     max_body_size=_MAX_DOWNLOAD_SIZE)
+            try:
+                with open(temp_file.name, 'wb') as f:
+                    await client.fetch(HTTPRequest(
+                        url, headers=headers,
+                        streaming_callback=f.write,
+                        request_timeout=0,
+                    ), raise_error=False)
+            finally:
+                client.close()
+
+        self.set_output('file', temp_file)
+
 
 @register(inputs=['suffix'], outputs=['file'])
 class EmptyFile(Component):
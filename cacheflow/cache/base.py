@@ -1,3 +1,8 @@
+import collections
+import contextlib
+import threading
+
+
 class Cache(object):
     """Cache system, storing data for later retrieval.
     """
@@ -16,3 +21,111 @@ class Cache(object):
         """Stores a new value to the cache.
         """
         raise NotImplementedError
+
+    def has_keys(self, keys):
+        """Indicates which of the given keys are in the cache.
+
+        :return: A set of the keys that are present.
+        """
+        return {key for key in keys if self.has_key(key)}
+
+    def retrieve_many(self, keys, **kwargs):
+        """Gets multiple values from the cache.
+
+        :return: A dictionary with the keys that were found.
+        """
+        values = {}
+        for key in keys:
+            try:
+                values[key] = self.retrieve(key, **kwargs)
+            except KeyError:
+                pass
+        return values
+
+    def remove(self, key):
+        """Removes a value from the cache, if it is there.
+        """
+        raise NotImplementedError
+
+    def size(self, key):
+        """Gets the number of bytes a value takes in the cache.
+
+        :return: The size, or ``None`` if this cache can't tell.
+        """
+        return None
+
+    def lock(self, key):
+        """Context manager held while computing the value for a key.
+
+        Executions computing the same value wait for each other, so that the
+        value is only computed once and then found in the cache. This only
+        works within this process, unless the cache overrides it.
+        """
+        return _key_locks.hold((id(self), key))
+
+    def pin(self, key):
+        """Keeps the values of a step from being evicted, until `unpin()`.
+
+        Caches evicting values to stay under a budget don't evict the values
+        whose key has the same first element (the step hash) as `key` while
+        it is pinned. Pins only apply within this process.
+        """
+
+    def unpin(self, key):
+        """Releases a pin taken with `pin()`.
+        """
+
+
+class _KeyLocks(object):
+    """A registry of locks, one for each key currently in use.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}  # key: [lock, number of users]
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+_key_locks = _KeyLocks()
+
+
+class _Pins(object):
+    """A registry of pinned groups of keys, see `Cache.pin()`.
+
+    Groups are pinned under a scope, such as a cache directory, so that
+    caches using the same storage share their pins.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pins = collections.Counter()  # (scope, group): number of pins
+
+    def pin(self, scope, group):
+        with self._lock:
+            self._pins[(scope, group)] += 1
+
+    def unpin(self, scope, group):
+        with self._lock:
+            self._pins[(scope, group)] -= 1
+            if self._pins[(scope, group)] <= 0:
+                del self._pins[(scope, group)]
+
+    def groups(self, scope):
+        with self._lock:
+            return {group for s, group in self._pins if s == scope}
+
+
+_pins = _Pins()
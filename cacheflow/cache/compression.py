@@ -0,0 +1,141 @@
+import bz2
+import io
+import lzma
+import zlib
+
+
+# Compressed files start with this, followed by the codec's tag. Pickles
+# start with the PROTO opcode, '\x80', so they can't be mistaken for it
+_MAGIC = b'\x00CF'
+
+# How much is buffered to decide whether data is worth compressing
+_SAMPLE_SIZE = 1 << 16
+
+_CHUNK_SIZE = 1 << 16
+
+
+def _zlib_compressor(level):
+    return zlib.compressobj(-1 if level is None else level)
+
+
+def _bz2_compressor(level):
+    return bz2.BZ2Compressor(9 if level is None else level)
+
+
+def _lzma_compressor(level):
+    return lzma.LZMACompressor(preset=level)
+
+
+# name: (tag, compressor factory, decompressor factory)
+CODECS = {
+    'zlib': (b'z', _zlib_compressor, zlib.decompressobj),
+    'bz2': (b'b', _bz2_compressor, bz2.BZ2Decompressor),
+    'lzma': (b'x', _lzma_compressor, lzma.LZMADecompressor),
+}
+
+_DECOMPRESSORS = {tag: new for tag, _, new in CODECS.values()}
+
+
+def check_codec(codec):
+    """Raise `ValueError` if `codec` is not None or a known codec name.
+    """
+    if codec is not None and codec not in CODECS:
+        raise ValueError("Unknown compression %r, use one of: %s" % (
+            codec, ', '.join(sorted(CODECS)),
+        ))
+
+
+class CompressingWriter(object):
+    """Compresses what is written to a file, if it is worth it.
+
+    The beginning of the data is compressed on its own first, and the data is
+    written uncompressed if that doesn't make it at least 10% smaller. Call
+    `finish()` once everything has been written.
+    """
+    def __init__(self, file, codec, level=None):
+        self.file = file
+        self.codec = codec
+        self.level = level
+        self._sample = bytearray()
+        self._compressor = None
+
+    def write(self, data):
+        length = memoryview(data).nbytes
+        if self._sample is not None:
+            self._sample += data
+            if len(self._sample) >= _SAMPLE_SIZE:
+                self._decide()
+        elif self._compressor is None:
+            self.file.write(data)
+        else:
+            compressed = self._compressor.compress(data)
+            if compressed:
+                self.file.write(compressed)
+        return length
+
+    def _decide(self):
+        sample = bytes(self._sample)
+        self._sample = None
+        tag, new_compressor, _ = CODECS[self.codec]
+        # One-shot compression of the sample, stream compressors might not
+        # output anything yet
+        trial = new_compressor(self.level)
+        size = len(trial.compress(sample)) + len(trial.flush())
+        if size <= 0.9 * len(sample):
+            self.file.write(_MAGIC + tag)
+            self._compressor = new_compressor(self.level)
+        self.write(sample)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        """Write the end of the data.
+        """
+        if self._sample is not None:
+            self._decide()
+        if self._compressor is not None:
+            self.file.write(self._compressor.flush())
+            self._compressor = None
+
+
+def open_compressed(file):
+    """Get a file object reading the data in `file`, compressed or not.
+
+    `file` has to be positioned at the start.
+    """
+    head = file.read(len(_MAGIC) + 1)
+    if len(head) == len(_MAGIC) + 1 and head[:len(_MAGIC)] == _MAGIC:
+        try:
+            new_decompressor = _DECOMPRESSORS[head[len(_MAGIC):]]
+        except KeyError:
+            raise ValueError("Unknown compression in cache file")
+        return io.BufferedReader(
+            _DecompressingReader(file, new_decompressor()),
+            _CHUNK_SIZE,
+        )
+    file.seek(0)
+    return file
+
+
+class _DecompressingReader(io.RawIOBase):
+    def __init__(self, file, decompressor):
+        self.file = file
+        self.decompressor = decompressor
+        self._buffer = b''
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._position == len(self._buffer):
+            chunk = self.file.read(_CHUNK_SIZE)
+            if not chunk:
+                return 0
+            self._buffer = self.decompressor.decompress(chunk)
+            self._position = 0
+        length = min(len(b), len(self._buffer) - self._position)
+        b[:length] = self._buffer[self._position:self._position + length]
+        self._position += length
+        return length
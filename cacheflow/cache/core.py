@@ -1,14 +1,41 @@
 import cloudpickle
 import contextlib
 import copyreg
-from hashlib import sha256
+import hashlib
 import io
+import itertools
+import mmap
 import os
 import pickle
 import re
+import shutil
+import sys
 import tempfile
+import threading
+import time
 
-from .base import Cache
+from ..trace import null_span
+from .base import Cache, _key_locks, _pins
+from .compression import CompressingWriter, check_codec, open_compressed
+from .database import _remove
+from .index import Index, _blob_files, _blob_refs
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+if fcntl is not None and sys.platform.startswith('linux'):
+    _FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+else:
+    _FICLONE = None
+
+# Files are read by chunks of this size
+_CHUNK_SIZE = 1 << 20
+
+# Protocol 5 can put buffers out-of-band (Python 3.8+)
+_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
 
 
 class NullCache(Cache):
@@ -23,60 +50,302 @@ class NullCache(Cache):
     def store(self, key, value, **kwargs):
         pass
 
+    def remove(self, key):
+        pass
+
+    def lock(self, key):
+        # Nothing gets stored, no point in waiting
+        return null_span()
+
 
 class MemoryCache(Cache):
     """In-memory cache that simply stores everything in a dict.
     """
     def __init__(self):
-        self.store = {}
+        self.values = {}
 
     def has_key(self, key):
-        return key in self.store
+        return key in self.values
 
     def retrieve(self, key, **kwargs):
-        return self.store[key]
+        return self.values[key]
 
     def store(self, key, value, **kwargs):
-        self.store[key] = value
+        self.values[key] = value
+
+    def remove(self, key):
+        self.values.pop(key, None)
 
 
 class DirectoryCache(Cache):
     """On-disk cache that writes to files in a directory.
+
+    Files and large values are stored once, as blobs (see `BlobFiles`). If
+    `max_size` is set, the least recently used entries are evicted (see
+    `cacheflow.cache.index.Index`). `compression` is ``'zlib'``, ``'bz2'``
+    or ``'lzma'``, at `compression_level`.
     """
-    def __init__(self, directory):
-        if not os.path.isdir(directory):
-            os.mkdir(directory)
+    # Temporary files older than this were left by a process that crashed
+    TEMP_FILE_AGE = 24 * 3600
+
+    def __init__(self, directory, blob_threshold=1 << 16, max_size=None,
+                 compression=None, compression_level=None):
+        check_codec(compression)
+        os.makedirs(directory, exist_ok=True)
         self.directory = directory
+        self.blob_threshold = blob_threshold
+        self.max_size = max_size
+        self.compression = compression
+        self.compression_level = compression_level
+        # Names of entries never contain a dot
+        self.fan_out = self._check_layout(os.path.join(directory,
+                                                       'layout.txt'))
+        self._remove_temp_files(directory)
+        self._remove_temp_files(self._blobs_directory())
+        if max_size is not None:
+            self.index = Index(os.path.join(directory, 'index.sqlite3'),
+                               directory, self._blobs_directory())
+        else:
+            self.index = None
 
-    _path_re = re.compile(r'[^A-Za-z0-9-]')
+    def _check_layout(self, layout):
+        """Find out whether entries are in subdirectories.
+        """
+        try:
+            with open(layout) as fp:
+                return fp.read().strip() == 'fan-out'
+        except FileNotFoundError:
+            pass
+        if any('.' not in name for name in os.listdir(self.directory)):
+            # Created by an older version, keep it flat
+            return False
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('fan-out\n')
+        os.replace(tmp, layout)
+        return True
+
+    def _remove_temp_files(self, directory):
+        """Remove temporary files left behind by processes that crashed.
+        """
+        limit = time.time() - self.TEMP_FILE_AGE
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith('.tmp'):
+                path = os.path.join(directory, name)
+                try:
+                    if os.stat(path).st_mtime < limit:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _name(self, key):
+        """The path of an entry, relative to the cache directory.
+        """
+        name = _key_name(key)
+        if self.fan_out:
+            return os.path.join(name[:2], name)
+        return name
 
     def _path(self, key):
-        assert isinstance(key, tuple)
-        return os.path.join(self.directory, '__'.join(
-            self._path_re.sub(lambda m: '_%x' % ord(m.group(0)), k)
-            for k in key
-        ))
+        return os.path.join(self.directory, self._name(key))
 
     def has_key(self, key):
         return os.path.exists(self._path(key))
 
     def retrieve(self, key, pickling, **kwargs):
-        stack = contextlib.ExitStack()
-        with stack:
-            try:
-                fp = stack.enter_context(open(self._path(key), 'rb'))
-            except FileNotFoundError:
-                raise KeyError(key)
-            return pickling.load(fp)
+        name = self._name(key)
+        try:
+            fp = open(os.path.join(self.directory, name), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+        with fp:
+            value = pickling.load(open_compressed(fp),
+                                  files=self._blobs(pickling))
+        if self.index is not None:
+            self.index.accessed(name)
+        return value
 
     def store(self, key, value, pickling, **kwargs):
-        with open(self._path(key), 'wb') as fp:
+        name = self._name(key)
+        files = self._blobs(pickling)
+        # Write to a temporary file, then move it in place
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                if self.compression is None:
+                    pickling.dump(value, fp, files=files)
+                else:
+                    writer = CompressingWriter(fp, self.compression,
+                                               self.compression_level)
+                    pickling.dump(value, writer, files=files)
+                    writer.finish()
+                fp.flush()
+                size = os.fstat(fp.fileno()).st_size
+            path = os.path.join(self.directory, name)
+            if self.fan_out:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write_blob_list(path, files.referenced)
+            os.replace(tmp, path)
+        except TypeError:
+            os.remove(tmp)
+            return
+        except BaseException:
+            os.remove(tmp)
+            raise
+        if self.index is not None:
+            self.index.stored(
+                name, size, files.referenced, self.max_size,
+                pinned=_pins.groups(os.path.realpath(self.directory)),
+            )
+
+    def _write_blob_list(self, path, blobs):
+        """Record the blobs an entry references, next to it and in `refs.d`.
+        """
+        entry = os.path.basename(path)
+        previous = self._read_blob_list(path)
+        for blob in blobs:
+            refs = _blob_refs(self.directory, blob)
+            os.makedirs(refs, exist_ok=True)
+            with open(os.path.join(refs, entry), 'w'):
+                pass
+        if not blobs:
+            _remove(path + '.blobs')
+        else:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
             try:
-                pickling.dump(value, fp)
+                with os.fdopen(fd, 'w') as fp:
+                    for blob in sorted(blobs):
+                        fp.write(blob + '\n')
+                os.replace(tmp, path + '.blobs')
+            except BaseException:
+                os.remove(tmp)
+                raise
+        if self.index is None:
+            self._release_blobs(entry, set(previous) - set(blobs))
+
+    def _read_blob_list(self, path):
+        try:
+            with open(path + '.blobs') as fp:
+                return fp.read().split()
+        except FileNotFoundError:
+            return []
+
+    def _release_blobs(self, entry, blobs):
+        """Drop an entry's references to blobs, removing unreferenced ones.
+
+        With an index, the index does this instead.
+        """
+        for blob in blobs:
+            refs = _blob_refs(self.directory, blob)
+            _remove(os.path.join(refs, entry))
+            try:
+                os.rmdir(refs)
+            except OSError:
+                # Still referenced, or by entries that predate refs.d
+                continue
+            for path in _blob_files(self._blobs_directory(), blob):
+                _remove(path)
+
+    def remove(self, key):
+        if self.index is not None:
+            self.index.removed(self._name(key))
+        else:
+            path = self._path(key)
+            blobs = self._read_blob_list(path)
+            _remove(path)
+            _remove(path + '.blobs')
+            self._release_blobs(os.path.basename(path), blobs)
+
+    def size(self, key):
+        """The size of an entry, including the blobs it references.
+
+        Blobs shared with other entries are counted for each of them.
+        """
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+        for blob in self._read_blob_list(path):
+            for blob_path in _blob_files(self._blobs_directory(), blob):
+                try:
+                    size += os.path.getsize(blob_path)
+                except FileNotFoundError:
+                    pass
+        return size
+
+    def pin(self, key):
+        _pins.pin(os.path.realpath(self.directory), self._name(key[:1]))
+
+    def unpin(self, key):
+        _pins.unpin(os.path.realpath(self.directory), self._name(key[:1]))
+
+    def _blobs_directory(self):
+        return os.path.join(self.directory, 'blobs.d')
+
+    def _blobs(self, pickling):
+        return BlobFiles(self._blobs_directory(), pickling,
+                         self.blob_threshold,
+                         self.compression, self.compression_level)
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Lock a key, between threads and processes.
+
+        This uses a lock file next to the cache entry, so executions in other
+        processes using the same directory wait for each other as well.
+        """
+        with _key_locks.hold((os.path.realpath(self.directory), key)):
+            if fcntl is None:
+                yield
                 return
-            except TypeError:
-                pass
-        os.remove(self._path(key))
+            path = self._path(key) + '.lock'
+            if self.fan_out:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = self._lock_file(path)
+            try:
+                yield
+            finally:
+                try:
+                    os.remove(path)
+                finally:
+                    os.close(fd)
+
+    @staticmethod
+    def _lock_file(path):
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # The previous holder removes the file after unlocking it,
+                # check that we locked the file that is currently there
+                try:
+                    locked = os.stat(path).st_ino == os.fstat(fd).st_ino
+                except FileNotFoundError:
+                    locked = False
+            except BaseException:
+                os.close(fd)
+                raise
+            if locked:
+                return fd
+            os.close(fd)
+
+
+_key_name_re = re.compile(r'[^A-Za-z0-9-]')
+
+
+def _key_name(key):
+    """Turn a key into a file name, which doesn't contain dots.
+    """
+    assert isinstance(key, tuple)
+    return '__'.join(
+        _key_name_re.sub(lambda m: '_%x' % ord(m.group(0)), k)
+        for k in key
+    )
 
 
 class HashFileWrapper(object):
@@ -93,6 +362,39 @@ class HashFileWrapper(object):
         pass
 
 
+class _CountingWriter(object):
+    def __init__(self, file):
+        self.file = file
+        self.bytes = 0
+
+    def write(self, b):
+        self.bytes += memoryview(b).nbytes
+        return self.file.write(b)
+
+
+class _CountingSink(object):
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, b):
+        self.bytes += memoryview(b).nbytes
+
+
+def _pickled_size(value, pickling):
+    """Count the bytes of a value once pickled, without keeping them.
+    """
+    sink = _CountingSink()
+    pickling.dump(value, sink)
+    return sink.bytes
+
+
+def _tell(file):
+    try:
+        return file.tell()
+    except (AttributeError, OSError):
+        return None
+
+
 class _Unhashable(object):
     def __hash__(self):
         raise TypeError
@@ -108,12 +410,241 @@ UNHASHABLE = _Unhashable()
 
 
 def hash_value(value, pickling):
-    h = sha256()
+    """Hash a value, using the `Hasher` of `pickling`.
+    """
+    return pickling.hasher.hash(value, pickling)
+
+
+# type: function, and 'module.qualname': function for lazy registrations
+_hashers = {}
+_lazy_hashers = {}
+
+
+def register_hasher(type_, function):
+    """Register a faster way to hash values of a type.
+
+    The function gets a value, and returns something to hash in its place,
+    built from the types `Hasher` handles directly (`str`, `bytes`, numbers,
+    tuples, lists, dicts, and buffers such as `memoryview`). It can also
+    return `NotImplemented`, in which case the value is pickled.
+
+    The type can be given by its full name (``'module.QualName'``), in which
+    case the module doesn't get imported until a value of that type is seen.
+    Only values of that exact type are concerned, not subclasses.
+    """
+    if isinstance(type_, str):
+        _lazy_hashers[type_] = function
+        # Forget the types that were looked up already
+        for cached_type, cached_function in list(_hashers.items()):
+            if cached_function is None:
+                _hashers.pop(cached_type, None)
+    else:
+        _hashers[type_] = function
+
+
+def _registered_hasher(type_):
     try:
-        pickling.dump(value, HashFileWrapper(h))
-    except TypeError:
-        return UNHASHABLE
-    return h.hexdigest()
+        return _hashers[type_]
+    except KeyError:
+        # Remember the result of the lookup, even if there is none
+        function = _hashers[type_] = _lazy_hashers.get(_type_name(type_))
+        return function
+
+
+def _type_name(type_):
+    return '%s.%s' % (type_.__module__, type_.__qualname__)
+
+
+def _hash_ndarray(value):
+    if value.dtype.hasobject:
+        return NotImplemented
+    if not value.flags.c_contiguous:
+        value = value.copy(order='C')
+    return value.dtype.descr, value.shape, \
+        memoryview(value.reshape(-1).view('u1'))
+
+
+register_hasher('numpy.ndarray', _hash_ndarray)
+
+
+class _CountingHash(object):
+    def __init__(self, h):
+        self.h = h
+        self.bytes = 0
+
+    def update(self, b):
+        self.bytes += memoryview(b).nbytes
+        self.h.update(b)
+
+
+class Hasher(object):
+    """Computes the hashes identifying values in the cache.
+
+    Strings, bytes and buffers are fed to the digest directly, other values
+    are pickled into it (see `register_hasher()` and `remember()`).
+
+    :param algorithm: The name of a `hashlib` algorithm, such as
+    ``'blake2b'``, or a function returning a new hash object. The default is
+    SHA-256.
+    """
+    def __init__(self, algorithm=None):
+        if algorithm is None:
+            self.new = hashlib.sha256
+        elif isinstance(algorithm, str):
+            self.new = lambda: hashlib.new(algorithm)
+        else:
+            self.new = algorithm
+        self._known = {}  # id(value): [value, hash, number of users]
+        self._known_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Known hashes are for objects of this process
+        return {'new': self.new}
+
+    def __setstate__(self, state):
+        self.__init__(state['new'])
+
+    @contextlib.contextmanager
+    def remember(self, values):
+        """Use already-computed hashes for these objects, in this block.
+
+        :param values: An iterable of ``(value, hash)`` pairs. The objects
+        must not be modified while in the block.
+        """
+        added = []
+        with self._known_lock:
+            for value, hash in values:
+                if hash is None or hash is UNHASHABLE:
+                    continue
+                entry = self._known.get(id(value))
+                if entry is None:
+                    self._known[id(value)] = [value, hash, 1]
+                else:
+                    entry[2] += 1
+                added.append(id(value))
+        try:
+            yield
+        finally:
+            with self._known_lock:
+                for key in added:
+                    entry = self._known[key]
+                    entry[2] -= 1
+                    if entry[2] == 0:
+                        del self._known[key]
+
+    def known(self, value):
+        """Get the hash of an object passed to `remember()`, or None.
+        """
+        entry = self._known.get(id(value))
+        if entry is not None and entry[0] is value:
+            return entry[1]
+        return None
+
+    def hash(self, value, pickling):
+        """Hash a value, returning a hex digest or `UNHASHABLE`.
+        """
+        known = self.known(value)
+        if known is not None:
+            return known
+        with pickling.span('hash') as args:
+            h = self.new()
+            if pickling.trace is not None:
+                h = _CountingHash(h)
+            try:
+                self._feed(h, value, pickling)
+            except (TypeError, pickle.PicklingError):
+                return UNHASHABLE
+            finally:
+                if isinstance(h, _CountingHash):
+                    args['bytes'] = h.bytes
+                    h = h.h
+        return h.hexdigest()
+
+    def _feed(self, h, value, pickling):
+        type_ = type(value)
+        fast_path = _FAST_PATHS.get(type_)
+        if fast_path is not None:
+            fast_path(h, value)
+            return
+
+        function = _registered_hasher(type_)
+        if function is not None:
+            replacement = function(value)
+            if replacement is not NotImplemented:
+                name = _type_name(type_).encode('utf-8')
+                h.update(b'r%d:%s' % (len(name), name))
+                self._feed_replacement(h, replacement, pickling)
+                return
+
+        def nested_hash(obj):
+            if type(obj) in _INLINE_TYPES:
+                return None
+            nested = self.known(obj)
+            if nested is None and _registered_hasher(type(obj)) is not None:
+                nested = self.hash(obj, pickling)
+                if nested is UNHASHABLE:
+                    raise TypeError("Unhashable value")
+            return nested
+
+        _HashPickler(HashFileWrapper(h), temp_dir=pickling.temp_dir,
+                     nested_hash=nested_hash, value=value).dump(value)
+
+    def _feed_replacement(self, h, value, pickling):
+        """Feed a value returned by a function from `register_hasher()`.
+
+        Those can contain buffers, which can't be pickled.
+        """
+        if isinstance(value, (tuple, list)):
+            h.update(b'l%d:' % len(value))
+            for item in value:
+                self._feed_replacement(h, item, pickling)
+        else:
+            value_hash = self.hash(value, pickling)
+            if value_hash is UNHASHABLE:
+                raise TypeError("Unhashable value")
+            h.update(b'h%s:' % value_hash.encode('ascii'))
+
+
+def _hash_str(h, value):
+    value = value.encode('utf-8', 'surrogatepass')
+    h.update(b's%d:' % len(value))
+    h.update(value)
+
+
+def _hash_bytes(h, value):
+    h.update(b'b%d:' % len(value))
+    h.update(value)
+
+
+def _hash_bytearray(h, value):
+    h.update(b'B%d:' % len(value))
+    h.update(value)
+
+
+def _hash_memoryview(h, value):
+    h.update(b'm%s:%r:%d:' % (
+        value.format.encode('ascii'), value.shape, value.nbytes,
+    ))
+    if value.c_contiguous:
+        h.update(value)
+    else:
+        h.update(value.tobytes())
+
+
+# Hashed without pickling them, when they are the value being hashed
+_FAST_PATHS = {
+    str: _hash_str,
+    bytes: _hash_bytes,
+    bytearray: _hash_bytearray,
+    memoryview: _hash_memoryview,
+}
+
+# The types the C pickler doesn't call reducer_override() for, never hashed on
+# their own so that hashes don't depend on which pickler is used
+_INLINE_TYPES = {
+    type(None), bool, int, float, str, bytes, bytearray,
+    tuple, list, dict, set, frozenset,
+}
 
 
 class TemporaryFile(object):
@@ -121,6 +652,22 @@ class TemporaryFile(object):
         fd, self.name = tempfile.mkstemp(dir=temp_dir, suffix=suffix)
         os.close(fd)
 
+    @classmethod
+    def _adopt(cls, name):
+        """Make a `TemporaryFile` from an existing file.
+        """
+        obj = cls.__new__(cls)
+        obj.name = name
+        return obj
+
+    @property
+    def suffix(self):
+        name = os.path.basename(self.name)
+        if '.' in name:
+            return '.' + name.split('.', 1)[1]
+        else:
+            return None
+
     def __getstate__(self):
         with open(self.name, 'rb') as fp:
             return {'contents': fp.read()}
@@ -130,10 +677,356 @@ class TemporaryFile(object):
             fp.write(state['contents'])
 
 
+def _hash_temp_file(h, value):
+    suffix = (value.suffix or '').encode('utf-8')
+    with open(value.name, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        h.update(b'F%d:%s%d:' % (len(suffix), suffix, size))
+        buffer = bytearray(_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            length = fp.readinto(buffer)
+            if not length:
+                break
+            h.update(view[:length])
+
+
+_FAST_PATHS[TemporaryFile] = _hash_temp_file
+
+
+def _clone_file(src, dst):
+    """Copy a file without reading it in memory.
+
+    This makes a reflink (copy-on-write clone) if the filesystem supports it,
+    otherwise the copy is done by the kernel if possible.
+    """
+    if _FICLONE is not None:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(src, dst)
+
+
+class FileStore(object):
+    """Where the contents of `TemporaryFile` objects go when pickled.
+    """
+    def save(self, temp_file):
+        """Store a file, returning a picklable reference to it.
+        """
+        raise NotImplementedError
+
+    def load(self, ref, suffix, temp_dir):
+        """Get a `TemporaryFile` in `temp_dir` back from its reference.
+        """
+        raise NotImplementedError
+
+    def save_value(self, value, hash, dump):
+        """Optionally store a value whose hash is known outside the pickle.
+
+        :param dump: Function pickling a value to a file object, which
+        optionally takes a `buffer_callback` for out-of-band buffers (see
+        `pickle.Pickler`).
+        :return: A picklable reference to the value, or None to have it
+        pickled normally.
+        """
+        return None
+
+    def load_value(self, ref, load):
+        """Get a value back from a reference returned by `save_value()`.
+
+        :param load: Function unpickling a value from a file object, which
+        optionally takes the out-of-band `buffers`.
+        """
+        raise pickle.UnpicklingError("Unknown persistent reference")
+
+
+class EmbeddedFiles(FileStore):
+    """Puts the contents of the files in the pickle, reading them in memory.
+    """
+    def save(self, temp_file):
+        with open(temp_file.name, 'rb') as fp:
+            return fp.read()
+
+    def load(self, ref, suffix, temp_dir):
+        obj = TemporaryFile(temp_dir=temp_dir, suffix=suffix)
+        with open(obj.name, 'wb') as fp:
+            fp.write(ref)
+        return obj
+
+
+class _HashedFiles(FileStore):
+    """Puts a hash of the files in the pickle, for hashing.
+    """
+    def save(self, temp_file):
+        h = hashlib.sha256()
+        _hash_temp_file(h, temp_file)
+        return h.hexdigest()
+
+    def save_value(self, value, hash, dump):
+        # Objects hashed on their own are represented by their hash
+        return hash
+
+
+class SharedFiles(FileStore):
+    """References files by path, for processes sharing a filesystem.
+
+    The files get copied to the receiver's `temp_dir`.
+    """
+    def save(self, temp_file):
+        return temp_file.name
+
+    def load(self, ref, suffix, temp_dir):
+        obj = TemporaryFile(temp_dir=temp_dir, suffix=suffix)
+        _clone_file(ref, obj.name)
+        return obj
+
+
+class MovedFiles(FileStore):
+    """Moves the files to another directory, where the receiver takes them.
+
+    The directory has to be on the same filesystem.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def save(self, temp_file):
+        fd, name = tempfile.mkstemp(dir=self.directory,
+                                    suffix=temp_file.suffix)
+        os.close(fd)
+        os.replace(temp_file.name, name)
+        temp_file.name = name
+        return name
+
+    def load(self, ref, suffix, temp_dir):
+        return TemporaryFile._adopt(ref)
+
+
+class BlobFiles(FileStore):
+    """Stores files and large values once, under their hash.
+
+    Values are stored separately if their hash is known and they pickle to
+    more than `threshold` bytes. Their large buffers, such as NumPy arrays,
+    get their own uncompressed files, memory-mapped when loading.
+    """
+    def __init__(self, directory, pickling, threshold=1 << 16,
+                 compression=None, compression_level=None):
+        self.directory = directory
+        self.pickling = pickling
+        self.threshold = threshold
+        self.compression = compression
+        self.compression_level = compression_level
+        self.referenced = set()
+        self._loaded = {}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name[:2], name)
+
+    def _put(self, name, tmp):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+
+    def _temp_path(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        os.close(fd)
+        return tmp
+
+    def save(self, temp_file):
+        name = hash_value(temp_file, self.pickling)
+        if not os.path.exists(self._path(name)):
+            tmp = self._temp_path()
+            try:
+                _clone_file(temp_file.name, tmp)
+                self._put(name, tmp)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        self.referenced.add(name)
+        return name
+
+    def load(self, ref, suffix, temp_dir):
+        obj = TemporaryFile(temp_dir=temp_dir, suffix=suffix)
+        try:
+            _clone_file(self._path(ref), obj.name)
+        except FileNotFoundError:
+            os.remove(obj.name)
+            raise KeyError(ref)
+        return obj
+
+    def save_value(self, value, hash, dump):
+        if isinstance(value, _SMALL_TYPES):
+            return None
+        elif (isinstance(value, (str, bytes, bytearray)) and
+                len(value) < self.threshold):
+            return None
+        elif os.path.exists(self._path(hash)):
+            self.referenced.add(hash)
+            return 'blob', hash
+
+        os.makedirs(self.directory, exist_ok=True)
+        spill = _SpillFile(self.directory, self.threshold,
+                           self.compression, self.compression_level)
+        buffers = itertools.count()
+        external = []
+
+        def buffer_callback(buffer):
+            try:
+                raw = buffer.raw()
+            except BufferError:  # Not contiguous
+                return True
+            if raw.nbytes < self.threshold:
+                return True
+            tmp = self._temp_path()
+            try:
+                with open(tmp, 'wb') as fp:
+                    fp.write(raw)
+                self._put('%s.%d' % (hash, next(buffers)), tmp)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            external.append(raw.nbytes)
+            return False
+
+        try:
+            if _PROTOCOL >= 5:
+                dump(value, spill, buffer_callback=buffer_callback)
+            else:
+                dump(value, spill)
+            if spill.name is None and not external:
+                return 'inline', spill.buffer.getvalue()
+            # The buffers are in their own files, the blob is written last
+            spill.spill()
+            spill.close()
+            self._put(hash, spill.name)
+        except BaseException:
+            spill.discard()
+            raise
+        self.referenced.add(hash)
+        return 'blob', hash
+
+    def load_value(self, ref, load):
+        kind, data = ref
+        if kind == 'inline':
+            return load(io.BytesIO(data))
+        try:
+            return self._loaded[data]
+        except KeyError:
+            pass
+        try:
+            fp = open(self._path(data), 'rb')
+        except FileNotFoundError:
+            raise KeyError(data)
+        with fp:
+            if _PROTOCOL >= 5:
+                value = load(open_compressed(fp),
+                             buffers=self._map_buffers(data))
+            else:
+                # No out-of-band buffers before Python 3.8
+                value = load(open_compressed(fp))
+        self._loaded[data] = value
+        return value
+
+    def _map_buffers(self, name):
+        """Memory-map the out-of-band buffers of a blob, in order.
+        """
+        for i in itertools.count():
+            try:
+                fp = open(self._path('%s.%d' % (name, i)), 'rb')
+            except FileNotFoundError:
+                raise KeyError(name)
+            with fp:
+                yield mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+_SMALL_TYPES = (type(None), bool, int, float, complex)
+
+
+def _is_immutable(value):
+    """Check that a value can't be modified, so its hash can't change.
+    """
+    if isinstance(value, (str, bytes) + _SMALL_TYPES):
+        return True
+    elif type(value) in (tuple, frozenset):
+        return all(_is_immutable(v) for v in value)
+    return False
+
+
+class _SpillFile(object):
+    """Keeps what is written in memory, or in a file past `threshold` bytes.
+
+    The file is compressed if `compression` is set.
+    """
+    def __init__(self, directory, threshold,
+                 compression=None, compression_level=None):
+        self.directory = directory
+        self.threshold = threshold
+        self.compression = compression
+        self.compression_level = compression_level
+        self.buffer = io.BytesIO()
+        self.raw = None
+        self.file = None
+        self.name = None
+
+    def write(self, data):
+        if self.file is None:
+            if self.buffer.tell() + len(data) <= self.threshold:
+                return self.buffer.write(data)
+            self.spill()
+        return self.file.write(data)
+
+    def spill(self):
+        """Move to a file now, if not done already.
+        """
+        if self.file is not None:
+            return
+        fd, self.name = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        self.raw = self.file = os.fdopen(fd, 'wb')
+        if self.compression is not None:
+            self.file = CompressingWriter(self.raw, self.compression,
+                                          self.compression_level)
+        self.file.write(self.buffer.getvalue())
+        self.buffer = None
+
+    def close(self):
+        if self.file is not None:
+            if self.file is not self.raw:
+                self.file.finish()
+            self.raw.close()
+
+    def discard(self):
+        if self.file is not None:
+            self.raw.close()
+            os.remove(self.name)
+
+
+def _load_temp_file(suffix, ref):
+    raise pickle.UnpicklingError("TemporaryFile objects can only be loaded "
+                                 "by Pickling")
+
+
 class Pickler(cloudpickle.CloudPickler):
-    def __init__(self, file, *, temp_dir):
-        super(Pickler, self).__init__(file, protocol=4)
+    def __init__(self, file, *, temp_dir, files=None, known=None,
+                 protocol=_PROTOCOL, buffer_callback=None, value=None):
+        if buffer_callback is None:
+            super(Pickler, self).__init__(file, protocol=protocol)
+        else:
+            super(Pickler, self).__init__(file, protocol=protocol,
+                                          buffer_callback=buffer_callback)
         self.__temp_dir = temp_dir
+        if files is None:
+            files = EmbeddedFiles()
+        self.__files = files
+        self.__known = known
+        # The value being stored separately, if that's what this pickles
+        self.__value = value
+        # The C pickler calls this for every object, even integers, so only
+        # set it when it's needed
+        if known is not None:
+            self.persistent_id = self._persistent_id
 
         if hasattr(self, 'dispatch_table'):
             pass
@@ -144,49 +1037,140 @@ class Pickler(cloudpickle.CloudPickler):
         self.dispatch_table[TemporaryFile] = self._tempfile_reduce
 
     def _tempfile_reduce(self, obj):
-        name = os.path.basename(obj.name)
-        if '.' in name:
-            suffix = '.' + name.split('.', 1)[1]
-        else:
-            suffix = None
-        with open(obj.name, 'rb') as fp:
-            contents = fp.read()
-        return type(obj), (suffix, contents)
+        return _load_temp_file, (obj.suffix, self.__files.save(obj))
+
+    def _persistent_id(self, obj):
+        if obj is self.__value or type(obj) is TemporaryFile:
+            return None
+        hash = self.__known(obj)
+        if hash is None:
+            return None
+        return self.__files.save_value(obj, hash, self._dump_value)
+
+    def _dump_value(self, obj, file, buffer_callback=None):
+        Pickler(
+            file, temp_dir=self.__temp_dir,
+            files=self.__files, known=self.__known,
+            buffer_callback=buffer_callback, value=obj,
+        ).dump(obj)
+
+
+# Whether the pickler has reducer_override(), which unlike persistent_id() is
+# not called for builtin types
+_REDUCER_OVERRIDE = hasattr(cloudpickle.CloudPickler, 'reducer_override')
+
+
+class _HashPickler(Pickler):
+    """Pickles a value to hash it, representing some objects by their hash.
+    """
+    def __init__(self, file, *, temp_dir, nested_hash, value):
+        super(_HashPickler, self).__init__(
+            file, temp_dir=temp_dir, files=_HashedFiles(),
+            known=None if _REDUCER_OVERRIDE else nested_hash,
+            protocol=4, value=value,
+        )
+        self.__nested_hash = nested_hash
+        self.__value = value
+
+    def reducer_override(self, obj):
+        if obj is not self.__value and type(obj) is not TemporaryFile:
+            hash = self.__nested_hash(obj)
+            if hash is not None:
+                return _hashed_value, (hash,)
+        return super(_HashPickler, self).reducer_override(obj)
+
+
+def _hashed_value(hash):
+    raise pickle.UnpicklingError("Pickles made for hashing can't be loaded")
 
 
 class Unpickler(pickle.Unpickler):
-    def __init__(self, file, *, temp_dir):
-        super(Unpickler, self).__init__(file)
+    def __init__(self, file, *, temp_dir, files=None, buffers=None):
+        if buffers is None:
+            super(Unpickler, self).__init__(file)
+        else:
+            super(Unpickler, self).__init__(file, buffers=buffers)
         self.__temp_dir = temp_dir
+        if files is None:
+            files = EmbeddedFiles()
+        self.__files = files
 
     def find_class(self, module, name):
-        if (module, name) == (__name__, 'TemporaryFile'):
+        if (module, name) == (__name__, '_load_temp_file'):
+            return self._tempfile_loader
+        elif (module, name) == (__name__, 'TemporaryFile'):
+            # Older format, with the contents embedded
             return self._tempfile_builder
         return super(Unpickler, self).find_class(module, name)
 
+    def _tempfile_loader(self, suffix, ref):
+        return self.__files.load(ref, suffix, self.__temp_dir)
+
     def _tempfile_builder(self, *args):
         suffix, contents = args
-        obj = TemporaryFile(temp_dir=self.__temp_dir, suffix=suffix)
-        with open(obj.name, 'wb') as fp:
-            fp.write(contents)
-        return obj
+        return EmbeddedFiles().load(contents, suffix, self.__temp_dir)
+
+    def persistent_load(self, pid):
+        return self.__files.load_value(pid, self._load_value)
+
+    def _load_value(self, file, buffers=None):
+        return Unpickler(
+            file, temp_dir=self.__temp_dir, files=self.__files,
+            buffers=buffers,
+        ).load()
 
 
 class Pickling(object):
-    def __init__(self, temp_dir):
+    """Serializes values, to hash them or to store them in a cache.
+
+    The `files` argument of the methods is a `FileStore`, receiving the
+    contents of `TemporaryFile` objects. By default, they are in the pickle.
+    """
+    def __init__(self, temp_dir, trace=None, hasher=None):
         self.temp_dir = temp_dir
+        self.trace = trace
+        if hasher is None:
+            hasher = Hasher()
+        self.hasher = hasher
 
-    def dump(self, obj, file):
-        Pickler(file, temp_dir=self.temp_dir).dump(obj)
+    def dump(self, obj, file, files=None):
+        known = None if files is None else self.hasher.known
+        if self.trace is None:
+            Pickler(file, temp_dir=self.temp_dir, files=files,
+                    known=known).dump(obj)
+            return
+        with self.trace.span('pickle') as args:
+            writer = _CountingWriter(file)
+            try:
+                Pickler(writer, temp_dir=self.temp_dir, files=files,
+                        known=known).dump(obj)
+            finally:
+                args['bytes'] = writer.bytes
 
-    def dumps(self, obj):
+    def dumps(self, obj, files=None):
         buffer = io.BytesIO()
-        Pickler(buffer, temp_dir=self.temp_dir).dump(obj)
+        self.dump(obj, buffer, files=files)
         return buffer.getvalue()
 
-    def load(self, file):
-        return Unpickler(file, temp_dir=self.temp_dir).load()
+    def load(self, file, files=None):
+        if self.trace is None:
+            return Unpickler(file, temp_dir=self.temp_dir, files=files).load()
+        with self.trace.span('unpickle') as args:
+            start = _tell(file)
+            try:
+                return Unpickler(file, temp_dir=self.temp_dir,
+                                 files=files).load()
+            finally:
+                end = _tell(file)
+                if start is not None and end is not None:
+                    args['bytes'] = end - start
+
+    def loads(self, s, files=None):
+        return self.load(io.BytesIO(s), files=files)
 
-    def loads(self, s):
-        buffer = io.BytesIO(s)
-        return Unpickler(buffer, temp_dir=self.temp_dir).load()
+    def span(self, name, **args):
+        """Record the time spent in a block, if tracing.
+        """
+        if self.trace is None:
+            return null_span()
+        return self.trace.span(name, **args)
@@ -0,0 +1,49 @@
+import contextlib
+import os
+import sqlite3
+import threading
+
+
+class Database(object):
+    """A SQLite database, used from multiple threads and processes.
+
+    Each thread gets its own connection. The database is in WAL mode, so
+    readers don't wait for writers.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def connect(self):
+        """Get the connection of the current thread.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode = WAL;")
+            db.execute("PRAGMA synchronous = NORMAL;")
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run statements in a transaction, committed at the end of the block.
+        """
+        db = self.connect()
+        # Take the write lock right away, so concurrent writers wait instead
+        # of failing when upgrading their lock
+        db.execute("BEGIN IMMEDIATE;")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK;")
+            raise
+        else:
+            db.execute("COMMIT;")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,268 @@
+import itertools
+import os
+import shutil
+import time
+
+from .database import Database, _remove
+
+
+class Index(object):
+    """Metadata about the entries of a `DirectoryCache`, in a SQLite file.
+
+    This records the size, creation time, last access time and number of
+    hits of each entry, and which blobs they reference, so that the least
+    recently used entries can be evicted to stay under a size budget.
+    Multiple processes can use the same index.
+
+    Entries are grouped by the first element of their key (the step hash),
+    and a group is evicted as a whole, so the outputs of a step don't go
+    away while its manifest stays.
+    """
+    def __init__(self, path, directory, blobs_directory):
+        self.path = path
+        self.directory = directory
+        self.blobs_directory = blobs_directory
+        self._db = Database(self.path)
+        with self._db.transaction() as db:
+            tables = {
+                row[0] for row in db.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table';",
+                )
+            }
+            if 'entries' not in tables:
+                self._create(db)
+
+    def _create(self, db):
+        db.execute(
+            '''
+            CREATE TABLE entries(
+                name TEXT PRIMARY KEY,
+                grp TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                hits INTEGER NOT NULL
+            );
+            ''',
+        )
+        db.execute("CREATE INDEX entries_grp ON entries(grp);")
+        db.execute(
+            '''
+            CREATE TABLE blobs(
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            );
+            ''',
+        )
+        db.execute(
+            '''
+            CREATE TABLE refs(
+                entry TEXT NOT NULL,
+                blob TEXT NOT NULL,
+                PRIMARY KEY(entry, blob)
+            );
+            ''',
+        )
+        db.execute("CREATE INDEX refs_blob ON refs(blob);")
+
+        # Add the entries already in the directory, the blobs they reference
+        # are unknown and will never be evicted
+        for name in _list_entries(self.directory):
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            db.execute(
+                '''
+                INSERT INTO entries(name, grp, size, created, accessed, hits)
+                VALUES(?, ?, ?, ?, ?, 0);
+                ''',
+                (name, name.split('__', 1)[0], stat.st_size,
+                 stat.st_mtime, stat.st_mtime),
+            )
+
+    def stored(self, name, size, blobs, max_size=None, pinned=()):
+        """Record a new entry, then evict others if over `max_size`.
+
+        :param name: The name of the entry's file.
+        :param blobs: The names of the blobs the entry references.
+        :param pinned: Groups that must not be evicted.
+        """
+        now = time.time()
+        blob_sizes = {}
+        for blob in blobs:
+            try:
+                blob_sizes[blob] = sum(
+                    os.path.getsize(path) for path in self._blob_files(blob)
+                )
+            except FileNotFoundError:
+                pass
+        group = name.split('__', 1)[0]
+        with self._db.transaction() as db:
+            db.execute(
+                '''
+                INSERT OR REPLACE INTO entries(
+                    name, grp, size, created, accessed, hits
+                )
+                VALUES(?, ?, ?, ?, ?, 0);
+                ''',
+                (name, group, size, now, now),
+            )
+            db.execute("DELETE FROM refs WHERE entry = ?;", (name,))
+            for blob, blob_size in blob_sizes.items():
+                db.execute(
+                    "INSERT OR IGNORE INTO blobs(name, size) VALUES(?, ?);",
+                    (blob, blob_size),
+                )
+                db.execute(
+                    "INSERT INTO refs(entry, blob) VALUES(?, ?);",
+                    (name, blob),
+                )
+            if max_size is not None:
+                self._evict(db, max_size, set(pinned) | {group})
+
+    def accessed(self, name):
+        """Record a hit on an entry.
+        """
+        with self._db.transaction() as db:
+            db.execute(
+                '''
+                UPDATE entries SET accessed = ?, hits = hits + 1
+                WHERE name = ?;
+                ''',
+                (time.time(), name),
+            )
+
+    def total_size(self):
+        """The size of the entries and blobs, in bytes.
+        """
+        db = self._db.connect()
+        return self._total_size(db)
+
+    def _total_size(self, db):
+        entries, = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries;",
+        ).fetchone()
+        blobs, = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs;",
+        ).fetchone()
+        return entries + blobs
+
+    def _evict(self, db, max_size, keep_groups):
+        total = self._total_size(db)
+        if total <= max_size:
+            return
+        groups = db.execute(
+            '''
+            SELECT grp FROM entries
+            GROUP BY grp
+            ORDER BY MAX(accessed);
+            ''',
+        ).fetchall()
+        for group, in groups:
+            if total <= max_size:
+                break
+            if group not in keep_groups:
+                total -= self._evict_group(db, group)
+
+    def removed(self, name):
+        """Remove an entry, and the blobs only it referenced.
+        """
+        with self._db.transaction() as db:
+            self._remove_entry(db, name)
+
+    def _evict_group(self, db, group):
+        """Remove the entries in a group.
+
+        :return: The number of bytes freed.
+        """
+        entries = db.execute(
+            "SELECT name FROM entries WHERE grp = ?;",
+            (group,),
+        ).fetchall()
+        return sum(self._remove_entry(db, name) for name, in entries)
+
+    def _remove_entry(self, db, name):
+        """Remove an entry, and the blobs only it referenced.
+
+        :return: The number of bytes freed.
+        """
+        _remove(os.path.join(self.directory, name))
+        _remove(os.path.join(self.directory, name + '.blobs'))
+        row = db.execute(
+            "SELECT size FROM entries WHERE name = ?;",
+            (name,),
+        ).fetchone()
+        if row is None:
+            return 0
+        freed, = row
+        blobs = [
+            blob for blob, in db.execute(
+                "SELECT blob FROM refs WHERE entry = ?;",
+                (name,),
+            )
+        ]
+        db.execute("DELETE FROM refs WHERE entry = ?;", (name,))
+        db.execute("DELETE FROM entries WHERE name = ?;", (name,))
+        for blob in blobs:
+            refs = _blob_refs(self.directory, blob)
+            _remove(os.path.join(refs, os.path.basename(name)))
+            used = db.execute(
+                "SELECT 1 FROM refs WHERE blob = ? LIMIT 1;",
+                (blob,),
+            ).fetchone()
+            if used is None:
+                size, = db.execute(
+                    "SELECT size FROM blobs WHERE name = ?;",
+                    (blob,),
+                ).fetchone()
+                db.execute("DELETE FROM blobs WHERE name = ?;", (blob,))
+                for path in self._blob_files(blob):
+                    _remove(path)
+                shutil.rmtree(refs, ignore_errors=True)
+                freed += size
+        return freed
+
+    def _blob_files(self, name):
+        return _blob_files(self.blobs_directory, name)
+
+
+def _blob_files(blobs_directory, name):
+    """The files of a blob: the pickle, then its out-of-band buffers.
+    """
+    directory = os.path.join(blobs_directory, name[:2])
+    paths = [os.path.join(directory, name)]
+    for i in itertools.count():
+        path = os.path.join(directory, '%s.%d' % (name, i))
+        if not os.path.exists(path):
+            break
+        paths.append(path)
+    return paths
+
+
+def _blob_refs(directory, name):
+    """The directory recording the entries that reference a blob.
+
+    It has an empty file named after each entry of the cache `directory`
+    referencing the blob, so that caches without an index can tell when a
+    blob is no longer used.
+    """
+    return os.path.join(directory, 'refs.d', name[:2], name)
+
+
+def _list_entries(directory):
+    """The names of the entry files, relative to the cache directory.
+
+    Entries are either directly in the directory, or in subdirectories named
+    after their first characters.
+    """
+    for name in os.listdir(directory):
+        if '.' in name:
+            continue
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            for sub in os.listdir(path):
+                if '.' not in sub:
+                    yield os.path.join(name, sub)
+        else:
+            yield name
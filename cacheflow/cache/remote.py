@@ -0,0 +1,246 @@
+import logging
+import os
+import requests
+import requests.adapters
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from .base import Cache
+from .compression import check_codec, open_compressed
+from .core import FileStore, TemporaryFile, _SpillFile, _key_name
+
+
+logger = logging.getLogger(__name__)
+
+
+# Values pickling to more than this are uploaded from a file
+_SPILL_THRESHOLD = 1 << 20
+
+_CHUNK_SIZE = 1 << 16
+
+
+class _AppendedFiles(FileStore):
+    """Puts the contents of the files after the pickle, in the same stream.
+
+    Call `write_contents()` after pickling, and `read_contents()` after
+    unpickling, to copy the contents in chunks.
+    """
+    def __init__(self):
+        self.files = []  # (path or TemporaryFile, size)
+
+    def save(self, temp_file):
+        size = os.path.getsize(temp_file.name)
+        self.files.append((temp_file.name, size))
+        return size
+
+    def load(self, ref, suffix, temp_dir):
+        obj = TemporaryFile(temp_dir=temp_dir, suffix=suffix)
+        self.files.append((obj, ref))
+        return obj
+
+    def write_contents(self, file):
+        for path, size in self.files:
+            with open(path, 'rb') as fp:
+                _copy(fp, file, size)
+
+    def read_contents(self, file):
+        for obj, size in self.files:
+            with open(obj.name, 'wb') as fp:
+                _copy(file, fp, size)
+
+
+def _copy(src, dst, size):
+    """Copy exactly `size` bytes between file objects.
+    """
+    while size > 0:
+        chunk = src.read(min(size, _CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("Truncated cache entry")
+        dst.write(chunk)
+        size -= len(chunk)
+
+
+class RemoteCache(Cache):
+    """Cache shared over HTTP, with a local cache in front.
+
+    Values are stored in the local cache and uploaded to the server, so
+    other machines can use them. Values are read from the local cache if
+    they are there, otherwise they are downloaded and stored locally for next
+    time. Uploads and downloads are streamed, and connections to the server
+    are kept alive and reused, up to `max_connections` at once.
+
+    The server is a `cacheflow.cache.server` (or anything implementing the
+    same API). If it can't be reached, the values are only stored locally,
+    and missing values are computed again; the server is not contacted
+    again for `retry_delay` seconds.
+
+    :param url: The base URL of the server.
+    :param local: The `Cache` to use locally, for example a
+    `DirectoryCache`.
+    :param compression: The codec to compress uploads with, see
+    `DirectoryCache`.
+    """
+    def __init__(self, url, local, max_connections=10, timeout=60,
+                 connect_timeout=5, retry_delay=60,
+                 compression='zlib', compression_level=None):
+        check_codec(compression)
+        self.url = url.rstrip('/') + '/'
+        self.local = local
+        self.timeout = connect_timeout, timeout
+        self.retry_delay = retry_delay
+        self._unreachable_until = None
+        self._lock = threading.Lock()
+        self.compression = compression
+        self.compression_level = compression_level
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_connections,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _entry_url(self, key):
+        return urllib.parse.urljoin(self.url, 'entries/' + _key_name(key))
+
+    def _reachable(self):
+        """Whether to contact the server, or wait after a failure.
+        """
+        with self._lock:
+            if self._unreachable_until is None:
+                return True
+            elif time.monotonic() >= self._unreachable_until:
+                self._unreachable_until = None
+                return True
+            return False
+
+    def _failed(self, action, error):
+        logger.warning("Can't %s cache server, not trying again for %ds: %s",
+                       action, self.retry_delay, error)
+        with self._lock:
+            self._unreachable_until = time.monotonic() + self.retry_delay
+
+    def has_key(self, key):
+        return bool(self.has_keys([key]))
+
+    def has_keys(self, keys):
+        present = self.local.has_keys(keys)
+        names = {
+            _key_name(key): key
+            for key in keys
+            if key not in present
+        }
+        if not names or not self._reachable():
+            return present
+        try:
+            response = self.session.post(
+                urllib.parse.urljoin(self.url, 'keys'),
+                json={'keys': list(names)},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            found = response.json()['keys']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self._failed("look up keys on", e)
+            return present
+        return present | {names[name] for name in found if name in names}
+
+    def retrieve(self, key, pickling, **kwargs):
+        try:
+            return self.local.retrieve(key, pickling=pickling, **kwargs)
+        except KeyError:
+            pass
+        value = self._download(key, pickling)
+        self.local.store(key, value, pickling=pickling)
+        return value
+
+    def _download(self, key, pickling):
+        """Get a value from the server, or raise `KeyError`.
+        """
+        if not self._reachable():
+            raise KeyError(key)
+        with tempfile.TemporaryFile(dir=pickling.temp_dir) as fp:
+            try:
+                with self.session.get(self._entry_url(key), stream=True,
+                                      timeout=self.timeout) as response:
+                    if response.status_code == 404:
+                        raise KeyError(key)
+                    response.raise_for_status()
+                    for chunk in response.iter_content(_CHUNK_SIZE):
+                        fp.write(chunk)
+            except requests.RequestException as e:
+                self._failed("download from", e)
+                raise KeyError(key)
+            fp.seek(0, 0)
+            reader = open_compressed(fp)
+            files = _AppendedFiles()
+            value = pickling.load(reader, files=files)
+            files.read_contents(reader)
+            return value
+
+    def store(self, key, value, pickling, **kwargs):
+        self.local.store(key, value, pickling=pickling, **kwargs)
+        if not self._reachable():
+            return
+        # The contents of files are sent after the pickle, the server has no
+        # blob store
+        spill = _SpillFile(pickling.temp_dir, _SPILL_THRESHOLD,
+                           self.compression, self.compression_level)
+        files = _AppendedFiles()
+        try:
+            try:
+                pickling.dump(value, spill, files=files)
+            except TypeError:
+                return
+            files.write_contents(spill)
+            spill.close()
+            if spill.name is None:
+                self._upload(key, spill.buffer.getvalue())
+            else:
+                with open(spill.name, 'rb') as fp:
+                    self._upload(key, fp)
+        finally:
+            spill.discard()
+
+    def _upload(self, key, data):
+        try:
+            response = self.session.put(
+                self._entry_url(key),
+                data=data,
+                headers={'Content-Type': 'application/octet-stream'},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            self._failed("upload to", e)
+
+    def remove(self, key):
+        self.local.remove(key)
+        if not self._reachable():
+            return
+        try:
+            response = self.session.delete(self._entry_url(key),
+                                           timeout=self.timeout)
+            if response.status_code != 404:
+                response.raise_for_status()
+        except requests.RequestException as e:
+            self._failed("remove from", e)
+
+    def size(self, key):
+        return self.local.size(key)
+
+    def lock(self, key):
+        return self.local.lock(key)
+
+    def pin(self, key):
+        self.local.pin(key)
+
+    def unpin(self, key):
+        self.local.unpin(key)
+
+    def close(self):
+        """Close the connections to the server.
+        """
+        self.session.close()
@@ -0,0 +1,179 @@
+import argparse
+import logging
+import os
+import re
+import tempfile
+import tornado.ioloop
+import tornado.iostream
+from tornado.routing import URLSpec
+import tornado.web
+
+from .. import __version__
+from ..web.base import BaseHandler
+
+
+logger = logging.getLogger(__name__)
+
+
+_CHUNK_SIZE = 1 << 16
+
+# The names `RemoteCache` uses, which can't escape the directory
+_name_re = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class Application(tornado.web.Application):
+    """Cache server, storing the entries uploaded by `RemoteCache` as files.
+
+    Entries are stored as they are received, in subdirectories of
+    `directory` named after the start of the entry's name.
+    """
+    def __init__(self, directory, handlers, **kwargs):
+        super(Application, self).__init__(handlers, **kwargs)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def entry_path(self, name):
+        return os.path.join(self.directory, name[:2], name)
+
+
+@tornado.web.stream_request_body
+class Entry(BaseHandler):
+    def prepare(self):
+        self.temp_file = self.temp_name = None
+        if self.request.method == 'PUT':
+            self.request.connection.set_max_body_size(
+                self.settings['max_entry_size'],
+            )
+            fd, self.temp_name = tempfile.mkstemp(
+                dir=self.application.directory,
+                prefix='.tmp',
+            )
+            self.temp_file = os.fdopen(fd, 'wb')
+
+    def data_received(self, chunk):
+        self.temp_file.write(chunk)
+
+    def put(self, name):
+        # Write to a temporary file, then move it in place, so entries being
+        # uploaded are never served
+        self.temp_file.close()
+        path = self.application.entry_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.temp_name, path)
+        self.temp_name = None
+        logger.info("Stored %s", name)
+        self.set_status(204)
+        return self.finish()
+
+    def on_finish(self):
+        self._discard()
+
+    def on_connection_close(self):
+        self._discard()
+
+    def _discard(self):
+        if self.temp_name is not None:
+            self.temp_file.close()
+            try:
+                os.remove(self.temp_name)
+            except FileNotFoundError:
+                pass
+            self.temp_name = None
+
+    async def get(self, name):
+        try:
+            fp = open(self.application.entry_path(name), 'rb')
+        except FileNotFoundError:
+            return self.send_error_json(404, "No such entry")
+        with fp:
+            self.set_header('Content-Type', 'application/octet-stream')
+            self.set_header('Content-Length', os.fstat(fp.fileno()).st_size)
+            while True:
+                chunk = fp.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                try:
+                    self.write(chunk)
+                    await self.flush()
+                except tornado.iostream.StreamClosedError:
+                    return
+        return self.finish()
+
+    def head(self, name):
+        try:
+            size = os.path.getsize(self.application.entry_path(name))
+        except FileNotFoundError:
+            self.set_status(404)
+            return self.finish()
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Content-Length', size)
+        return self.finish()
+
+    def delete(self, name):
+        try:
+            os.remove(self.application.entry_path(name))
+        except FileNotFoundError:
+            return self.send_error_json(404, "No such entry")
+        logger.info("Removed %s", name)
+        self.set_status(204)
+        return self.finish()
+
+
+class Keys(BaseHandler):
+    def post(self):
+        """Find out which of a list of entries are present.
+        """
+        keys = self.get_json().get('keys')
+        if not isinstance(keys, list):
+            return self.send_error_json(400, "Expected a list of keys")
+        return self.send_json({
+            'keys': [
+                name for name in keys
+                if isinstance(name, str) and _name_re.match(name) and
+                os.path.exists(self.application.entry_path(name))
+            ],
+        })
+
+
+def make_app(directory, max_entry_size=10 << 30, debug=False):
+    return Application(
+        directory,
+        [
+            URLSpec('/entries/([A-Za-z0-9_-]+)', Entry),
+            URLSpec('/keys', Keys),
+        ],
+        max_entry_size=max_entry_size,
+        debug=debug,
+    )
+
+
+def main():
+    logging.root.handlers.clear()
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+
+    parser = argparse.ArgumentParser(
+        description="Cache server, sharing results between machines",
+    )
+    parser.add_argument('--version', action='version',
+                        version='cacheflow version %s' % __version__)
+    parser.add_argument('-p', '--port', default='7456',
+                        help="Port number to listen on")
+    parser.add_argument('-b', '--bind', default='127.0.0.1',
+                        help="Address to bind on")
+    parser.add_argument('--debug', action='store_true', default=False,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('directory', nargs=argparse.OPTIONAL,
+                        default='_cf_server',
+                        help="Directory to store the entries in")
+
+    args = parser.parse_args()
+    try:
+        port = int(args.port, 10)
+    except ValueError:
+        return parser.error("Invalid port number")
+
+    app = make_app(os.path.abspath(args.directory), debug=args.debug)
+    app.listen(port, args.bind)
+    logger.info("Listening on %s:%d", args.bind, port)
+    tornado.ioloop.IOLoop.current().start()
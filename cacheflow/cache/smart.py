@@ -0,0 +1,263 @@
+import json
+import os
+import tempfile
+import weakref
+
+from .base import Cache, _pins
+from .core import _pickled_size
+from .database import Database, _remove
+
+
+class SmartCache(Cache):
+    """Smart cache, deciding whether to store data or not.
+
+    A decision to store inputs or not is made depending on:
+
+      * The value's size
+      * The computational cost of re-computing the value (`work_amount`)
+      * How often/recently the value was requested from the cache
+
+    Entries are evicted with the GreedyDual-Size-Frequency policy to stay
+    under `max_size` bytes, grouped like in `cacheflow.cache.index.Index`.
+    Their metadata is in a SQLite database at `path` (temporary if not set).
+
+    :param cache: The `Cache` to store the values in.
+    :param read_rate: The rate at which values are read back, in bytes per
+    second. Values computed faster than that are not stored.
+    """
+    def __init__(self, cache, max_size, read_rate=100e6, path=None):
+        self.cache = cache
+        self.max_size = max_size
+        self.read_rate = read_rate
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='cacheflow-smart-',
+                                        suffix='.sqlite3')
+            os.close(fd)
+            weakref.finalize(self, _remove_database, path)
+        self.path = path
+        self._db = Database(path)
+        with self._db.transaction() as db:
+            db.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS groups(
+                    name TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    cost REAL NOT NULL,
+                    hits INTEGER NOT NULL,
+                    priority REAL NOT NULL
+                );
+                ''',
+            )
+            db.execute(
+                '''
+                CREATE INDEX IF NOT EXISTS groups_priority
+                ON groups(priority);
+                ''',
+            )
+            db.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS entries(
+                    key TEXT PRIMARY KEY,
+                    grp TEXT NOT NULL,
+                    size INTEGER NOT NULL
+                );
+                ''',
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_grp ON entries(grp);",
+            )
+            db.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS inflation(
+                    value REAL NOT NULL
+                );
+                ''',
+            )
+            row = db.execute("SELECT 1 FROM inflation;").fetchone()
+            if row is None:
+                db.execute("INSERT INTO inflation(value) VALUES(0.0);")
+
+    @property
+    def total_size(self):
+        """The size of the entries known to this cache, in bytes.
+        """
+        total, = self._db.connect().execute(
+            "SELECT COALESCE(SUM(size), 0) FROM groups;",
+        ).fetchone()
+        return total
+
+    def has_key(self, key):
+        return self.cache.has_key(key)
+
+    def retrieve(self, key, **kwargs):
+        value = self.cache.retrieve(key, **kwargs)
+        with self._db.transaction() as db:
+            row = db.execute(
+                "SELECT 1 FROM entries WHERE key = ?;",
+                (_encode(key),),
+            ).fetchone()
+            if row is None:
+                size = self.cache.size(key)
+                if size is None:
+                    return value
+                self._add(db, key, size)
+            db.execute(
+                "UPDATE groups SET hits = hits + 1 WHERE name = ?;",
+                (_encode(key[:1]),),
+            )
+            self._update(db, key)
+            self._evict(db)
+        return value
+
+    def store(self, key, value, work_amount=None, **kwargs):
+        self.cache.store(key, value, work_amount=work_amount, **kwargs)
+        size = self.cache.size(key)
+        if size is None:
+            pickling = kwargs.get('pickling')
+            if pickling is None:
+                return
+            size = _pickled_size(value, pickling)
+
+        if (work_amount is not None and
+                work_amount * self.read_rate < size):
+            # Faster to compute again than to read from the cache
+            self.cache.remove(key)
+            return
+
+        with self._db.transaction() as db:
+            self._add(db, key, size)
+            if work_amount is not None:
+                db.execute(
+                    "UPDATE groups SET cost = MAX(cost, ?) WHERE name = ?;",
+                    (work_amount, _encode(key[:1])),
+                )
+            self._update(db, key)
+            self._evict(db)
+
+    def remove(self, key):
+        with self._db.transaction() as db:
+            row = db.execute(
+                "SELECT size FROM entries WHERE key = ?;",
+                (_encode(key),),
+            ).fetchone()
+            if row is not None:
+                group = _encode(key[:1])
+                db.execute("DELETE FROM entries WHERE key = ?;",
+                           (_encode(key),))
+                db.execute(
+                    "UPDATE groups SET size = size - ? WHERE name = ?;",
+                    (row[0], group),
+                )
+                db.execute(
+                    '''
+                    DELETE FROM groups WHERE name = ? AND NOT EXISTS(
+                        SELECT 1 FROM entries WHERE grp = ?
+                    );
+                    ''',
+                    (group, group),
+                )
+        self.cache.remove(key)
+
+    def size(self, key):
+        return self.cache.size(key)
+
+    def lock(self, key):
+        return self.cache.lock(key)
+
+    def pin(self, key):
+        _pins.pin(self.path, _encode(key[:1]))
+        self.cache.pin(key)
+
+    def unpin(self, key):
+        _pins.unpin(self.path, _encode(key[:1]))
+        self.cache.unpin(key)
+
+    def _add(self, db, key, size):
+        """Record that a key is in the cache, with its size.
+        """
+        group = _encode(key[:1])
+        db.execute(
+            '''
+            INSERT OR IGNORE INTO groups(name, size, cost, hits, priority)
+            VALUES(?, 0, 0.0, 1, 0.0);
+            ''',
+            (group,),
+        )
+        row = db.execute(
+            "SELECT size FROM entries WHERE key = ?;",
+            (_encode(key),),
+        ).fetchone()
+        previous = 0 if row is None else row[0]
+        db.execute(
+            '''
+            INSERT OR REPLACE INTO entries(key, grp, size)
+            VALUES(?, ?, ?);
+            ''',
+            (_encode(key), group, size),
+        )
+        db.execute(
+            "UPDATE groups SET size = size + ? WHERE name = ?;",
+            (size - previous, group),
+        )
+
+    def _update(self, db, key):
+        """Compute the priority of a group after it changed.
+        """
+        db.execute(
+            '''
+            UPDATE groups
+            SET priority = (SELECT value FROM inflation) +
+                hits * cost / MAX(1, size)
+            WHERE name = ?;
+            ''',
+            (_encode(key[:1]),),
+        )
+
+    def _evict(self, db):
+        """Remove groups with the lowest priority until under budget.
+
+        Pinned groups are skipped.
+        """
+        total, = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM groups;",
+        ).fetchone()
+        if total <= self.max_size:
+            return
+        pinned = _pins.groups(self.path)
+        evicted = []
+        for group, priority, size in db.execute(
+            "SELECT name, priority, size FROM groups "
+            "ORDER BY priority, rowid;",
+        ):
+            if total <= self.max_size:
+                break
+            if group in pinned:
+                continue
+            evicted.append(group)
+            total -= size
+            inflation = priority
+        if not evicted:
+            return
+        db.execute("UPDATE inflation SET value = ?;", (inflation,))
+        for group in evicted:
+            entries = db.execute(
+                "SELECT key FROM entries WHERE grp = ?;",
+                (group,),
+            ).fetchall()
+            db.execute("DELETE FROM entries WHERE grp = ?;", (group,))
+            db.execute("DELETE FROM groups WHERE name = ?;", (group,))
+            for key, in entries:
+                self.cache.remove(_decode(key))
+
+
+def _encode(key):
+    return json.dumps(list(key))
+
+
+def _decode(key):
+    return tuple(json.loads(key))
+
+
+def _remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        _remove(path + suffix)
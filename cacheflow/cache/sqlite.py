@@ -0,0 +1,236 @@
+import io
+import os
+
+from .base import Cache
+from .core import BlobFiles, _SpillFile, _key_name
+from .database import Database, _remove
+from .index import _blob_files
+
+
+class SqliteCache(Cache):
+    """On-disk cache keeping values in a SQLite database.
+
+    This suits many small entries better than `DirectoryCache`, which writes
+    a file for each. Values that pickle to at most `inline_threshold` bytes
+    are stored in the database, bigger ones are written to files in
+    `directory`. Files, and big values whose hash is known, are stored once
+    in a content-addressed area (see `BlobFiles`), until the last entry
+    referencing them is removed.
+
+    The database is in WAL mode, so readers don't wait for writers, and
+    multiple processes can use the same cache.
+
+    :param directory: Directory containing the database and the files,
+    created if it doesn't exist.
+    """
+    def __init__(self, directory, inline_threshold=1 << 16,
+                 blob_threshold=1 << 16):
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        self.directory = directory
+        self.inline_threshold = inline_threshold
+        self.blob_threshold = blob_threshold
+        # Names of files never contain a dot
+        self.path = os.path.join(directory, 'cache.sqlite3')
+        self._db = Database(self.path)
+        with self._db.transaction() as db:
+            db.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS entries(
+                    key TEXT PRIMARY KEY,
+                    value BLOB,
+                    file TEXT
+                );
+                ''',
+            )
+            db.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS refs(
+                    entry TEXT NOT NULL,
+                    blob TEXT NOT NULL,
+                    PRIMARY KEY(entry, blob)
+                );
+                ''',
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS refs_blob ON refs(blob);")
+
+    def _blobs_directory(self):
+        return os.path.join(self.directory, 'blobs.d')
+
+    def _blobs(self, pickling):
+        return BlobFiles(self._blobs_directory(), pickling,
+                         self.blob_threshold)
+
+    def has_key(self, key):
+        row = self._db.connect().execute(
+            "SELECT 1 FROM entries WHERE key = ?;",
+            (_key_name(key),),
+        ).fetchone()
+        return row is not None
+
+    def has_keys(self, keys):
+        names = {_key_name(key): key for key in keys}
+        return {
+            names[name]
+            for name, in self._select('key', list(names))
+        }
+
+    def retrieve(self, key, pickling, **kwargs):
+        row = self._db.connect().execute(
+            "SELECT value, file FROM entries WHERE key = ?;",
+            (_key_name(key),),
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._load(key, row[0], row[1], pickling)
+
+    def retrieve_many(self, keys, pickling, **kwargs):
+        names = {_key_name(key): key for key in keys}
+        values = {}
+        for name, value, file in self._select('key, value, file',
+                                              list(names)):
+            key = names[name]
+            try:
+                values[key] = self._load(key, value, file, pickling)
+            except KeyError:
+                pass
+        return values
+
+    def _select(self, columns, names):
+        """Get rows for multiple keys, with as few queries as possible.
+        """
+        db = self._db.connect()
+        # SQLite limits the number of parameters in a query
+        for start in range(0, len(names), 500):
+            batch = names[start:start + 500]
+            yield from db.execute(
+                "SELECT %s FROM entries WHERE key IN (%s);" % (
+                    columns, ', '.join('?' * len(batch)),
+                ),
+                batch,
+            )
+
+    def _load(self, key, value, file, pickling):
+        files = self._blobs(pickling)
+        if value is not None:
+            return pickling.load(io.BytesIO(value), files=files)
+        try:
+            fp = open(os.path.join(self.directory, file), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+        with fp:
+            return pickling.load(fp, files=files)
+
+    def store(self, key, value, pickling, **kwargs):
+        name = _key_name(key)
+        spill = _SpillFile(self.directory, self.inline_threshold)
+        files = self._blobs(pickling)
+        try:
+            try:
+                pickling.dump(value, spill, files=files)
+            except TypeError:
+                spill.discard()
+                return
+            if spill.name is not None:
+                spill.close()
+                os.replace(spill.name, os.path.join(self.directory, name))
+        except BaseException:
+            spill.discard()
+            raise
+
+        with self._db.transaction() as db:
+            row = db.execute(
+                "SELECT file FROM entries WHERE key = ?;",
+                (name,),
+            ).fetchone()
+            if spill.name is None:
+                db.execute(
+                    '''
+                    INSERT OR REPLACE INTO entries(key, value, file)
+                    VALUES(?, ?, NULL);
+                    ''',
+                    (name, spill.buffer.getbuffer()),
+                )
+                if row is not None and row[0] is not None:
+                    # Was bigger before
+                    _remove(os.path.join(self.directory, row[0]))
+            else:
+                db.execute(
+                    '''
+                    INSERT OR REPLACE INTO entries(key, value, file)
+                    VALUES(?, NULL, ?);
+                    ''',
+                    (name, name),
+                )
+            previous = self._refs(db, name)
+            db.execute("DELETE FROM refs WHERE entry = ?;", (name,))
+            for blob in files.referenced:
+                db.execute(
+                    "INSERT INTO refs(entry, blob) VALUES(?, ?);",
+                    (name, blob),
+                )
+            self._remove_unused(db, previous - files.referenced)
+
+    def remove(self, key):
+        name = _key_name(key)
+        with self._db.transaction() as db:
+            row = db.execute(
+                "SELECT file FROM entries WHERE key = ?;",
+                (name,),
+            ).fetchone()
+            db.execute("DELETE FROM entries WHERE key = ?;", (name,))
+            if row is not None and row[0] is not None:
+                _remove(os.path.join(self.directory, row[0]))
+            blobs = self._refs(db, name)
+            db.execute("DELETE FROM refs WHERE entry = ?;", (name,))
+            self._remove_unused(db, blobs)
+
+    def _refs(self, db, name):
+        """The blobs an entry references.
+        """
+        return {
+            blob for blob, in db.execute(
+                "SELECT blob FROM refs WHERE entry = ?;",
+                (name,),
+            )
+        }
+
+    def _remove_unused(self, db, blobs):
+        """Remove the blobs that no entry references anymore.
+        """
+        for blob in blobs:
+            used = db.execute(
+                "SELECT 1 FROM refs WHERE blob = ? LIMIT 1;",
+                (blob,),
+            ).fetchone()
+            if used is None:
+                for path in _blob_files(self._blobs_directory(), blob):
+                    _remove(path)
+
+    def size(self, key):
+        """The size of an entry, including the blobs it references.
+
+        Blobs shared with other entries are counted for each of them.
+        """
+        name = _key_name(key)
+        db = self._db.connect()
+        row = db.execute(
+            "SELECT length(value), file FROM entries WHERE key = ?;",
+            (name,),
+        ).fetchone()
+        if row is None:
+            return None
+        elif row[1] is not None:
+            try:
+                size = os.path.getsize(os.path.join(self.directory, row[1]))
+            except FileNotFoundError:
+                return None
+        else:
+            size = row[0]
+        for blob in self._refs(db, name):
+            for path in _blob_files(self._blobs_directory(), blob):
+                try:
+                    size += os.path.getsize(path)
+                except FileNotFoundError:
+                    pass
+        return size
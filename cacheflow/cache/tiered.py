@@ -0,0 +1,116 @@
+import collections
+import threading
+
+from .base import Cache
+from .core import TemporaryFile
+
+
+class TieredCache(Cache):
+    """Keeps recent values in memory, pickled, in front of another cache.
+
+    :param cache: The `Cache` storing the values.
+    :param max_size: The budget for the pickles in memory, in bytes.
+    """
+    def __init__(self, cache, max_size):
+        self.cache = cache
+        self.max_size = max_size
+        self.memory_size = 0
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()  # key: pickle
+
+    def has_key(self, key):
+        with self._lock:
+            if key in self._memory:
+                return True
+        return self.cache.has_key(key)
+
+    def retrieve(self, key, **kwargs):
+        pickling = kwargs.get('pickling')
+        if pickling is not None:
+            with self._lock:
+                pickle = self._memory.get(key)
+                if pickle is not None:
+                    self._memory.move_to_end(key)
+            if pickle is not None:
+                # Values are unpickled every time, so changing one doesn't
+                # change what the cache returns next
+                return pickling.loads(pickle)
+        value = self.cache.retrieve(key, **kwargs)
+        self._promote(key, value, pickling)
+        return value
+
+    def store(self, key, value, **kwargs):
+        self.cache.store(key, value, **kwargs)
+        if self.cache.has_key(key):
+            self._promote(key, value, kwargs.get('pickling'))
+        else:
+            self._drop(key)
+
+    def remove(self, key):
+        self._drop(key)
+        self.cache.remove(key)
+
+    def size(self, key):
+        return self.cache.size(key)
+
+    def lock(self, key):
+        return self.cache.lock(key)
+
+    def pin(self, key):
+        self.cache.pin(key)
+
+    def unpin(self, key):
+        self.cache.unpin(key)
+
+    def _promote(self, key, value, pickling):
+        """Keep a value in memory, if it fits.
+
+        Values with `TemporaryFile` objects are not kept, their files belong
+        to the executor that loaded them.
+        """
+        if pickling is None or _contains_file(value):
+            self._drop(key)
+            return
+        try:
+            pickle = pickling.dumps(value)
+        except TypeError:
+            self._drop(key)
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self.memory_size -= len(previous)
+            if len(pickle) > self.max_size:
+                return
+            self._memory[key] = pickle
+            self.memory_size += len(pickle)
+            while self.memory_size > self.max_size:
+                _, dropped = self._memory.popitem(last=False)
+                self.memory_size -= len(dropped)
+
+    def _drop(self, key):
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self.memory_size -= len(previous)
+
+
+def _contains_file(value):
+    """Find `TemporaryFile` objects in a value, looking in common containers.
+    """
+    stack = [value]
+    seen = set()
+    while stack:
+        value = stack.pop()
+        if isinstance(value, TemporaryFile):
+            return True
+        elif isinstance(value, (list, tuple, set, frozenset, dict)):
+            if id(value) in seen:
+                continue
+            seen.add(id(value))
+            if isinstance(value, dict):
+                stack.extend(value.keys())
+                stack.extend(value.values())
+            else:
+                stack.extend(value)
+    return False
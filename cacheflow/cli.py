@@ -1,4 +1,6 @@
 import argparse
+import contextlib
+import csv
 import logging
 import os
 import sys
@@ -6,7 +8,11 @@ import yaml
 
 from . import __version__
 from .cache import DirectoryCache
+from .cache.compression import CODECS
+from .cache.remote import RemoteCache
 from .executor import Executor
+from .sweep import Sweep
+from .trace import Trace
 from cacheflow.storage.json import InvalidWorkflowJson, workflow_from_json
 
 
@@ -33,8 +39,26 @@ def main():
 
     parser_run = subparsers.add_parser('run', help="Run a workflow")
     parser_run.add_argument('workflow', action='store')
+    _add_executor_arguments(parser_run)
     parser_run.set_defaults(func=run)
 
+    parser_sweep = subparsers.add_parser(
+        'sweep',
+        help="Run a workflow for every combination of parameter values",
+    )
+    parser_sweep.add_argument('workflow', action='store')
+    parser_sweep.add_argument('-p', '--parameter', action='append',
+                              nargs='+', dest='parameters', required=True,
+                              metavar=('STEP.PARAMETER', 'VALUE'),
+                              help="Parameter to sweep, followed by its "
+                                   "values")
+    parser_sweep.add_argument('-o', '--output', action='append',
+                              dest='outputs', default=[],
+                              metavar='STEP.OUTPUT',
+                              help="Output to print in the results table")
+    _add_executor_arguments(parser_sweep)
+    parser_sweep.set_defaults(func=sweep)
+
     args = parser.parse_args()
 
     if not args.func:
@@ -44,22 +68,128 @@ def main():
     args.func(args)
 
 
-def run(args):
+def _add_executor_arguments(parser):
+    parser.add_argument('-j', '--jobs', action='store', type=int,
+                        default=None,
+                        help="Number of steps to run in parallel (default: "
+                             "1, or one per CPU with --processes)")
+    parser.add_argument('--processes', action='store_const',
+                        dest='backend', const='processes',
+                        default='threads',
+                        help="Run steps in worker processes instead of "
+                             "threads")
+    parser.add_argument('--top-down', action='store_true', default=False,
+                        help="Look up steps in the cache from the sinks, "
+                             "using the structure of the workflow, "
+                             "to avoid running the steps they depend on")
+    parser.add_argument('--spill-outputs', action='store_true',
+                        default=False,
+                        help="Drop step outputs from memory once they "
+                             "are cached, reading them back when needed")
+    parser.add_argument('--trace', action='store', default=None,
+                        help="Write a trace of the execution to this "
+                             "file, in the Chrome trace event format")
+    parser.add_argument('--cache-size', action='store', type=int,
+                        default=None,
+                        help="Maximum size of the cache in megabytes, "
+                             "least recently used entries are evicted")
+    parser.add_argument('--cache-compression', action='store',
+                        choices=sorted(CODECS), default=None,
+                        help="Compress new cache entries with this codec")
+    parser.add_argument('--cache-server', action='store', default=None,
+                        help="URL of a cache server (see "
+                             "cacheflow-cache-server) to share results "
+                             "with other machines")
+
+
+def _load_workflow(filename):
     try:
-        with open(args.workflow) as fp:
+        with open(filename) as fp:
             try:
                 obj = yaml.safe_load(fp)
             except yaml.YAMLError:
                 raise InvalidWorkflowJson("Invalid YAML")
-        workflow = workflow_from_json(obj)
+        return workflow_from_json(obj)
     except InvalidWorkflowJson as e:
         logger.error("Error loading workflow: %s", e)
         sys.exit(1)
 
+
+@contextlib.contextmanager
+def _executor(args):
+    """Set up an executor from the command-line arguments.
+    """
     cache_loc = os.path.abspath('_cf_cache')
+    trace = trace_loc = None
+    if args.trace:
+        trace = Trace()
+        trace_loc = os.path.abspath(args.trace)
     os.chdir(os.path.dirname(args.workflow))
 
-    executor = Executor(DirectoryCache(cache_loc))
+    max_size = None
+    if args.cache_size is not None:
+        max_size = args.cache_size * 1000000
+    cache = DirectoryCache(cache_loc, max_size=max_size,
+                           compression=args.cache_compression)
+    if args.cache_server is not None:
+        cache = RemoteCache(args.cache_server, cache)
+    executor = Executor(cache, max_workers=args.jobs,
+                        backend=args.backend, top_down=args.top_down,
+                        spill_outputs=args.spill_outputs, trace=trace)
     executor.add_components_from_entrypoint()
-    executor.load_workflow(workflow)
-    executor.execute()
+    try:
+        yield executor
+    finally:
+        if trace is not None:
+            with open(trace_loc, 'w') as fp:
+                trace.write(fp)
+            logger.info("Wrote trace to %s", trace_loc)
+
+
+def run(args):
+    workflow = _load_workflow(args.workflow)
+
+    with _executor(args) as executor:
+        executor.load_workflow(workflow)
+        executor.execute()
+
+
+def _split_ref(ref, what):
+    if '.' not in ref:
+        logger.error("Invalid %s %r (should be <step>.<name>)", what, ref)
+        sys.exit(2)
+    return tuple(ref.split('.', 1))
+
+
+def sweep(args):
+    workflow = _load_workflow(args.workflow)
+
+    parameters = []
+    for param in args.parameters:
+        step_id, name = _split_ref(param[0], "parameter")
+        parameters.append((step_id, name, param[1:]))
+    outputs = [_split_ref(ref, "output") for ref in args.outputs]
+    try:
+        sweep = Sweep(workflow, parameters)
+    except ValueError as e:
+        logger.error("Invalid sweep: %s", e)
+        sys.exit(1)
+    for step_id, _ in outputs:
+        if step_id not in workflow.steps:
+            logger.error("Unknown step %r", step_id)
+            sys.exit(1)
+    sinks = {step_id for step_id, _ in outputs} or None
+
+    with _executor(args) as executor:
+        table = sweep.execute(executor, sinks)
+
+    writer = csv.writer(sys.stdout, delimiter='\t', lineterminator='\n')
+    writer.writerow(
+        ['%s.%s' % p for p in sweep.parameters] +
+        ['%s.%s' % o for o in outputs]
+    )
+    for combination, results in table.items():
+        writer.writerow(
+            list(combination) +
+            [results[step_id][name] for step_id, name in outputs]
+        )
@@ -1,14 +1,33 @@
+import asyncio
+import collections.abc
+import concurrent.futures
+from hashlib import sha256
+import heapq
 import logging
+import os
+import pickle
 from pkg_resources import iter_entry_points
+import itertools
+import struct
 import tempfile
+import threading
+import time
+import weakref
 
 from .base import StepInputConnection
-from .cache.core import hash_value, UNHASHABLE, Pickling
+from .cache.core import hash_value, UNHASHABLE, MovedFiles, Pickling, \
+    SharedFiles, _is_immutable, _pickled_size
+from .stream import Stream
 
 
 logger = logging.getLogger(__name__)
 
 
+# Constants of these exact types are only hashed once per workflow, they
+# only compare equal to values that hash the same
+_MEMOIZED_CONSTANTS = (str, bytes, int)
+
+
 def hash_dict_list(dct, pickling):
     return {
         k: [(e, hash_value(e, pickling)) for e in v]
@@ -16,17 +35,111 @@ def hash_dict_list(dct, pickling):
     }
 
 
+def _step_definition(step, step_hashes):
+    """Something equal for steps that hash the same, or None.
+
+    This compares the component and parameters without hashing them, and
+    the hashes of the upstream steps.
+    """
+    key = _constant_key(step.component_def)
+    if key is None:
+        return None
+    parts = [key]
+    for name, inputs in sorted(step.inputs.items()):
+        for input in inputs:
+            if isinstance(input, StepInputConnection):
+                parts.append((name, input.source_output_name,
+                              step_hashes[input.source_step_id]))
+            else:
+                key = _constant_key(input)
+                if key is None:
+                    return None
+                parts.append((name, key))
+    return tuple(parts)
+
+
+def _constant_key(value):
+    """Something equal for constants that hash the same, or None.
+
+    Unlike the values, this doesn't compare ``1``, ``True`` and ``1.0`` (or
+    ``0.0`` and ``-0.0``) as equal.
+    """
+    type_ = type(value)
+    if type_ in _MEMOIZED_CONSTANTS or type_ is bool or value is None:
+        return type_, value
+    elif type_ is float:
+        return type_, struct.pack('>d', value)
+    elif type_ is tuple or type_ is list:
+        keys = []
+        for item in value:
+            key = _constant_key(item)
+            if key is None:
+                return None
+            keys.append(key)
+        return type_, tuple(keys)
+    elif type_ is dict:
+        keys = []
+        for k, v in value.items():
+            k, v = _constant_key(k), _constant_key(v)
+            if k is None or v is None:
+                return None
+            keys.append((k, v))
+        return type_, tuple(keys)
+    return None
+
+
 class Executor(object):
-    def __init__(self, cache):
+    """Executes workflows, getting results from the cache when possible.
+
+    :param cache: The `Cache` used to store and retrieve step outputs.
+    :param max_workers: Number of steps to run at the same time, using a
+    thread pool. Steps run one after the other if this is ``None`` or 1,
+    except with the ``'processes'`` backend where ``None`` means one per CPU.
+    :param backend: Either ``'threads'`` to run the components in the
+    executor's threads, or ``'processes'`` to run them in a pool of worker
+    processes. Inputs and outputs are sent to and from the worker processes
+    using `Pickling`.
+    :param top_down: If True, also record step outputs under the structural
+    hash of the step (computed from the workflow, see `step_hashes`), and
+    start executions from the requested sinks, only running the steps whose
+    outputs can't be found that way.
+    :param spill_outputs: If True, the outputs of a step are dropped from
+    memory as soon as they are stored in the cache, and loaded back from
+    there when a dependent step runs. This reduces memory usage at the
+    expense of reading them back from the cache.
+    :param trace: A `cacheflow.trace.Trace` recording the time spent in each
+    phase of the steps (hashing, cache lookups, pickling, execution).
+    :param hasher: The `Hasher` used to hash values, to use a different
+    digest algorithm.
+    """
+    BACKENDS = ('threads', 'processes')
+
+    # Number of step durations to remember
+    MAX_DURATIONS = 100000
+
+    def __init__(self, cache, max_workers=None, backend='threads',
+                 top_down=False, spill_outputs=False, trace=None,
+                 hasher=None):
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown backend %r" % backend)
         self.cache = cache
+        self.max_workers = max_workers
+        self.backend = backend
+        self.top_down = top_down
+        self.spill_outputs = spill_outputs
+        self._process_pool = None
         self.component_loaders = []
 
         self.workflow = None
         self.steps = {}
         self.step_hashes = ()
+        self._constant_hashes = {}  # (type, value): hash
+        self._measured_durations = {}  # structural_hash: seconds
+        self._step_hash_memo = {}  # step_id: (definition, hash)
 
         self.temp_dir = tempfile.TemporaryDirectory(prefix='cacheflow_')
-        self.pickling = Pickling(self.temp_dir.name)
+        self.pickling = Pickling(self.temp_dir.name, trace=trace,
+                                 hasher=hasher)
 
     def add_components_from_entrypoint(self):
         for entry_point in iter_entry_points('cacheflow'):
@@ -99,12 +212,11 @@ class Executor(object):
 
     def _compute_dependency_maps(self):
         self.dependencies = {}
-        self.dependents = {}
+        self.dependents = {step_id: [] for step_id in self.workflow.steps}
 
         for step in self.workflow.steps.values():
             # Process inputs
             self.dependencies[step.id] = deps = set()
-            self.dependents[step.id] = []
             for name, inputs in step.inputs.items():
                 for input in inputs:
                     if isinstance(input, StepInputConnection):
@@ -121,171 +233,1159 @@ class Executor(object):
         self.sinks = {step_id for step_id in self.workflow.steps
                       if not self.dependents[step_id]}
 
+    def _hash_constant(self, value, constant_hashes=None):
+        """Hash a constant parameter, reusing previous hashes.
+        """
+        if constant_hashes is None:
+            constant_hashes = self._constant_hashes
+        if type(value) not in _MEMOIZED_CONSTANTS:
+            # Equality is not enough for those, for example (1, 2) == (True,
+            # 2.0) and 0.0 == -0.0, but their hashes differ
+            return hash_value(value, self.pickling)
+        key = type(value), value
+        try:
+            return constant_hashes[key]
+        except KeyError:
+            pass
+        value_hash = self._constant_hashes.get(key)
+        if value_hash is None:
+            value_hash = hash_value(value, self.pickling)
+        constant_hashes[key] = value_hash
+        return value_hash
+
     def _compute_step_hashes(self):
         step_hashes = {}
 
-        # TODO: Have this not be recursive (similarly to the execution code)
-        def compute_hash(step_id):
+        # Only keep memoized hashes for the current workflow
+        constant_hashes = {}
+        step_hash_memo = {}
+
+        # Go over the steps in topological order
+        remaining = {
+            step_id: len(deps) for step_id, deps in self.dependencies.items()
+        }
+        open_list = [
+            step_id for step_id, count in remaining.items() if count == 0
+        ]
+        while open_list:
+            step_id = open_list.pop()
             step = self.workflow.steps[step_id]
 
-            # Build a dictionary of input hashes
-            input_hashes = {}
-            for name, inputs in sorted(step.inputs.items()):
-                if not inputs:
-                    continue
-                input_hashes_list = []
-                for input in inputs:
-                    if isinstance(input, StepInputConnection):
-                        # Recursively compute that hash
-                        if input.source_step_id not in step_hashes:
-                            compute_hash(input.source_step_id)
+            # Don't even load the component if the step and its upstream
+            # hashes didn't change since last time
+            definition = _step_definition(step, step_hashes)
+            memo = self._step_hash_memo.get(step_id)
+            if (definition is not None and memo is not None and
+                    memo[0] == definition):
+                step_hash = memo[1]
+            else:
+                step_hash = self._hash_step(step, step_hashes,
+                                            constant_hashes)
+            step_hashes[step_id] = step_hash
+            step_hash_memo[step_id] = definition, step_hash
+
+            for dependent_id in {d[1] for d in self.dependents[step_id]}:
+                remaining[dependent_id] -= 1
+                if remaining[dependent_id] == 0:
+                    open_list.append(dependent_id)
+
+        if set(step_hashes) != set(self.workflow.steps):
+            raise RuntimeError("Couldn't compute all step hashes (cycle?)")
 
-                        # Use the source's hash for input connections
+        self._constant_hashes = constant_hashes
+        self._step_hash_memo = step_hash_memo
+
+        return step_hashes
+
+    def _hash_step(self, step, step_hashes, constant_hashes):
+        # Build a dictionary of input hashes
+        input_hashes = {}
+        for name, inputs in sorted(step.inputs.items()):
+            if not inputs:
+                continue
+            input_hashes_list = []
+            for input in inputs:
+                if isinstance(input, StepInputConnection):
+                    # Use the source's hash for input connections
+                    value = step_hashes[input.source_step_id]
+                    if value is not UNHASHABLE:
                         value = '&%s\n%s' % (
                             input.source_output_name,
-                            step_hashes[input.source_step_id],
+                            value,
                         )
-                    else:
-                        # Use the value itself for constant parameters
-                        value = '=\n%s', hash_value(input, self.pickling)
-                    input_hashes_list.append(value)
-                input_hashes[name] = input_hashes_list
+                else:
+                    # Use the value itself for constant parameters
+                    value = self._hash_constant(input, constant_hashes)
+                    if value is not UNHASHABLE:
+                        value = '=\n%s', value
+                input_hashes_list.append(value)
+            input_hashes[name] = tuple(input_hashes_list)
 
-            # Use Component's hashing function to build a hash
-            component_cls = self._load_component(step.component_def)
-            step_hashes[step.id] = component_cls.compute_hash(input_hashes)
+        # Use Component's hashing function to build a hash
+        component_cls = self._load_component(step.component_def)
+        return component_cls.compute_hash(input_hashes)
 
-        for step_id in self.sinks:
-            compute_hash(step_id)
+    def _make_pool(self):
+        max_workers = self.max_workers
+        if self.backend == 'processes':
+            if max_workers is None:
+                max_workers = os.cpu_count() or 1
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+            )
+        if max_workers is None or max_workers <= 1:
+            return _InlinePool(), 1
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='cacheflow',
+        )
+        return pool, max_workers
 
-        if set(step_hashes) != set(self.workflow.steps):
-            raise RuntimeError("Couldn't compute all step hashes (cycle?)")
+    def _shutdown_pool(self, pool):
+        pool.shutdown(wait=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+            self._process_pool = None
 
-        return step_hashes
+    def _execute_component(self, step, component, inputs, globals):
+        """Execute a component, returning its outputs.
+        """
+        inputs = _resolve_pairs(inputs)
+        if self._process_pool is None:
+            component.outputs = {}
+            # Components hashing their inputs again (for example to pass
+            # them on as outputs) get the hashes we already have
+            with self._remember_inputs(inputs):
+                component.execute(
+                    inputs=_input_values(inputs),
+                    temp_dir=self.temp_dir.name, globals=globals,
+                )
+            # Don't keep the outputs alive after this execution
+            outputs, component.outputs = component.outputs, {}
+            return outputs
+        else:
+            # Streams are read entirely to be sent to the worker
+            inputs = {
+                name: [
+                    v.materialize() if isinstance(v, Stream) else v
+                    for v in values
+                ]
+                for name, values in _input_values(inputs).items()
+            }
+            # Files are passed by path, the worker copies them
+            payload = self.pickling.dumps(
+                (type(component), inputs, globals, self.pickling.hasher),
+                files=SharedFiles(),
+            )
+            future = self._process_pool.submit(
+                _execute_in_process,
+                payload, self.temp_dir.name,
+            )
+            outputs, dropped = self.pickling.loads(
+                future.result(),
+                files=MovedFiles(self.temp_dir.name),
+            )
+            if dropped:
+                logger.warning("Step %r has outputs that can't be sent back "
+                               "from the worker process, dropping them: %s",
+                               step.id, ', '.join(sorted(dropped)))
+            return outputs
+
+    def _remember_inputs(self, inputs):
+        # Components can modify their inputs, only remember values that
+        # can't change
+        return self.pickling.hasher.remember(
+            pair for values in inputs.values() for pair in values
+            if _is_immutable(pair[0])
+        )
+
+    def _lookup_structural(self, step_id):
+        """Find the outputs of a step from the structural hash.
+
+        :return: The step hash under which the outputs are stored, or
+        ``None``.
+        """
+        structural_hash = self.step_hashes[step_id]
+        if structural_hash is UNHASHABLE:
+            return None
+        try:
+            step_hash = self.cache.retrieve(
+                (structural_hash, 'step'),
+                pickling=self.pickling,
+            )
+        except KeyError:
+            return None
+        if not self.cache.has_key((step_hash, 'manifest')):
+            return None
+        return step_hash
+
+    def _store_structural(self, step, step_hash):
+        """Record the step hash for the structural hash of a step.
+        """
+        structural_hash = self.step_hashes[step.id]
+        if structural_hash is not UNHASHABLE:
+            self.cache.store(
+                (structural_hash, 'step'), step_hash,
+                pickling=self.pickling,
+            )
+
+    def _retrieve_outputs(self, step, step_hash):
+        """Get outputs from the cache.
+
+        The values are only loaded from the cache when they are needed, the
+        outputs are ``(_LazyValue, hash)`` pairs.
+
+        :return: The outputs, or ``None`` if they are not in the cache.
+        """
+        try:
+            manifest = self.cache.retrieve(
+                (step_hash, 'manifest'),
+                pickling=self.pickling,
+            )
+        except KeyError:
+            # Entry from older version, without manifest
+            try:
+                outputs = self.cache.retrieve(
+                    (step_hash, 'outputs'),
+                    pickling=self.pickling,
+                )
+            except KeyError:
+                return None
+            return self._load_streams(step_hash, outputs)
+        return self._lazy_outputs(step, step_hash, manifest)
+
+    def _load_streams(self, step_hash, outputs):
+        """Replace the streams in outputs from the cache with `Stream`s.
+        """
+        return {
+            name: (self._load_stream(step_hash, name, value), hash)
+            for name, (value, hash) in outputs.items()
+        }
+
+    def _load_stream(self, step_hash, name, value):
+        """Replace an output from the cache with a `Stream` if it is one.
+        """
+        if not isinstance(value, _CachedStream):
+            return value
+
+        def get(index):
+            try:
+                return self.cache.retrieve(
+                    (step_hash, 'chunk', name, '%d' % index),
+                    pickling=self.pickling,
+                )
+            except KeyError:
+                raise RuntimeError(
+                    "Chunk %d of stream %r is no longer in the cache" % (
+                        index, name,
+                    )
+                ) from None
+
+        return Stream._replayed(value.count, get)
+
+    def _lazy_outputs(self, step, step_hash, manifest):
+        loader = _OutputsLoader(self, step.id, step_hash)
+        return {
+            name: (_LazyValue(loader, name), hash)
+            for name, hash in manifest.items()
+        }
+
+    def _lookup_step(self, step, component, inputs, step_hash=None):
+        """Compute the hash of a step and try to get its outputs from cache.
+
+        :param step_hash: The step's hash, if already known. It will be
+        computed from the inputs otherwise.
+        :return: A tuple ``(step_hash, outputs)``, where ``outputs`` is
+        ``None`` if the step needs to be executed.
+        """
+        known = step_hash is not None
+        if not known:
+            with self.pickling.span('hash inputs', step=step.id):
+                step_hash = component.compute_hash({
+                    n: [e[1] for e in v] for n, v in inputs.items()
+                })
+        if step_hash is not UNHASHABLE:
+            with self.pickling.span('cache lookup', step=step.id) as args:
+                outputs = self._retrieve_outputs(step, step_hash)
+                args['hit'] = outputs is not None
+            if outputs is not None:
+                logger.info("Got step %r from cache", step.id)
+                if self.top_down and not known:
+                    self._store_structural(step, step_hash)
+                return step_hash, outputs
+        return step_hash, None
+
+    def _store_step(self, step, step_hash, outputs, work_amount=None):
+        """Store the outputs of a step that was just executed.
+
+        :param work_amount: The time it took to compute the outputs, in
+        seconds.
+        :return: The outputs to pass on to dependent steps, which are the
+        ones passed in, unless ``spill_outputs`` is set.
+        """
+        streams = [
+            name for name, (value, _) in outputs.items()
+            if isinstance(value, Stream)
+        ]
+        if streams:
+            outputs = dict(outputs)
+            for name in streams:
+                outputs[name] = outputs[name][0], _stream_hash(step_hash, name)
+        if step_hash is UNHASHABLE:
+            return outputs
+        if streams:
+            self._record_streams(step, step_hash, outputs, streams,
+                                 work_amount)
+            return outputs
+        with self.pickling.span('cache store', step=step.id):
+            return self._store_step_outputs(
+                step, step_hash, outputs, work_amount,
+            )
+
+    def _record_streams(self, step, step_hash, outputs, streams,
+                        work_amount):
+        """Store the chunks of output streams as they are read.
+
+        The entry for the step is stored once all its streams have been read
+        entirely, with the streams replaced by `_CachedStream` markers.
+        """
+        lock = threading.Lock()
+        counts = {}
+
+        def recorder(name):
+            def on_chunk(index, chunk):
+                key = (step_hash, 'chunk', name, '%d' % index)
+                with self.pickling.span('cache store', step=step.id,
+                                        chunk=index):
+                    self.cache.store(key, chunk, pickling=self.pickling)
+                return self.cache.has_key(key)
+
+            def on_end(count):
+                with lock:
+                    counts[name] = count
+                    if len(counts) < len(streams):
+                        return
+                stored = {
+                    name: (_CachedStream(counts[name]), hash)
+                    if name in counts else (value, hash)
+                    for name, (value, hash) in outputs.items()
+                }
+                logger.info("Streams of step %r were read, storing",
+                            step.id)
+                with self.pickling.span('cache store', step=step.id):
+                    self._store_step_outputs(
+                        step, step_hash, stored, work_amount,
+                    )
+
+            def replay(index):
+                return self.cache.retrieve(
+                    (step_hash, 'chunk', name, '%d' % index),
+                    pickling=self.pickling,
+                )
+
+            return on_chunk, on_end, replay
+
+        for name in streams:
+            outputs[name][0]._record(*recorder(name))
+
+    def _store_step_outputs(self, step, step_hash, outputs, work_amount):
+        # Each output has its own entry, so they can be loaded separately.
+        # With their hashes, the cache can store the values by content
+        keys = []
+        with self.pickling.hasher.remember(outputs.values()):
+            for name, (value, _) in outputs.items():
+                key = step_hash, 'output', name
+                self.cache.store(
+                    key, value,
+                    pickling=self.pickling,
+                    work_amount=work_amount,
+                )
+                keys.append(key)
+        if len(self.cache.has_keys(keys)) != len(keys):
+            # Couldn't be stored
+            return outputs
+        # The manifest is written last, so it is only there for
+        # complete entries
+        manifest = {name: hash for name, (_, hash) in outputs.items()}
+        self.cache.store(
+            (step_hash, 'manifest'), manifest,
+            pickling=self.pickling,
+        )
+        if self.top_down:
+            self._store_structural(step, step_hash)
+        if self.spill_outputs:
+            return self._lazy_outputs(step, step_hash, manifest)
+        return outputs
+
+    def _run_step(self, step, component, inputs, globals, step_hash=None):
+        """Get the outputs of a step, from the cache or by executing it.
+
+        This is called from the worker threads when executing in parallel.
+
+        :return: The outputs, or ``None`` if the step hash was provided but
+        its outputs are no longer in the cache (the inputs are not available
+        to execute it).
+        """
+        with self.pickling.span('step %s' % step.id, step=step.id) as args:
+            args['cached'] = True
+            known = step_hash is not None
+            step_hash, outputs = self._lookup_step(
+                step, component, inputs, step_hash,
+            )
+            if outputs is not None or known:
+                return outputs
+
+            if step_hash is UNHASHABLE:
+                args['cached'] = False
+                return self._execute_step(
+                    step, component, inputs, globals, step_hash,
+                )
+            with self.cache.lock((step_hash, 'outputs')):
+                outputs = self._lookup_concurrent(step, step_hash)
+                if outputs is not None:
+                    return outputs
+                args['cached'] = False
+                return self._execute_step(
+                    step, component, inputs, globals, step_hash,
+                )
+
+    def _lookup_concurrent(self, step, step_hash):
+        """Look up a step again, after getting the lock on its hash.
+
+        If another execution was computing this step, we waited for it and
+        can now get its outputs from the cache.
+        """
+        outputs = self._retrieve_outputs(step, step_hash)
+        if outputs is not None:
+            logger.info("Got step %r from cache, computed concurrently",
+                        step.id)
+            if self.top_down:
+                self._store_structural(step, step_hash)
+        return outputs
+
+    def _execute_step(self, step, component, inputs, globals, step_hash):
+        logger.info("Executing step %r", step.id)
+        start = time.perf_counter()
+        try:
+            with self.pickling.span('execute', step=step.id):
+                outputs = self._execute_component(
+                    step, component, inputs, globals,
+                )
+        except Exception:
+            logger.exception("Got exception running component %r",
+                             component)
+            raise
+        duration = time.perf_counter() - start
+        self._record_duration(step, duration)
+        return self._store_step(step, step_hash, outputs, duration)
+
+    def _record_duration(self, step, duration):
+        structural_hash = self.step_hashes[step.id]
+        if structural_hash is not UNHASHABLE:
+            self._measured_durations[structural_hash] = duration
+
+    def _load_durations(self):
+        """Get the durations of the steps from previous executions.
+
+        :return: A dictionary mapping structural step hashes to durations in
+        seconds.
+        """
+        try:
+            return self.cache.retrieve(
+                ('durations',),
+                pickling=self.pickling,
+            )
+        except KeyError:
+            return {}
+
+    def _save_durations(self):
+        """Add the durations measured during this execution to the cache.
+        """
+        if not self._measured_durations:
+            return
+        # Reload, in case another execution wrote durations since we started
+        durations = self._load_durations()
+        for structural_hash, duration in self._measured_durations.items():
+            # Move it to the end, most recent entries are last
+            durations.pop(structural_hash, None)
+            durations[structural_hash] = duration
+        self._measured_durations = {}
+        # Drop the oldest entries
+        extra = max(0, len(durations) - self.MAX_DURATIONS)
+        for structural_hash in list(itertools.islice(durations, extra)):
+            del durations[structural_hash]
+        self.cache.store(
+            ('durations',), durations,
+            pickling=self.pickling,
+        )
+
+    def _start_execution(self, sinks, globals):
+        if self.workflow is None:
+            raise ValueError("No workflow loaded")
+
+        logger.info("Executing workflow, temp_dir=%r", self.temp_dir.name)
+
+        self._measured_durations = {}
+        return _Execution(self, sinks, globals, self._load_durations())
+
+    def _end_execution(self):
+        self._save_durations()
 
     def execute(self, sinks=None, globals=None):
         """Execute a workflow.
 
+        Steps whose dependencies are satisfied are sent to a thread pool if
+        the executor was created with ``max_workers`` greater than 1.
+
         :param sinks: An iterable of step IDs that we want executed, or
         ``None`` to indicate all the sinks need to be executed.
         :param globals: Global values which get passed to every step.
-        :return: A dictionary mapping output references to values.
+        :return: A dictionary mapping the IDs of the sinks to their outputs.
+        Other steps' outputs are not kept for the whole execution, pass
+        them as sinks to get them.
         """
-        if self.workflow is None:
-            raise ValueError("No workflow loaded")
+        execution = self._start_execution(sinks, globals)
 
-        logger.info("Executing workflow, temp_dir=%r", self.temp_dir.name)
+        pool, max_running = self._make_pool()
+        running = {}  # future: step
+        try:
+            while execution.ready or running:
+                # Start steps, up to the number of workers
+                while execution.ready and len(running) < max_running:
+                    step, component, inputs, step_hash = \
+                        execution.next_step()
+                    future = pool.submit(
+                        self._run_step,
+                        step, component, inputs, execution.globals,
+                        step_hash,
+                    )
+                    running[future] = step
+
+                # Wait for a step to finish
+                done, _ = concurrent.futures.wait(
+                    running,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    step = running.pop(future)
+                    execution.step_done(step, future.result())
+        finally:
+            # Don't start anything else if we are leaving on error
+            for future in running:
+                future.cancel()
+            self._shutdown_pool(pool)
+            self._end_execution()
+
+        return execution.finish()
+
+
+class AsyncExecutor(Executor):
+    """Executor running steps concurrently from an asyncio event loop.
+
+    Components implementing `Component.execute_async()` are awaited directly,
+    so any number of them can be waiting on I/O at the same time. Other
+    components, as well as cache lookups and stores, run in a thread pool of
+    ``max_workers`` threads.
+    """
+    def __init__(self, cache, max_workers=None, top_down=False,
+                 spill_outputs=False, trace=None, hasher=None):
+        super(AsyncExecutor, self).__init__(
+            cache, max_workers=max_workers, top_down=top_down,
+            spill_outputs=spill_outputs, trace=trace, hasher=hasher,
+        )
+
+    async def _run_step_async(self, step, component, inputs, globals,
+                              step_hash, thread_pool):
+        loop = asyncio.get_event_loop()
+
+        if not component.is_async():
+            return await loop.run_in_executor(
+                thread_pool,
+                self._run_step, step, component, inputs, globals, step_hash,
+            )
+
+        known = step_hash is not None
+        step_hash, outputs = await loop.run_in_executor(
+            thread_pool,
+            self._lookup_step, step, component, inputs, step_hash,
+        )
+        if outputs is not None or known:
+            return outputs
+
+        if step_hash is UNHASHABLE:
+            return await self._execute_step_async(
+                step, component, inputs, globals, step_hash, thread_pool,
+            )
+
+        # Waiting for the lock happens in the loop's default executor, so it
+        # doesn't hold up threads the lock's owner might need. Releasing it
+        # doesn't block, it is done from the event loop
+        lock = self.cache.lock((step_hash, 'outputs'))
+        acquiring = loop.run_in_executor(None, lock.__enter__)
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # Release it once we get it
+            acquiring.add_done_callback(
+                lambda f: f.exception() or lock.__exit__(None, None, None),
+            )
+            raise
+        try:
+            outputs = await loop.run_in_executor(
+                thread_pool,
+                self._lookup_concurrent, step, step_hash,
+            )
+            if outputs is not None:
+                return outputs
+            return await self._execute_step_async(
+                step, component, inputs, globals, step_hash, thread_pool,
+            )
+        finally:
+            lock.__exit__(None, None, None)
+
+    async def _execute_step_async(self, step, component, inputs, globals,
+                                  step_hash, thread_pool):
+        loop = asyncio.get_event_loop()
+        logger.info("Executing step %r", step.id)
+        try:
+            inputs = await loop.run_in_executor(
+                thread_pool,
+                _resolve_pairs, inputs,
+            )
+            start = time.perf_counter()
+            component.outputs = {}
+            with self.pickling.span('execute', step=step.id), \
+                    self._remember_inputs(inputs):
+                await component.execute_async(
+                    inputs=_input_values(inputs),
+                    temp_dir=self.temp_dir.name, globals=globals,
+                )
+        except Exception:
+            logger.exception("Got exception running component %r",
+                             component)
+            raise
+        duration = time.perf_counter() - start
+        self._record_duration(step, duration)
+        outputs, component.outputs = component.outputs, {}
+        return await loop.run_in_executor(
+            thread_pool,
+            self._store_step, step, step_hash, outputs, duration,
+        )
+
+    async def execute_async(self, sinks=None, globals=None):
+        """Execute a workflow, from a coroutine.
+
+        :param sinks: An iterable of step IDs that we want executed, or
+        ``None`` to indicate all the sinks need to be executed.
+        :param globals: Global values which get passed to every step.
+        :return: A dictionary mapping the IDs of the sinks to their outputs.
+        Other steps' outputs are not kept for the whole execution, pass
+        them as sinks to get them.
+        """
+        execution = self._start_execution(sinks, globals)
+
+        thread_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='cacheflow',
+        )
+        running = {}  # task: step
+        try:
+            while execution.ready or running:
+                while execution.ready:
+                    step, component, inputs, step_hash = \
+                        execution.next_step()
+                    task = asyncio.ensure_future(self._run_step_async(
+                        step, component, inputs, execution.globals,
+                        step_hash, thread_pool,
+                    ))
+                    running[task] = step
+
+                done, _ = await asyncio.wait(
+                    running,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    step = running.pop(task)
+                    execution.step_done(step, task.result())
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running)
+            thread_pool.shutdown(wait=False)
+            self._end_execution()
+
+        return execution.finish()
+
+    def execute(self, sinks=None, globals=None):
+        """Execute a workflow, running an event loop until it is done.
+        """
+        return asyncio.run(self.execute_async(sinks, globals))
+
+
+class _Execution(object):
+    """State of a workflow execution.
+
+    This keeps track of the inputs available to each step and of which steps
+    are ready to run. It is used by the executors' scheduling loops.
+
+    The outputs of a step are kept until the last step using them has
+    started, at which point they are dropped (unless they are results).
+
+    Ready steps are started in order of the longest path from them to a
+    sink, using durations measured during previous executions.
+    """
+    def __init__(self, executor, sinks, globals, durations):
+        self.executor = executor
+        workflow = executor.workflow
 
         if globals is None:
             globals = {}
+        self.globals = globals
 
-        step_inputs = {}  # step_id: (set(missing inputs), [inputs])
-        for step in self.workflow.steps.values():
-            inputs = {
-                name: [
-                    (v, hash_value(v, self.pickling))
-                    for v in values
-                    if not isinstance(v, StepInputConnection)
-                ]
-                for name, values in step.inputs.items()
-            }
-            step_inputs[step.id] = set(self.dependencies[step.id]), inputs
+        # step_id: step_hash, for steps found from their structural hash
+        self.known_hashes = {}
 
+        # Find the steps to execute, from the sinks
         if sinks:
-            to_execute = set(sinks)
-
-            # Also add transitive dependencies of the sinks
+            sinks = set(sinks)
             open_list = list(sinks)
-            while open_list:
-                process_list, open_list = open_list, []
-                for step_id in process_list:
-                    for dep_id in self.dependencies[step_id]:
-                        if dep_id not in to_execute:
-                            to_execute.add(dep_id)
-                            open_list.append(dep_id)
         else:
-            # Execute everything
-            sinks = self.workflow.steps
-            to_execute = set(self.workflow.steps)
-
-        ready = {step_id for step_id in to_execute
-                 if not self.dependencies[step_id]}
-
-        # Execute
-        results = {}
-        while ready:
-            step = self.workflow.steps[ready.pop()]
-            to_execute.discard(step.id)
-
-            # Run the step
-            component = self.steps[step.id]
-            inputs = step_inputs[step.id][1]
-            for k, v in inputs.items():
-                if len(v) > 1:
-                    raise ValueError("Multiple values for input '%s'" % k)
-            step_hash = component.compute_hash({
-                n: [e[1] for e in v] for n, v in inputs.items()
-            })
-            outputs = None
-            if step_hash != UNHASHABLE:
-                try:
-                    outputs = self.cache.retrieve(
-                        (step_hash, 'outputs'),
-                        pickling=self.pickling,
-                    )
-                except KeyError:
-                    pass
-                else:
-                    logger.info("Got step %r from cache", step.id)
-            if outputs is None:
-                logger.info("Executing step %r", step.id)
-                try:
-                    component.execute(
-                        inputs={
-                            n: [e[0] for e in v]
-                            for n, v in inputs.items()
-                        },
-                        temp_dir=self.temp_dir.name, globals=globals,
-                    )
-                except Exception:
-                    logger.exception("Got exception running component %r",
-                                     component)
-                    raise
-                outputs = component.outputs
-                if step_hash != UNHASHABLE:
-                    self.cache.store(
-                        (step_hash, 'outputs'), outputs,
-                        pickling=self.pickling,
-                    )
+            sinks = executor.sinks
+            open_list = list(sinks)
+        self.sinks = sinks
+        self.to_execute = to_execute = set()
+        while open_list:
+            step_id = open_list.pop()
+            if step_id in to_execute:
+                continue
+            to_execute.add(step_id)
+            if executor.top_down:
+                step_hash = executor._lookup_structural(step_id)
+                if step_hash is not None:
+                    # Don't need the dependencies of this step
+                    logger.info("Step %r found from structural hash",
+                                step_id)
+                    self.known_hashes[step_id] = step_hash
+                    continue
+            open_list.extend(executor.dependencies[step_id])
 
-            # Store global results
-            if step.id in sinks:
-                store = {}
-                for k, v in outputs.items():
-                    store[k] = v[0]
-                results[step.id] = store
-
-            # Pass the outputs to connected steps
-            for output, to_step_id, to_input_name in self.dependents[step.id]:
-                deps = step_inputs[to_step_id][0]
-                deps.discard(step.id)
-                if not deps:
-                    ready.add(to_step_id)
-                    logger.info("Step %r now ready", to_step_id)
-                try:
-                    value = outputs[output]
-                except KeyError:
-                    raise KeyError("Step %r did not set an output %r" % (
-                        step.id, output,
-                    )) from None
-                else:
-                    step_inputs[to_step_id][1] \
-                        .setdefault(to_input_name, []) \
-                        .append(value)
+        # step_id: {input_name: [(value, hash)]}, for constant parameters
+        self.constants = {}
+        # step_id: set(step_ids), dependencies that still have to run
+        self.missing = {}
+        for step in workflow.steps.values():
+            with executor.pickling.span('hash constants', step=step.id):
+                self.constants[step.id] = {
+                    name: [
+                        (v, executor._hash_constant(v))
+                        for v in values
+                        if not isinstance(v, StepInputConnection)
+                    ]
+                    for name, values in step.inputs.items()
+                }
+            if step.id in self.known_hashes:
+                self.missing[step.id] = set()
+            else:
+                self.missing[step.id] = set(executor.dependencies[step.id])
+
+        # step_id: set(step_ids), steps that will need the step's outputs
+        # Outputs are only kept in memory until the last of them has started
+        self.consumers = {
+            step_id: {
+                to_step_id
+                for _, to_step_id, _ in executor.dependents[step_id]
+                if to_step_id in to_execute and
+                to_step_id not in self.known_hashes
+            }
+            for step_id in workflow.steps
+        }
+        # step_id: outputs, for steps whose outputs are still needed
+        self.outputs = {}
+
+        self._compute_priorities(durations)
+        self.ready = _ReadyQueue(self.priorities)
+        for step_id in to_execute:
+            if not self.missing[step_id]:
+                self.ready.add(step_id)
+        self.started = set()
+        self.done = set()
+
+        self.results = {}
+
+    def _compute_priorities(self, durations):
+        """Compute the length of the longest path from each step to a sink.
+
+        Steps that were never executed are assumed to take the average time.
+        Steps found from their structural hash don't take any time.
+        """
+        executor = self.executor
+        if durations:
+            default = sum(durations.values()) / len(durations)
+        else:
+            default = 1.0
+
+        def duration(step_id):
+            if step_id in self.known_hashes:
+                return 0.0
+            try:
+                return durations[executor.step_hashes[step_id]]
+            except (KeyError, TypeError):
+                return default
+
+        # Go over the steps in reverse topological order
+        self.priorities = priorities = {}
+        remaining = {
+            step_id: len(self.consumers[step_id])
+            for step_id in self.to_execute
+        }
+        open_list = [
+            step_id for step_id, count in remaining.items() if count == 0
+        ]
+        while open_list:
+            step_id = open_list.pop()
+            priorities[step_id] = duration(step_id) + max(
+                (priorities[c] for c in self.consumers[step_id]),
+                default=0.0,
+            )
+            if step_id in self.known_hashes:
+                continue
+            for dep_id in executor.dependencies[step_id]:
+                remaining[dep_id] -= 1
+                if remaining[dep_id] == 0:
+                    open_list.append(dep_id)
+        self._default_duration = default
+
+    def next_step(self):
+        """Take a step that is ready to run.
+
+        :return: A tuple ``(step, component, inputs, step_hash)``, where
+        ``step_hash`` is ``None`` unless it was found from the structural
+        hash.
+        """
+        step = self.executor.workflow.steps[self.ready.pop()]
+        self.to_execute.discard(step.id)
+        self.started.add(step.id)
+
+        component = self.executor.steps[step.id]
+        step_hash = self.known_hashes.get(step.id)
+        inputs = {
+            name: list(values)
+            for name, values in self.constants[step.id].items()
+        }
+        if step_hash is None:
+            for name, values in step.inputs.items():
+                for value in values:
+                    if isinstance(value, StepInputConnection):
+                        inputs[name].append(
+                            self.outputs[value.source_step_id]
+                            [value.source_output_name]
+                        )
+            self._release_dependencies(step.id)
+        for k, v in inputs.items():
+            if len(v) > 1:
+                raise ValueError("Multiple values for input '%s'" % k)
+        return step, component, inputs, step_hash
+
+    def _release_dependencies(self, step_id):
+        """Drop the outputs that are no longer needed once a step started.
+        """
+        for dep_id in self.executor.dependencies[step_id]:
+            consumers = self.consumers[dep_id]
+            consumers.discard(step_id)
+            if not consumers and dep_id in self.outputs:
+                logger.info("Releasing outputs of step %r", dep_id)
+                del self.outputs[dep_id]
 
-        if to_execute:
+    def _add_dependencies(self, step_id):
+        """Schedule a step found from its structural hash, that is missing.
+
+        The outputs are gone from the cache, so we have to run its
+        dependencies after all, unless they were run already.
+        """
+        logger.info("Step %r no longer in cache, executing dependencies",
+                    step_id)
+        del self.known_hashes[step_id]
+        self.started.discard(step_id)
+        open_list = [step_id]
+        while open_list:
+            step_id = open_list.pop()
+            self.to_execute.add(step_id)
+            if step_id in self.known_hashes:
+                self.ready.add(step_id)
+                continue
+            missing = self.missing[step_id] = set()
+            for dep_id in self.executor.dependencies[step_id]:
+                self.consumers[dep_id].add(step_id)
+                if dep_id in self.done:
+                    if dep_id in self.outputs:
+                        continue
+                    # Outputs were released, run that step again
+                    self.done.discard(dep_id)
+                    self.started.discard(dep_id)
+                missing.add(dep_id)
+                if (dep_id not in self.to_execute and
+                        dep_id not in self.started):
+                    open_list.append(dep_id)
+            if not missing:
+                self.ready.add(step_id)
+
+    def step_done(self, step, outputs):
+        """Record the outputs of a step, making dependent steps ready.
+
+        :param outputs: The outputs of the step, or ``None`` if the step was
+        found from its structural hash but is no longer in the cache.
+        """
+        if outputs is None:
+            self._add_dependencies(step.id)
+            return
+        self.done.add(step.id)
+
+        # Store global results
+        if step.id in self.sinks:
+            store = {}
+            for k, v in outputs.items():
+                store[k] = v[0]
+            if any(isinstance(v, _LazyValue) for v in store.values()):
+                store = _LazyResults(store)
+            self.results[step.id] = store
+
+        # Check that the outputs connected to other steps exist
+        for output, to_step_id, to_input_name in \
+                self.executor.dependents[step.id]:
+            if output not in outputs:
+                raise KeyError("Step %r did not set an output %r" % (
+                    step.id, output,
+                ))
+
+        # Keep the outputs for the steps that will need them
+        if self.consumers[step.id]:
+            self.outputs[step.id] = outputs
+
+        # Make connected steps ready
+        for to_step_id in self.consumers[step.id]:
+            deps = self.missing[to_step_id]
+            deps.discard(step.id)
+            if not deps and to_step_id in self.to_execute:
+                self.ready.add(to_step_id)
+                logger.info("Step %r now ready", to_step_id)
+
+    def finish(self):
+        """Check that the execution is complete, and return the results.
+        """
+        if self.to_execute:
             logger.error("Couldn't execute any step, %d remain",
-                         len(to_execute))
+                         len(self.to_execute))
             raise RuntimeError("Can't execute remaining steps")
 
-        return results
+        return self.results
+
+
+class _ReadyQueue(object):
+    """The steps that are ready to run, highest priority first.
+    """
+    def __init__(self, priorities):
+        self._priorities = priorities
+        self._heap = []
+        self._steps = set()
+        self._counter = itertools.count()
+
+    def add(self, step_id):
+        if step_id in self._steps:
+            return
+        self._steps.add(step_id)
+        heapq.heappush(self._heap, (
+            -self._priorities.get(step_id, 0.0),
+            next(self._counter),
+            step_id,
+        ))
+
+    def pop(self):
+        _, _, step_id = heapq.heappop(self._heap)
+        self._steps.discard(step_id)
+        return step_id
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, step_id):
+        return step_id in self._steps
+
+
+class _OutputsLoader(object):
+    """Loads the outputs of a step from the cache, once each.
+    """
+    def __init__(self, executor, step_id, step_hash):
+        self.executor = executor
+        self.step_id = step_id
+        self.step_hash = step_hash
+        self.outputs = {}
+        self.lock = threading.Lock()
+        # Don't let the cache evict the outputs while they can be loaded
+        executor.cache.pin((step_hash,))
+        weakref.finalize(self, executor.cache.unpin, (step_hash,))
+
+    def load(self, name):
+        with self.lock:
+            try:
+                return self.outputs[name]
+            except KeyError:
+                pass
+            logger.info("Loading output %r of step %r from cache",
+                        name, self.step_id)
+            executor = self.executor
+            pickling = executor.pickling
+            try:
+                with pickling.span('cache load', step=self.step_id,
+                                   output=name):
+                    try:
+                        value = executor.cache.retrieve(
+                            (self.step_hash, 'output', name),
+                            pickling=pickling,
+                        )
+                    except KeyError:
+                        # Entry from older version, with all the outputs
+                        # together
+                        outputs = executor.cache.retrieve(
+                            (self.step_hash, 'outputs'),
+                            pickling=pickling,
+                        )
+                        for n, (v, _) in executor._load_streams(
+                            self.step_hash, outputs,
+                        ).items():
+                            self.outputs.setdefault(n, v)
+                        return self.outputs[name]
+            except KeyError:
+                raise RuntimeError(
+                    "Output %r of step %r is no longer in the cache" % (
+                        name, self.step_id,
+                    )
+                ) from None
+            value = self.outputs[name] = executor._load_stream(
+                self.step_hash, name, value,
+            )
+            return value
+
+
+class _LazyValue(object):
+    """An output value from the cache, which is loaded when needed.
+    """
+    __slots__ = ('loader', 'name')
+
+    def __init__(self, loader, name):
+        self.loader = loader
+        self.name = name
+
+    def get(self):
+        return self.loader.load(self.name)
+
+
+def _resolve(value):
+    if isinstance(value, _LazyValue):
+        return value.get()
+    return value
+
+
+def _resolve_pairs(inputs):
+    """Load the lazy values in the inputs of a step.
+    """
+    return {n: [(_resolve(e[0]), e[1]) for e in v] for n, v in inputs.items()}
+
+
+def _input_values(inputs):
+    """Turn the inputs of a step into the values passed to the component.
+    """
+    return {n: [e[0] for e in v] for n, v in inputs.items()}
+
+
+class _LazyResults(collections.abc.Mapping):
+    """Outputs of a sink, loading values from the cache when accessed.
+    """
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, name):
+        return _resolve(self._values[name])
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return '<_LazyResults %r>' % sorted(self._values)
+
+
+def _execute_in_process(payload, temp_dir):
+    """Execute a component in a worker process.
+
+    The component class, inputs and outputs go through `Pickling`, so
+    `TemporaryFile` objects get re-created on each side. Input files are
+    copied in, output files are moved out to `temp_dir` where the executor
+    takes them, the rest is deleted with the worker's directory.
+
+    Outputs that can't be pickled (open files, locks...) can't be sent back,
+    they are dropped and their names returned along with the others.
+    """
+    with tempfile.TemporaryDirectory(prefix='worker_', dir=temp_dir) as tmp:
+        pickling = Pickling(tmp)
+        component_cls, inputs, globals, pickling.hasher = \
+            pickling.loads(payload, files=SharedFiles())
+        component = component_cls(pickling=pickling)
+        component.execute(inputs=inputs, temp_dir=tmp, globals=globals)
+        outputs = {}
+        dropped = []
+        for name, (value, hash) in component.outputs.items():
+            if isinstance(value, Stream):
+                value = value.materialize()
+            elif hash is UNHASHABLE:
+                # Hashing failed, probably because it can't be pickled
+                try:
+                    _pickled_size(value, pickling)
+                except (TypeError, pickle.PicklingError):
+                    dropped.append(name)
+                    continue
+            outputs[name] = value, hash
+        return pickling.dumps((outputs, dropped), files=MovedFiles(temp_dir))
+
+
+class _CachedStream(object):
+    """Stands for a `Stream` in the outputs stored in the cache.
+
+    The chunks are stored under their own keys.
+    """
+    def __init__(self, count):
+        self.count = count
+
+
+def _stream_hash(step_hash, name):
+    """The hash of an output stream, derived from the step hash.
+
+    Streams can't be hashed from their content before they are read, but
+    they are determined by the step that produces them.
+    """
+    if step_hash is UNHASHABLE:
+        return UNHASHABLE
+    return sha256(('%s\nstream\n%s' % (step_hash, name)).encode()) \
+        .hexdigest()
+
+
+class _InlinePool(object):
+    """Replacement for a `concurrent.futures.Executor` that runs inline.
+
+    This is used for serial execution, so that the same scheduling code can be
+    used.
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
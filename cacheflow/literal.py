@@ -102,7 +102,8 @@ def load_noteflow(fileobj):
 def render(noteflow, executor, out):
     logger.info("Executing...")
     executor.load_workflow(noteflow.workflow)
-    results = executor.execute()
+    # Sections can show the outputs of any step
+    results = executor.execute(noteflow.workflow.steps)
 
     md = markdown.Markdown()
 
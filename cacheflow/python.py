@@ -1,9 +1,13 @@
 import ast
 import builtins
+import contextlib
 import logging
 import sys
+import threading
+import types
 
 from .base import Component, SimpleComponentLoader
+from .stream import Stream
 
 
 logger = logging.getLogger(__name__)
@@ -249,6 +253,65 @@ class OutputStreams(object):
         return self._Writer(self, stream)
 
 
+class _StreamDispatcher(object):
+    """Stand-in for `sys.stdout` or `sys.stderr` writing to per-thread targets.
+
+    This allows multiple steps to capture their output when running in
+    parallel threads.
+    """
+    def __init__(self, name, original):
+        self._name = name
+        self._original = original
+
+    def _target(self):
+        target = getattr(_redirections, self._name, None)
+        if target is None:
+            return self._original
+        return target
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._target(), attr)
+
+
+_redirections = threading.local()
+_redirections_lock = threading.Lock()
+_redirections_count = 0
+
+
+@contextlib.contextmanager
+def _redirect_streams(stdout, stderr):
+    """Redirect `sys.stdout` and `sys.stderr` for the current thread only.
+    """
+    global _redirections_count
+
+    with _redirections_lock:
+        if _redirections_count == 0:
+            sys.stdout = _StreamDispatcher('stdout', sys.stdout)
+            sys.stderr = _StreamDispatcher('stderr', sys.stderr)
+        _redirections_count += 1
+    old = (
+        getattr(_redirections, 'stdout', None),
+        getattr(_redirections, 'stderr', None),
+    )
+    _redirections.stdout = stdout
+    _redirections.stderr = stderr
+    try:
+        yield
+    finally:
+        _redirections.stdout, _redirections.stderr = old
+        with _redirections_lock:
+            _redirections_count -= 1
+            if _redirections_count == 0:
+                sys.stdout = sys.stdout._original
+                sys.stderr = sys.stderr._original
+
+
 # TODO: Figure out caching
 # TODO: Figure out isolation
 # TODO: Figure out calling different Python versions
@@ -266,20 +329,25 @@ class BuiltinPython(Component):
         for k, v in inputs.items():
             local[k] = v[-1]
         local['__builtins__'] = builtins
-        old_stdout = sys.stdout
-        old_stderr = sys.stderr
-        try:
-            streams = OutputStreams()
-            sys.stdout = streams.writer('stdout')
-            sys.stderr = streams.writer('stderr')
-
+        streams = OutputStreams()
+        with _redirect_streams(streams.writer('stdout'),
+                               streams.writer('stderr')):
             exec(compile(code, 'code', 'exec'), local, local)
-        finally:
-            sys.stdout = old_stdout
-            sys.stderr = old_stderr
 
-        for name, value in local.items():
-            self.set_output(name, value)
+        hashes = []
+        for name, value in list(local.items()):
+            if isinstance(value, types.GeneratorType):
+                # Generators become streams, read as the next steps need them
+                self.set_output_stream(name, value)
+                del local[name]
+            elif isinstance(value, Stream):
+                # Input streams are not passed through, they were read
+                del local[name]
+            else:
+                self.set_output(name, value)
+                hashes.append((value, self.outputs[name][1]))
         local.pop('__builtins__', None)
-        self.set_output('env', local)
+        # Don't hash the variables again as part of the environment
+        with self.pickling.hasher.remember(hashes):
+            self.set_output('env', local)
         self.set_output('streams', streams.get())
@@ -0,0 +1,123 @@
+import threading
+
+
+class Stream(object):
+    """A value made of a sequence of chunks, produced as they are read.
+
+    Components output streams using `Component.set_output_stream()`, from an
+    iterable of chunks such as a generator. Downstream components get the
+    `Stream` as an input and iterate on it, which pulls the chunks through
+    the upstream generator one at a time, so the whole value never has to be
+    in memory.
+
+    The executor records the chunks in the cache as they are produced, after
+    which the stream can be read again (from the cache). A stream that can't
+    be cached can only be read once, unless it was created from a list.
+    """
+    def __init__(self, chunks):
+        if isinstance(chunks, list):
+            self._list = chunks
+            self._replay = chunks.__getitem__
+        else:
+            self._list = None
+            self._replay = None
+        self._source = iter(chunks)
+        self._lock = threading.Lock()
+        self._produced = 0
+        self._done = False
+        self._error = None
+        self._on_chunk = None
+        self._on_end = None
+
+    @classmethod
+    def _replayed(cls, count, replay):
+        """Create a stream whose chunks can all be obtained from `replay`.
+        """
+        stream = cls(())
+        stream._produced = count
+        stream._done = True
+        stream._replay = replay
+        return stream
+
+    def _record(self, on_chunk, on_end, replay):
+        """Get notified of the chunks as they are produced.
+
+        :param on_chunk: Called with ``(index, chunk)`` for each chunk. If it
+        returns False, the chunks stop being recorded.
+        :param on_end: Called with the number of chunks when the stream has
+        been entirely produced and all chunks were recorded.
+        :param replay: Function getting a recorded chunk back, from its index.
+        """
+        with self._lock:
+            if self._produced != 0 or self._done:
+                raise RuntimeError("Stream was already read")
+            self._on_chunk = on_chunk
+            self._on_end = on_end
+            if self._replay is None:
+                self._replay = replay
+
+    def _stop_recording(self):
+        self._on_chunk = self._on_end = None
+        if self._list is None:
+            self._replay = None
+
+    def _get(self, index):
+        """Get the chunk at `index`, producing it if it's the next one.
+
+        :return: A pair ``(found, chunk)``, `found` is False at the end of
+        the stream.
+        """
+        with self._lock:
+            if self._error is not None:
+                raise RuntimeError("Stream failed") from self._error
+            if index == self._produced:
+                if self._done:
+                    return False, None
+                try:
+                    chunk = next(self._source)
+                except StopIteration:
+                    self._done = True
+                    if self._on_end is not None:
+                        self._on_end(self._produced)
+                    self._on_chunk = self._on_end = None
+                    return False, None
+                except Exception as e:
+                    self._error = e
+                    self._stop_recording()
+                    raise
+                if self._on_chunk is not None:
+                    if not self._on_chunk(index, chunk):
+                        self._stop_recording()
+                self._produced += 1
+                return True, chunk
+            replay = self._replay
+        if replay is None:
+            raise RuntimeError("Stream was already read, and its chunks "
+                               "were not kept")
+        return True, replay(index)
+
+    def __iter__(self):
+        index = 0
+        while True:
+            found, chunk = self._get(index)
+            if not found:
+                return
+            yield chunk
+            index += 1
+
+    def __reduce__(self):
+        if self._list is None:
+            raise TypeError("Can't pickle a Stream, use materialize()")
+        return type(self), (self._list,)
+
+    def materialize(self):
+        """Read the whole stream, returning a `Stream` that can be pickled.
+        """
+        if self._list is not None:
+            return self
+        return Stream(list(self))
+
+    def __repr__(self):
+        return '<Stream %d chunks%s>' % (
+            self._produced, '' if self._done else '+',
+        )
@@ -0,0 +1,195 @@
+import itertools
+
+from .base import Step, StepInputConnection, Workflow
+
+
+class Sweep(object):
+    """A workflow executed with many values for some of its parameters.
+
+    This builds a single workflow containing all the variants, in which the
+    steps that don't depend on the swept parameters appear only once, so
+    they run once and their results are shared. Steps downstream of swept
+    parameters are copied once per combination of the parameters they
+    actually depend on.
+
+    :param workflow: The `Workflow` to run.
+    :param parameters: A list of ``(step_id, input_name, values)`` triples,
+    every combination of values is run.
+    """
+    def __init__(self, workflow, parameters):
+        self.original = workflow
+        self.parameters = []
+        self.values = []
+        for step_id, name, values in parameters:
+            if step_id not in workflow.steps:
+                raise ValueError("Unknown step %r" % step_id)
+            if (step_id, name) in self.parameters:
+                raise ValueError("Parameter %s.%s is swept twice" % (
+                    step_id, name,
+                ))
+            values = list(values)
+            if not values:
+                raise ValueError("No values for parameter %s.%s" % (
+                    step_id, name,
+                ))
+            self.parameters.append((step_id, name))
+            self.values.append(values)
+
+        # Combinations, as tuples of indices into self.values
+        self._combinations = list(itertools.product(
+            *(range(len(values)) for values in self.values)
+        ))
+        # For each combination, maps original step IDs to new ones
+        self._step_ids = [{} for _ in self._combinations]
+        self.workflow = self._build()
+
+    @property
+    def combinations(self):
+        """The combinations of parameter values, in order.
+        """
+        return [
+            tuple(self.values[i][j] for i, j in enumerate(combination))
+            for combination in self._combinations
+        ]
+
+    def _build(self):
+        """Build the combined workflow.
+        """
+        steps = {}
+        # step_id: indices of the parameters the step depends on
+        swept = {}
+        for step_id in _topological_order(self.original):
+            step = self.original.steps[step_id]
+            indices = {
+                i for i, (p_step, _) in enumerate(self.parameters)
+                if p_step == step_id
+            }
+            for values in step.inputs.values():
+                for value in values:
+                    if isinstance(value, StepInputConnection):
+                        indices.update(swept[value.source_step_id])
+            indices = swept[step_id] = tuple(sorted(indices))
+
+            if not indices:
+                steps[step_id] = step
+                for step_ids in self._step_ids:
+                    step_ids[step_id] = step_id
+                continue
+
+            # step_id: new step, for each projection of the combinations on
+            # the parameters this step depends on
+            variants = {}
+            for combination, step_ids in zip(self._combinations,
+                                             self._step_ids):
+                projection = tuple(combination[i] for i in indices)
+                if projection not in variants:
+                    new_id = '%s#%s' % (
+                        step_id,
+                        '.'.join('%d' % j for j in projection),
+                    )
+                    variants[projection] = new_id
+                    steps[new_id] = self._make_variant(
+                        step, new_id, combination, step_ids,
+                    )
+                step_ids[step_id] = variants[projection]
+
+        return Workflow(steps, self.original.meta)
+
+    def _make_variant(self, step, new_id, combination, step_ids):
+        inputs = {}
+        for name, values in step.inputs.items():
+            inputs[name] = [
+                StepInputConnection(
+                    step_ids[value.source_step_id],
+                    value.source_output_name,
+                )
+                if isinstance(value, StepInputConnection) else value
+                for value in values
+            ]
+        for i, (p_step, p_name) in enumerate(self.parameters):
+            if p_step == step.id:
+                inputs[p_name] = [self.values[i][combination[i]]]
+        return Step(new_id, step.component_def, inputs,
+                    position=step.position)
+
+    def step_ids(self, step_id):
+        """Get the IDs of the steps standing for `step_id` in each variant.
+        """
+        return [step_ids[step_id] for step_ids in self._step_ids]
+
+    def table(self, results, sinks=None):
+        """Arrange the results of the combined workflow by parameter values.
+
+        :param results: The results of executing `workflow`.
+        :param sinks: The steps to include, from the original workflow. By
+        default, the steps that no other step depends on.
+        :return: A dictionary mapping each combination of parameter values
+        (a tuple, in the order of `parameters`) to a dictionary of results
+        ``{step_id: outputs}``.
+        """
+        if sinks is None:
+            sinks = _sinks(self.original)
+        return {
+            combination: {
+                step_id: results[step_ids[step_id]]
+                for step_id in sinks
+            }
+            for combination, step_ids in zip(self.combinations,
+                                             self._step_ids)
+        }
+
+    def execute(self, executor, sinks=None):
+        """Execute all the variants using an `Executor`.
+
+        :param sinks: The steps to execute, from the original workflow. By
+        default, the steps that no other step depends on.
+        :return: The results, as a table (see `table()`).
+        """
+        if sinks is None:
+            sinks = _sinks(self.original)
+        executor.load_workflow(self.workflow)
+        results = executor.execute(
+            {step_id for s in sinks for step_id in self.step_ids(s)},
+        )
+        return self.table(results, sinks)
+
+
+def _sinks(workflow):
+    sinks = set(workflow.steps)
+    for step in workflow.steps.values():
+        for values in step.inputs.values():
+            for value in values:
+                if isinstance(value, StepInputConnection):
+                    sinks.discard(value.source_step_id)
+    return sinks
+
+
+def _topological_order(workflow):
+    """Order the steps of a workflow so they come after their dependencies.
+    """
+    dependents = {step_id: [] for step_id in workflow.steps}
+    missing = {}
+    for step in workflow.steps.values():
+        sources = {
+            value.source_step_id
+            for values in step.inputs.values()
+            for value in values
+            if isinstance(value, StepInputConnection)
+        }
+        for source in sources:
+            if source not in workflow.steps:
+                raise ValueError("Step %r depends on unknown step %r" % (
+                    step.id, source,
+                ))
+            dependents[source].append(step.id)
+        missing[step.id] = len(sources)
+
+    order = [step_id for step_id, count in missing.items() if count == 0]
+    for step_id in order:
+        for dependent in dependents[step_id]:
+            missing[dependent] -= 1
+            if missing[dependent] == 0:
+                order.append(dependent)
+    if len(order) != len(workflow.steps):
+        raise ValueError("Workflow has a cycle")
+    return order
@@ -0,0 +1,74 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Trace(object):
+    """Records what an execution spends its time on.
+
+    The events can be written in the Chrome trace event format, which can be
+    opened in ``chrome://tracing`` or https://ui.perfetto.dev/.
+    """
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._threads = set()
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _now():
+        return time.perf_counter() * 1e6
+
+    @contextlib.contextmanager
+    def span(self, name, category='cacheflow', **args):
+        """Record the time spent in a block.
+
+        This yields a dictionary of arguments, which can be updated from the
+        block, for example to add the number of bytes that were processed.
+        """
+        start = self._now()
+        try:
+            yield args
+        finally:
+            end = self._now()
+            thread = threading.current_thread()
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': start,
+                'dur': end - start,
+                'pid': self._pid,
+                'tid': thread.ident,
+                'args': args,
+            }
+            with self._lock:
+                if thread.ident not in self._threads:
+                    self._threads.add(thread.ident)
+                    self.events.append({
+                        'name': 'thread_name',
+                        'ph': 'M',
+                        'pid': self._pid,
+                        'tid': thread.ident,
+                        'args': {'name': thread.name},
+                    })
+                self.events.append(event)
+
+    def write(self, fp):
+        """Write the trace as JSON to a file object.
+        """
+        with self._lock:
+            json.dump(
+                {'traceEvents': self.events, 'displayTimeUnit': 'ms'},
+                fp,
+                default=repr,
+            )
+
+
+@contextlib.contextmanager
+def null_span(*args, **kwargs):
+    """Stand-in for `Trace.span()`, when not tracing.
+    """
+    yield {}
@@ -1,5 +1,6 @@
 import json
 import logging
+from tornado.ioloop import IOLoop
 from tornado.websocket import WebSocketHandler
 
 from ..storage.controller import WorkflowChangeObserver
@@ -10,6 +11,8 @@ logger = logging.getLogger(__name__)
 
 
 class WorkflowWS(WebSocketHandler, WorkflowChangeObserver):
+    executing = False
+
     def open(self):
         self.application.controller.add_change_observer(self)
         logger.info("WebSocket connected")
@@ -51,9 +54,44 @@ class WorkflowWS(WebSocketHandler, WorkflowChangeObserver):
             )
             for action in actions_array:
                 self.application.controller.apply_action(action)
+        elif type_ == 'execute':
+            IOLoop.current().spawn_callback(self.execute_workflow)
         else:
             logger.error("Got invalid message %r", type_)
 
+    async def execute_workflow(self):
+        # The executor is shared, only run one execution at a time
+        if WorkflowWS.executing:
+            self.write_message({
+                'type': 'execution_error',
+                'error': "Already executing",
+            })
+            return
+        WorkflowWS.executing = True
+        try:
+            controller = self.application.controller
+            workflow = controller.current_workflow
+            controller.executor.load_workflow(workflow)
+            # The output streams of every step are shown
+            results = await controller.executor.execute_async(workflow.steps)
+        except Exception as e:
+            logger.exception("Error executing workflow")
+            self.write_message({
+                'type': 'execution_error',
+                'error': str(e),
+            })
+        else:
+            self.write_message({
+                'type': 'execution_done',
+                'streams': {
+                    step_id: outputs['streams']
+                    for step_id, outputs in results.items()
+                    if 'streams' in outputs
+                },
+            })
+        finally:
+            WorkflowWS.executing = False
+
     def on_close(self):
         self.application.controller.remove_change_observer(self)
         logger.info("WebSocket disconnected")
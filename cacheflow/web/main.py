@@ -10,7 +10,7 @@ import webbrowser
 from .. import __version__
 from ..base import Step, StepInputConnection, Workflow
 from ..cache import NullCache
-from ..executor import Executor
+from ..executor import AsyncExecutor
 from ..storage.controller import WorkflowController
 from .base import BaseHandler
 from . import api
@@ -23,7 +23,7 @@ class Application(tornado.web.Application):
     def __init__(self, handlers, **kwargs):
         super(Application, self).__init__(handlers, **kwargs)
 
-        executor = Executor(NullCache())
+        executor = AsyncExecutor(NullCache())
         executor.add_components_from_entrypoint()
 
         workflow = Workflow(
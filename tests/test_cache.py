@@ -0,0 +1,828 @@
+import concurrent.futures
+import mmap
+import os
+import pickle
+import tempfile
+import threading
+import unittest
+
+from cacheflow.cache import DirectoryCache, Hasher, MemoryCache, Pickling, \
+    SmartCache, SqliteCache, TemporaryFile, TieredCache, hash_value, \
+    register_hasher
+from cacheflow.cache.core import UNHASHABLE, _hashers, _lazy_hashers
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import requests
+    import tornado.ioloop
+except ImportError:
+    requests = None
+else:
+    import asyncio
+    import tornado.httpserver
+    import tornado.netutil
+    from cacheflow.cache import server
+    from cacheflow.cache.remote import RemoteCache
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class Opaque(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class Buffer(object):
+    """Holds memory that is pickled out-of-band with protocol 5."""
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return Buffer, (pickle.PickleBuffer(self.data),)
+        return Buffer, (bytes(self.data),)
+
+
+class TestHashing(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.pickling = Pickling(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def hash(self, value):
+        return hash_value(value, self.pickling)
+
+    def test_fast_paths(self):
+        """Test that values of different types hash differently."""
+        values = [
+            '1', b'1', bytearray(b'1'), 1, 1.0, True, 1j, None,
+            ('1',), ['1'], ('1', '2'), ('12',), {'1': '2'}, {'12': ''},
+            [('1', 2)], memoryview(b'1'), {1}, ('1', 2.5, [None, b'x']),
+        ]
+        hashes = [self.hash(v) for v in values]
+        self.assertEqual(len(set(hashes)), len(values))
+        for value, h in zip(values, hashes):
+            self.assertEqual(len(h), 64)
+            self.assertEqual(self.hash(value), h)
+
+        self.assertEqual(self.hash(('a', {'b': [1, 2.5]})),
+                         self.hash(('a', {'b': [1, 2.5]})))
+        self.assertEqual(self.hash(memoryview(b'abcd')[::2]),
+                         self.hash(memoryview(b'ac')))
+
+    def test_fallback(self):
+        """Test hashing values that have to be pickled."""
+        self.assertEqual(self.hash(Opaque(1)), self.hash(Opaque(1)))
+        self.assertNotEqual(self.hash(Opaque(1)), self.hash(Opaque(2)))
+        self.assertIs(self.hash(threading.Lock()), UNHASHABLE)
+        self.assertIs(self.hash([1, threading.Lock()]), UNHASHABLE)
+
+        # Structures referencing themselves can't use the fast paths
+        loop = [1]
+        loop.append(loop)
+        self.assertEqual(len(self.hash(loop)), 64)
+
+    def test_temporary_file(self):
+        """Test hashing files from their content."""
+        def make(contents, suffix='.txt'):
+            temp_file = TemporaryFile(self.temp_dir.name, suffix=suffix)
+            with open(temp_file.name, 'wb') as fp:
+                fp.write(contents)
+            return temp_file
+
+        big = b'0123456789' * 300000
+        self.assertEqual(self.hash(make(big)), self.hash(make(big)))
+        self.assertNotEqual(self.hash(make(big)), self.hash(make(big + b'.')))
+        self.assertNotEqual(self.hash(make(b'a')),
+                            self.hash(make(b'a', '.csv')))
+        self.assertEqual(self.hash({make(b'a')}), self.hash({make(b'a')}))
+        self.assertNotEqual(self.hash({make(b'a')}), self.hash({make(b'b')}))
+
+    def test_algorithm(self):
+        """Test using a different digest algorithm."""
+        sha256 = Pickling(self.temp_dir.name, hasher=Hasher('sha256'))
+        blake2b = Pickling(self.temp_dir.name, hasher=Hasher('blake2b'))
+        sha512 = Pickling(self.temp_dir.name, hasher=Hasher('sha512'))
+        self.assertEqual(hash_value('a', sha256), self.hash('a'))
+        self.assertNotEqual(hash_value('a', blake2b), self.hash('a'))
+        self.assertEqual(len(hash_value('a', sha256)), 64)
+        self.assertEqual(len(hash_value('a', sha512)), 128)
+
+    def test_register(self):
+        """Test registering hashers for other types."""
+        plain = self.hash(Point(1, 2))
+        register_hasher(Point, lambda p: (p.x, p.y))
+        self.addCleanup(_hashers.pop, Point, None)
+        self.assertNotEqual(self.hash(Point(1, 2)), plain)
+        self.assertEqual(self.hash(Point(1, 2)), self.hash(Point(1, 2)))
+        self.assertNotEqual(self.hash(Point(1, 2)), self.hash((1, 2)))
+        self.assertNotEqual(self.hash(Point(1, 2)), self.hash(Point(2, 1)))
+
+        # By name, and falling back to pickling
+        calls = []
+
+        def hash_opaque(value):
+            calls.append(value)
+            return NotImplemented
+
+        self.hash(Opaque(1))
+        register_hasher('%s.Opaque' % __name__, hash_opaque)
+        self.addCleanup(_hashers.pop, Opaque, None)
+        self.addCleanup(_lazy_hashers.pop, '%s.Opaque' % __name__, None)
+        self.assertEqual(self.hash(Opaque(1)), self.hash(Opaque(1)))
+        self.assertEqual(len(calls), 2)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_numpy(self):
+        """Test hashing NumPy arrays from their memory."""
+        array = numpy.arange(12, dtype=numpy.float64).reshape(3, 4)
+        self.assertEqual(self.hash(array), self.hash(array.copy()))
+        self.assertEqual(self.hash(array.T), self.hash(array.T.copy()))
+        self.assertNotEqual(self.hash(array), self.hash(array.T))
+        self.assertNotEqual(self.hash(array),
+                            self.hash(array.astype(numpy.float32)))
+        self.assertNotEqual(self.hash(array), self.hash(array.reshape(4, 3)))
+        objects = numpy.array([Opaque(1)], dtype=object)
+        self.assertEqual(len(self.hash(objects)), 64)
+
+
+class TestDirectoryCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = DirectoryCache(os.path.join(self.temp_dir.name, 'cache'))
+        self.pickling = Pickling(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def blobs(self):
+        return [
+            name
+            for _, _, files in os.walk(os.path.join(self.cache.directory,
+                                                    'blobs.d'))
+            for name in files
+        ]
+
+    def test_files(self):
+        """Test storing files once, outside of the entries."""
+        temp_file = TemporaryFile(self.temp_dir.name, suffix='.bin')
+        contents = os.urandom(100000)
+        with open(temp_file.name, 'wb') as fp:
+            fp.write(contents)
+        self.cache.store(('one',), {'file': temp_file}, self.pickling)
+        self.cache.store(('two',), [temp_file], self.pickling)
+
+        self.assertEqual(self.blobs(), [hash_value(temp_file, self.pickling)])
+        self.assertLess(
+            os.path.getsize(self.cache._path(('one',))),
+            1000,
+        )
+
+        loaded = self.cache.retrieve(('one',), self.pickling)['file']
+        self.assertNotEqual(loaded.name, temp_file.name)
+        self.assertTrue(loaded.name.endswith('.bin'))
+        with open(loaded.name, 'rb') as fp:
+            self.assertEqual(fp.read(), contents)
+
+        # Missing blob
+        name, = self.blobs()
+        os.remove(os.path.join(self.cache.directory, 'blobs.d',
+                               name[:2], name))
+        with self.assertRaises(KeyError):
+            self.cache.retrieve(('two',), self.pickling)
+
+    def test_values(self):
+        """Test storing big values with a known hash once."""
+        big = [Opaque(i) for i in range(20000)]
+        small = Opaque(1)
+        outputs = {
+            'big': (big, hash_value(big, self.pickling)),
+            'small': (small, hash_value(small, self.pickling)),
+            'int': (1, hash_value(1, self.pickling)),
+        }
+        with self.pickling.hasher.remember(outputs.values()):
+            self.cache.store(('one',), outputs, self.pickling)
+            self.cache.store(('two',), [big, big, small], self.pickling)
+        # Not remembered, stored in the entry
+        self.cache.store(('three',), big, self.pickling)
+
+        self.assertEqual(self.blobs(), [outputs['big'][1]])
+        size = os.path.getsize(self.cache._path(('three',)))
+        for key in ['one', 'two']:
+            self.assertLess(
+                os.path.getsize(self.cache._path((key,))),
+                size // 10,
+            )
+
+        loaded = self.cache.retrieve(('one',), self.pickling)
+        self.assertEqual([o.value for o in loaded['big'][0]],
+                         list(range(20000)))
+        self.assertEqual(loaded['small'][0].value, 1)
+        self.assertEqual(loaded['int'], outputs['int'])
+        loaded = self.cache.retrieve(('two',), self.pickling)
+        self.assertIs(loaded[0], loaded[1])
+        self.assertEqual(loaded[2].value, 1)
+
+        # Blobs are removed with the last entry referencing them
+        self.cache.remove(('one',))
+        self.assertEqual(self.blobs(), [outputs['big'][1]])
+        self.cache.remove(('two',))
+        self.assertEqual(self.blobs(), [])
+
+    def test_eviction(self):
+        """Test evicting the least recently used entries."""
+        directory = os.path.join(self.temp_dir.name, 'bounded')
+        cache = DirectoryCache(directory, max_size=50000)
+        value = os.urandom(15000)
+        for i in range(3):
+            cache.store(('step%d' % i, 'outputs'), value + b'%d' % i,
+                        self.pickling)
+            cache.store(('step%d' % i, 'manifest'), {}, self.pickling)
+        cache.retrieve(('step0', 'outputs'), self.pickling)
+        self.assertLess(cache.index.total_size(), 50000)
+
+        # Another process, with its own connection
+        other = DirectoryCache(directory, max_size=50000)
+        other.store(('step3', 'outputs'), value, self.pickling)
+        self.assertTrue(cache.has_key(('step0', 'outputs')))
+        # The whole step was evicted
+        self.assertFalse(cache.has_key(('step1', 'outputs')))
+        self.assertFalse(cache.has_key(('step1', 'manifest')))
+        self.assertTrue(cache.has_key(('step2', 'outputs')))
+        self.assertLessEqual(cache.index.total_size(), 50000)
+
+        # Blobs go away when no entry references them anymore
+        temp_file = TemporaryFile(self.temp_dir.name)
+        with open(temp_file.name, 'wb') as fp:
+            fp.write(os.urandom(40000))
+        blobs = os.path.join(directory, 'blobs.d')
+
+        def list_blobs():
+            return [name for _, _, files in os.walk(blobs) for name in files]
+
+        cache.store(('step4', 'outputs'), temp_file, self.pickling)
+        cache.store(('step5', 'outputs'), [temp_file], self.pickling)
+        self.assertEqual(len(list_blobs()), 1)
+        self.assertFalse(cache.has_key(('step0', 'outputs')))
+        cache.store(('step6', 'outputs'), value, self.pickling)
+        self.assertFalse(cache.has_key(('step4', 'outputs')))
+        self.assertFalse(cache.has_key(('step5', 'outputs')))
+        self.assertEqual(list_blobs(), [])
+        self.assertLessEqual(cache.index.total_size(), 50000)
+
+        # Pinned steps are kept, even when over budget
+        other.pin(('step6', 'outputs'))
+        cache.store(('step7', 'outputs'), value, self.pickling)
+        cache.store(('step8', 'outputs'), value, self.pickling)
+        cache.store(('step9', 'outputs'), value, self.pickling)
+        self.assertTrue(cache.has_key(('step6', 'outputs')))
+        other.unpin(('step6', 'outputs'))
+        cache.store(('step10', 'outputs'), value, self.pickling)
+        self.assertFalse(cache.has_key(('step6', 'outputs')))
+
+    def test_eviction_processes(self):
+        """Test updating the index from multiple processes at once."""
+        directory = os.path.join(self.temp_dir.name, 'bounded')
+        DirectoryCache(directory, max_size=100000)
+        with concurrent.futures.ProcessPoolExecutor(4) as pool:
+            list(pool.map(
+                store_entries,
+                [(directory, self.temp_dir.name, i) for i in range(4)],
+            ))
+        cache = DirectoryCache(directory, max_size=100000)
+        self.assertLessEqual(cache.index.total_size(), 100000)
+        entries = [
+            os.path.join(path, name)
+            for path, dirs, files in os.walk(directory)
+            if path != os.path.join(directory, 'blobs.d')
+            for name in files
+            if '.' not in name
+        ]
+        self.assertEqual(
+            sum(os.path.getsize(path) for path in entries),
+            cache.index.total_size(),
+        )
+
+    @unittest.skipIf(pickle.HIGHEST_PROTOCOL < 5, "No pickle protocol 5")
+    def test_buffers(self):
+        """Test writing big buffers separately, and mapping them back."""
+        data = bytearray(os.urandom(200000))
+        value = [Buffer(data), Buffer(bytearray(b'small'))]
+        outputs = {'value': (value, hash_value(value, self.pickling))}
+        cache = DirectoryCache(self.cache.directory, compression='zlib',
+                               max_size=10000000)
+        with self.pickling.hasher.remember(outputs.values()):
+            cache.store(('step',), outputs, self.pickling)
+        name = outputs['value'][1]
+        self.assertEqual(sorted(self.blobs()), [name, name + '.0'])
+        blob = os.path.join(self.cache.directory, 'blobs.d', name[:2], name)
+        self.assertLess(os.path.getsize(blob), 1000)
+        with open(blob + '.0', 'rb') as fp:
+            self.assertEqual(fp.read(), data)
+
+        loaded = cache.retrieve(('step',), self.pickling)['value'][0]
+        self.assertEqual(bytes(loaded[0].data), data)
+        self.assertIsInstance(loaded[0].data, mmap.mmap)
+        self.assertTrue(memoryview(loaded[0].data).readonly)
+        self.assertEqual(bytes(loaded[1].data), b'small')
+
+        # Not stored separately if the hash is unknown
+        cache.store(('other',), value, self.pickling)
+        self.assertGreater(
+            os.path.getsize(self.cache._path(('other',))),
+            200000,
+        )
+        self.assertEqual(
+            bytes(cache.retrieve(('other',), self.pickling)[0].data),
+            data,
+        )
+
+        # Buffers are removed with the blob
+        self.assertGreater(cache.index.total_size(), 400000)
+        cache.remove(('step',))
+        self.assertEqual(self.blobs(), [])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    @unittest.skipIf(pickle.HIGHEST_PROTOCOL < 5,
+                     "Out-of-band buffers need pickle protocol 5")
+    def test_numpy(self):
+        """Test memory-mapping NumPy arrays from the cache."""
+        array = numpy.arange(100000, dtype=numpy.float64)
+        outputs = {'array': (array, hash_value(array, self.pickling))}
+        with self.pickling.hasher.remember(outputs.values()):
+            self.cache.store(('step',), outputs, self.pickling)
+        loaded = self.cache.retrieve(('step',), self.pickling)['array'][0]
+        self.assertTrue(numpy.array_equal(loaded, array))
+        self.assertFalse(loaded.flags.writeable)
+        self.assertEqual(len(self.blobs()), 2)
+
+    def test_compression(self):
+        """Test compressing entries and blobs."""
+        text = ('All work and no play makes Jack a dull boy. ' * 10000)
+        noise = os.urandom(100000)
+        hashes = {'text': hash_value(text, self.pickling)}
+        directory = self.cache.directory
+        for codec in ['zlib', 'bz2', 'lzma']:
+            cache = DirectoryCache(directory, compression=codec,
+                                   compression_level=1)
+            cache.store((codec,), text, self.pickling)
+            self.assertLess(cache.size((codec,)), len(text) // 5)
+            self.assertEqual(cache.retrieve((codec,), self.pickling), text)
+
+        # Incompressible data is stored as it is
+        cache.store(('noise',), noise, self.pickling)
+        with open(cache._path(('noise',)), 'rb') as fp:
+            self.assertEqual(fp.read(1), b'\x80')
+
+        # Entries written with other settings are still readable
+        self.assertEqual(self.cache.retrieve(('bz2',), self.pickling), text)
+        self.assertEqual(cache.retrieve(('noise',), self.pickling), noise)
+        self.cache.store(('plain',), text, self.pickling)
+        self.assertEqual(cache.retrieve(('plain',), self.pickling), text)
+
+        # Blobs too
+        cache.store(('outputs',), {'text': text}, self.pickling)
+        with self.pickling.hasher.remember([(text, hashes['text'])]):
+            cache.store(('outputs',), {'text': text}, self.pickling)
+        blob, = self.blobs()
+        self.assertLess(
+            os.path.getsize(os.path.join(directory, 'blobs.d',
+                                         blob[:2], blob)),
+            len(text) // 5,
+        )
+        self.assertEqual(self.cache.retrieve(('outputs',), self.pickling),
+                         {'text': text})
+
+        with self.assertRaises(ValueError):
+            DirectoryCache(directory, compression='zip')
+
+    def test_layout(self):
+        """Test writing entries atomically, in subdirectories."""
+        self.cache.store(('step1', 'outputs'), 42, self.pickling)
+        self.assertTrue(self.cache.fan_out)
+        self.assertEqual(
+            self.cache._path(('step1', 'outputs')),
+            os.path.join(self.cache.directory, 'st', 'step1__outputs'),
+        )
+        self.assertEqual(self.cache.retrieve(('step1', 'outputs'),
+                                             self.pickling), 42)
+        with self.cache.lock(('step2', 'outputs')):
+            pass
+
+        # Failed writes leave nothing behind
+        self.cache.store(('step2', 'outputs'), threading.Lock(),
+                         self.pickling)
+        self.assertFalse(self.cache.has_key(('step2', 'outputs')))
+
+        class Unpicklable(object):
+            def __reduce__(self):
+                raise RuntimeError("can't pickle")
+
+        with self.assertRaises(RuntimeError):
+            self.cache.store(('step1', 'outputs'), Unpicklable(),
+                             self.pickling)
+        self.assertEqual(self.cache.retrieve(('step1', 'outputs'),
+                                             self.pickling), 42)
+        self.assertEqual(
+            sorted(os.listdir(self.cache.directory)),
+            ['layout.txt', 'st'],
+        )
+
+        # Stale temporary files get cleaned up
+        blobs = os.path.join(self.cache.directory, 'blobs.d')
+        os.mkdir(blobs)
+        stale = [os.path.join(self.cache.directory, '.tmpstale'),
+                 os.path.join(blobs, '.tmpstale')]
+        for path in stale:
+            open(path, 'wb').close()
+            os.utime(path, (0, 0))
+        DirectoryCache(self.cache.directory)
+        for path in stale:
+            self.assertFalse(os.path.exists(path))
+
+        # Caches from older versions keep their layout
+        directory = os.path.join(self.temp_dir.name, 'flat')
+        os.mkdir(directory)
+        with open(os.path.join(directory, 'step1__outputs'), 'wb') as fp:
+            self.pickling.dump(12, fp)
+        cache = DirectoryCache(directory, max_size=1 << 20)
+        self.assertFalse(cache.fan_out)
+        self.assertEqual(cache.retrieve(('step1', 'outputs'),
+                                        self.pickling), 12)
+        cache.store(('step2', 'outputs'), 13, self.pickling)
+        self.assertTrue(
+            os.path.exists(os.path.join(directory, 'step2__outputs')),
+        )
+        self.assertEqual(cache.index.total_size(),
+                         2 * cache.size(('step1', 'outputs')))
+
+        # Including their temporary files
+        stale = os.path.join(directory, '.tmpstale')
+        open(stale, 'wb').close()
+        os.utime(stale, (0, 0))
+        DirectoryCache(directory)
+        self.assertFalse(os.path.exists(stale))
+
+
+class TestSmartCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.pickling = Pickling(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_admission(self):
+        """Test not storing results that are too cheap to compute."""
+        cache = SmartCache(MemoryCache(), 100000)
+        cache.store(('cheap', 'outputs'), b'x' * 50000,
+                    pickling=self.pickling, work_amount=0.0001)
+        self.assertFalse(cache.has_key(('cheap', 'outputs')))
+        cache.store(('slow', 'outputs'), b'x' * 50000,
+                    pickling=self.pickling, work_amount=1.0)
+        self.assertTrue(cache.has_key(('slow', 'outputs')))
+        self.assertGreater(cache.total_size, 50000)
+
+    def test_eviction(self):
+        """Test evicting big cheap results before small expensive ones."""
+        backend = MemoryCache()
+        cache = SmartCache(backend, 20000)
+
+        def store(name, size, work_amount):
+            cache.store((name, 'outputs'), os.urandom(size),
+                        pickling=self.pickling, work_amount=work_amount)
+            cache.store((name, 'manifest'), {},
+                        pickling=self.pickling)
+
+        store('small', 1000, 1.0)
+        store('big1', 8000, 0.01)
+        store('big2', 8000, 0.01)
+        cache.retrieve(('big1', 'outputs'), pickling=self.pickling)
+        store('big3', 8000, 0.01)
+        self.assertEqual(
+            set(backend.values),
+            {('small', 'outputs'), ('small', 'manifest'),
+             ('big1', 'outputs'), ('big1', 'manifest'),
+             ('big3', 'outputs'), ('big3', 'manifest')},
+        )
+        self.assertLessEqual(cache.total_size, 20000)
+
+        # Entries that are not used anymore go eventually
+        for i in range(3):
+            store('new%d' % i, 1000, 0.5)
+        self.assertFalse(cache.has_key(('big1', 'outputs')))
+        for i in range(3, 60):
+            store('new%d' % i, 1000, 0.5)
+        self.assertFalse(cache.has_key(('small', 'outputs')))
+
+    def test_processes(self):
+        """Test sharing the budget between caches using the same database."""
+        backend = MemoryCache()
+        path = os.path.join(self.temp_dir.name, 'smart.sqlite3')
+        for i in range(3):
+            # Another process, with its own cache object
+            cache = SmartCache(backend, 20000, path=path)
+            cache.store(('step%d' % i, 'outputs'), os.urandom(8000),
+                        pickling=self.pickling, work_amount=1.0)
+        self.assertFalse(backend.has_key(('step0', 'outputs')))
+        self.assertTrue(backend.has_key(('step2', 'outputs')))
+        self.assertEqual(SmartCache(backend, 20000, path=path).total_size,
+                         cache.total_size)
+        self.assertLessEqual(cache.total_size, 20000)
+
+    def test_directory(self):
+        """Test using a SmartCache in front of a DirectoryCache."""
+        backend = DirectoryCache(os.path.join(self.temp_dir.name, 'cache'),
+                                 blob_threshold=4096)
+        cache = SmartCache(backend, 20000)
+        for i in range(3):
+            cache.store(('step%d' % i, 'outputs'), os.urandom(8000),
+                        pickling=self.pickling, work_amount=1.0)
+        self.assertFalse(cache.has_key(('step0', 'outputs')))
+        self.assertTrue(cache.has_key(('step2', 'outputs')))
+        self.assertEqual(
+            sum(backend.size(('step%d' % i, 'outputs')) or 0
+                for i in range(3)),
+            cache.total_size,
+        )
+
+        # Values stored as blobs count too, and are removed with the entries
+        def blob_bytes():
+            blobs = os.path.join(backend.directory, 'blobs.d')
+            return sum(
+                os.path.getsize(os.path.join(path, name))
+                for path, _, files in os.walk(blobs)
+                for name in files
+            )
+
+        for i in range(10):
+            value = os.urandom(8000)
+            value_hash = hash_value(value, self.pickling)
+            with self.pickling.hasher.remember([(value, value_hash)]):
+                cache.store(('blob%d' % i, 'outputs'), value,
+                            pickling=self.pickling, work_amount=1.0)
+        self.assertGreater(blob_bytes(), 8000)
+        self.assertLessEqual(blob_bytes(), 20000)
+        self.assertLessEqual(cache.total_size, 20000)
+
+        value = os.urandom(1000000)
+        value_hash = hash_value(value, self.pickling)
+        with self.pickling.hasher.remember([(value, value_hash)]):
+            # Faster to compute than to read
+            cache.store(('big', 'outputs'), value,
+                        pickling=self.pickling, work_amount=0.0001)
+            self.assertFalse(cache.has_key(('big', 'outputs')))
+            self.assertLessEqual(blob_bytes(), 20000)
+            backend.store(('big', 'outputs'), value, pickling=self.pickling)
+        self.assertGreater(backend.size(('big', 'outputs')), 1000000)
+        self.assertLess(
+            os.path.getsize(backend._path(('big', 'outputs'))),
+            1000,
+        )
+
+
+class TestTieredCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.pickling = Pickling(self.temp_dir.name)
+        self.disk = DirectoryCache(os.path.join(self.temp_dir.name, 'cache'))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_tiers(self):
+        """Test serving values from memory, and promoting them."""
+        cache = TieredCache(self.disk, 25000)
+        values = [Opaque(os.urandom(10000)) for _ in range(3)]
+        for i, value in enumerate(values):
+            cache.store(('step%d' % i,), value, pickling=self.pickling)
+        self.assertTrue(self.disk.has_key(('step0',)))
+        self.assertLessEqual(cache.memory_size, 25000)
+
+        # Recent values come from memory, unpickled every time
+        self.disk.remove(('step2',))
+        loaded = cache.retrieve(('step2',), pickling=self.pickling)
+        self.assertEqual(loaded.value, values[2].value)
+        self.assertIsNot(loaded, values[2])
+        self.assertIsNot(cache.retrieve(('step2',), pickling=self.pickling),
+                         loaded)
+        # Older ones were dropped from memory, and come from disk
+        self.assertNotIn(('step0',), cache._memory)
+        loaded = cache.retrieve(('step0',), pickling=self.pickling)
+        self.assertEqual(loaded.value, values[0].value)
+        # And are promoted
+        self.assertIn(('step0',), cache._memory)
+        # Making room by dropping the least recently used
+        self.assertNotIn(('step1',), cache._memory)
+
+        cache.remove(('step0',))
+        self.assertFalse(cache.has_key(('step0',)))
+        with self.assertRaises(KeyError):
+            cache.retrieve(('step0',), pickling=self.pickling)
+
+    def test_memory_size(self):
+        """Test measuring values in memory, not on disk."""
+        disk = DirectoryCache(os.path.join(self.temp_dir.name, 'compressed'),
+                              compression='zlib')
+        cache = TieredCache(disk, 100000)
+        cache.store(('step',), 'a' * 1000000, pickling=self.pickling)
+        self.assertLess(disk.size(('step',)), 100000)
+        self.assertEqual(cache.memory_size, 0)
+        cache.retrieve(('step',), pickling=self.pickling)
+        self.assertEqual(cache.memory_size, 0)
+
+    def test_files(self):
+        """Test that values with files are not kept in memory."""
+        cache = TieredCache(self.disk, 25000)
+        temp_file = TemporaryFile(self.temp_dir.name)
+        cache.store(('step',), {'file': (temp_file, 'hash')},
+                    pickling=self.pickling)
+        self.assertEqual(cache.memory_size, 0)
+        self.assertIsNot(
+            cache.retrieve(('step',), pickling=self.pickling)['file'][0],
+            temp_file,
+        )
+
+
+class TestSqliteCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.pickling = Pickling(self.temp_dir.name)
+        self.directory = os.path.join(self.temp_dir.name, 'cache')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_store(self):
+        """Test storing small values inline and big ones in files."""
+        cache = SqliteCache(self.directory, inline_threshold=1000)
+        big = os.urandom(5000)
+        for i in range(100):
+            cache.store(('step%d' % i, 'outputs'), {'n': i}, self.pickling)
+        cache.store(('big', 'outputs'), big, self.pickling)
+        cache.store(('bad', 'outputs'), threading.Lock(), self.pickling)
+        self.assertEqual(
+            sorted(n for n in os.listdir(self.directory) if '.' not in n),
+            ['big__outputs'],
+        )
+
+        # Another connection
+        cache = SqliteCache(self.directory, inline_threshold=1000)
+        self.assertTrue(cache.has_key(('step5', 'outputs')))
+        self.assertFalse(cache.has_key(('bad', 'outputs')))
+        self.assertEqual(cache.retrieve(('step5', 'outputs'), self.pickling),
+                         {'n': 5})
+        self.assertEqual(cache.retrieve(('big', 'outputs'), self.pickling),
+                         big)
+        self.assertGreater(cache.size(('big', 'outputs')), 5000)
+        self.assertLess(cache.size(('step5', 'outputs')), 100)
+        with self.assertRaises(KeyError):
+            cache.retrieve(('missing', 'outputs'), self.pickling)
+
+        # Replacing a big value with a small one
+        cache.store(('big', 'outputs'), 'small', self.pickling)
+        self.assertEqual(cache.retrieve(('big', 'outputs'), self.pickling),
+                         'small')
+        self.assertFalse(
+            os.path.exists(os.path.join(self.directory, 'big__outputs')),
+        )
+
+        cache.remove(('step5', 'outputs'))
+        self.assertFalse(cache.has_key(('step5', 'outputs')))
+
+    def test_blobs(self):
+        """Test counting and removing the blobs entries reference."""
+        cache = SqliteCache(self.directory)
+        value = os.urandom(500000)
+        value_hash = hash_value(value, self.pickling)
+        with self.pickling.hasher.remember([(value, value_hash)]):
+            cache.store(('one',), value, self.pickling)
+            cache.store(('two',), [value], self.pickling)
+        blob = os.path.join(self.directory, 'blobs.d', value_hash[:2],
+                            value_hash)
+        self.assertTrue(os.path.exists(blob))
+        self.assertGreater(cache.size(('one',)), 500000)
+        self.assertGreater(cache.size(('two',)), 500000)
+
+        cache.remove(('one',))
+        self.assertTrue(os.path.exists(blob))
+        cache.store(('two',), 'replaced', self.pickling)
+        self.assertFalse(os.path.exists(blob))
+        self.assertLess(cache.size(('two',)), 100)
+
+    def test_batch(self):
+        """Test looking up many keys at once."""
+        cache = SqliteCache(self.directory)
+        for i in range(0, 1000, 2):
+            cache.store(('step%d' % i,), i, self.pickling)
+        keys = [('step%d' % i,) for i in range(1000)]
+        self.assertEqual(cache.has_keys(keys), set(keys[::2]))
+        values = cache.retrieve_many(keys, pickling=self.pickling)
+        self.assertEqual(values, {('step%d' % i,): i
+                                  for i in range(0, 1000, 2)})
+
+
+@unittest.skipIf(requests is None, "Requests or Tornado is not installed")
+class TestRemoteCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.pickling = Pickling(self.temp_dir.name)
+
+        # Run a server in a thread
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/' % sockets[0].getsockname()[1]
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            http_server = tornado.httpserver.HTTPServer(server.make_app(
+                os.path.join(self.temp_dir.name, 'server'),
+            ))
+            http_server.add_sockets(sockets)
+            self.loop = tornado.ioloop.IOLoop.current()
+            started.set()
+            self.loop.start()
+            http_server.stop()
+            self.loop.close(all_fds=True)
+
+        self.thread = threading.Thread(target=serve)
+        self.thread.start()
+        started.wait()
+
+    def tearDown(self):
+        self.loop.add_callback(self.loop.stop)
+        self.thread.join()
+        self.temp_dir.cleanup()
+
+    def remote(self, name):
+        return RemoteCache(
+            self.url,
+            DirectoryCache(os.path.join(self.temp_dir.name, name)),
+        )
+
+    def test_share(self):
+        """Test sharing values between machines through a server."""
+        one = self.remote('one')
+        two = self.remote('two')
+        temp_file = TemporaryFile(self.temp_dir.name)
+        contents = os.urandom(2000000)
+        with open(temp_file.name, 'wb') as fp:
+            fp.write(contents)
+        one.store(('step1', 'outputs'), {'file': temp_file, 'n': 1},
+                  pickling=self.pickling)
+        one.store(('step2', 'outputs'), 'text' * 1000,
+                  pickling=self.pickling)
+
+        keys = [('step%d' % i, 'outputs') for i in range(4)]
+        self.assertEqual(two.has_keys(keys), set(keys[1:3]))
+        self.assertFalse(two.local.has_key(('step1', 'outputs')))
+        loaded = two.retrieve(('step1', 'outputs'), pickling=self.pickling)
+        self.assertEqual(loaded['n'], 1)
+        with open(loaded['file'].name, 'rb') as fp:
+            self.assertEqual(fp.read(), contents)
+        # Now stored locally
+        self.assertTrue(two.local.has_key(('step1', 'outputs')))
+        with self.assertRaises(KeyError):
+            two.retrieve(('step3', 'outputs'), pickling=self.pickling)
+
+        two.remove(('step2', 'outputs'))
+        self.assertFalse(self.remote('three').has_key(('step2', 'outputs')))
+
+    def test_unreachable(self):
+        """Test that the local cache still works without the server."""
+        cache = RemoteCache(
+            'http://127.0.0.1:1/',
+            DirectoryCache(os.path.join(self.temp_dir.name, 'local')),
+        )
+        cache.store(('step1', 'outputs'), 12, pickling=self.pickling)
+        # Not tried again for a while
+        self.assertFalse(cache._reachable())
+        self.assertTrue(cache.has_key(('step1', 'outputs')))
+        self.assertFalse(cache.has_key(('step2', 'outputs')))
+        self.assertEqual(cache.retrieve(('step1', 'outputs'),
+                                        pickling=self.pickling), 12)
+        with self.assertRaises(KeyError):
+            cache.retrieve(('step2', 'outputs'), pickling=self.pickling)
+
+
+def store_entries(args):
+    directory, temp_dir, worker = args
+    cache = DirectoryCache(directory, max_size=100000)
+    pickling = Pickling(temp_dir)
+    for i in range(20):
+        key = ('w%ds%d' % (worker, i), 'outputs')
+        cache.store(key, os.urandom(10000), pickling)
+        try:
+            cache.retrieve(key, pickling)
+        except KeyError:
+            pass  # Evicted by another process already
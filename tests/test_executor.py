@@ -1,9 +1,21 @@
+import asyncio
+import concurrent.futures
+import gc
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
 import unittest
+import weakref
 
-from cacheflow import Executor
+from cacheflow import AsyncExecutor, Executor
 from cacheflow.base import Workflow, Component, ComponentLoader, \
-    Step, StepInputConnection
-from cacheflow.cache import NullCache
+    SimpleComponentLoader, Step, StepInputConnection
+from cacheflow.cache import DirectoryCache, Hasher, MemoryCache, \
+    NullCache, TemporaryFile, TieredCache
+from cacheflow.trace import Trace
 
 
 class MockComponent(Component):
@@ -18,6 +30,15 @@ class MockLoader(ComponentLoader):
         return MockComponent
 
 
+class CountingLoader(MockLoader):
+    def __init__(self):
+        self.loaded = 0
+
+    def get_component(self, component_def):
+        self.loaded += 1
+        return super(CountingLoader, self).get_component(component_def)
+
+
 class TestLoading(unittest.TestCase):
     def executor(self):
         executor = Executor(NullCache)
@@ -82,8 +103,8 @@ class TestLoading(unittest.TestCase):
             steps1, {
                 'one': (steps1['one'][0], 'e654a5214e9805a3325ea921433c5d88' +
                         'b7e49fd075fad6c5153e7c589795b43d'),
-                'two': (steps1['two'][0], 'a4b199ebd6b64a671b2d965080f779f2' +
-                        '2317214ccf14c1cfae42b193cfbd4e4f'),
+                'two': (steps1['two'][0], '768072aea5f8c8ce9038152fba592c53' +
+                        '4c1c289f515d41b33f2dc9834b036f24'),
             }
         )
 
@@ -104,8 +125,8 @@ class TestLoading(unittest.TestCase):
                 'one': (steps1['one'][0], 'e654a5214e9805a3325ea921433c5d88' +
                         'b7e49fd075fad6c5153e7c589795b43d'),
                 # 'two' has different id()
-                'two': (steps2['two'][0], 'c8ee525a0040b7cdda23a3ea68a3631c' +
-                                          '3024ff39207a9952380bb57303885db7'),
+                'two': (steps2['two'][0], 'b9f121e936994d95b61e91afc09bbac3' +
+                                          '07c81cb1778d5529dec183699d384fcc'),
             }
         )
 
@@ -131,3 +152,847 @@ class TestLoading(unittest.TestCase):
                                           '19beabed488efe0d0e313a322fe51967'),
             }
         )
+
+    def test_reload(self):
+        """Test reloading a workflow without hashing the unchanged steps."""
+        def make_workflow(last):
+            steps = {'s0': Step('s0', {'type': 'mock'},
+                                {'i': ['a', 1.5, [1, {'k': None}]]})}
+            for i in range(1, 5):
+                steps['s%d' % i] = Step('s%d' % i, {'type': 'mock'}, {
+                    'i': [StepInputConnection('s%d' % (i - 1), 'o')],
+                    'j': [last if i == 4 else 2.0],
+                })
+            return Workflow(steps, {})
+
+        hashed = []
+
+        def new_hash():
+            hashed.append(1)
+            return hashlib.sha256()
+
+        loader = CountingLoader()
+        executor = Executor(NullCache(), hasher=Hasher(new_hash))
+        executor.add_components_loader(loader)
+        executor.load_workflow(make_workflow(3))
+        hashes = dict(executor.step_hashes)
+        components = dict(executor.steps)
+        self.assertEqual(loader.loaded, 10)
+        self.assertTrue(hashed)
+
+        # Nothing is loaded or hashed again
+        loader.loaded = 0
+        del hashed[:]
+        executor.load_workflow(make_workflow(3))
+        self.assertEqual(executor.step_hashes, hashes)
+        self.assertEqual(executor.steps, components)
+        self.assertEqual(loader.loaded, 0)
+        self.assertEqual(hashed, [])
+
+        # Only the changed step is, even if the new value compares equal
+        executor.load_workflow(make_workflow(3.0))
+        self.assertEqual(loader.loaded, 2)
+        self.assertEqual(len(hashed), 1)
+        self.assertNotEqual(executor.step_hashes['s4'], hashes['s4'])
+        self.assertEqual(
+            {k: v for k, v in executor.step_hashes.items() if k != 's4'},
+            {k: v for k, v in hashes.items() if k != 's4'},
+        )
+
+    def test_long_chain(self):
+        """Test loading a workflow deeper than the recursion limit."""
+        def make_chain(first):
+            steps = {'s0': Step('s0', {'type': 'mock'}, {'i': [first]})}
+            for i in range(1, 3000):
+                steps['s%d' % i] = Step('s%d' % i, {'type': 'mock'}, {
+                    'i': [StepInputConnection('s%d' % (i - 1), 'o')],
+                })
+            return Workflow(steps, {})
+
+        executor = self.executor()
+        executor.load_workflow(make_chain('a'))
+        hashes1 = dict(executor.step_hashes)
+        self.assertEqual(len(set(hashes1.values())), 3000)
+
+        # Same hashes if reloaded, different if the first step changes
+        executor.load_workflow(make_chain('a'))
+        self.assertEqual(executor.step_hashes, hashes1)
+        executor.load_workflow(make_chain('b'))
+        self.assertTrue(all(
+            executor.step_hashes[k] != hashes1[k] for k in hashes1
+        ))
+
+        # Cycles are detected
+        workflow = make_chain('a')
+        workflow.steps['s0'].inputs['j'] = [
+            StepInputConnection('s2999', 'o'),
+        ]
+        with self.assertRaises(RuntimeError):
+            executor.load_workflow(workflow)
+
+
+components = SimpleComponentLoader()
+
+
+@components(inputs=['value'], outputs=['value'])
+class Constant(Component):
+    def execute(self, inputs, **kwargs):
+        value, = inputs['value']
+        self.set_output('value', int(value))
+
+
+@components(inputs=['a', 'b'], outputs=['sum'])
+class Add(Component):
+    executed = 0
+
+    def execute(self, inputs, **kwargs):
+        Add.executed += 1
+        time.sleep(0.05)
+        self.set_output('sum', sum(inputs['a'] + inputs['b']))
+
+
+@components(inputs=['contents'], outputs=['file'])
+class WriteFile(Component):
+    def execute(self, inputs, temp_dir, **kwargs):
+        contents, = inputs['contents']
+        temp_file = TemporaryFile(temp_dir)
+        with open(temp_file.name, 'w') as fp:
+            fp.write(contents)
+        self.set_output('file', temp_file)
+
+
+@components(inputs=['file'], outputs=['contents'])
+class ReadFile(Component):
+    def execute(self, inputs, **kwargs):
+        temp_file, = inputs['file']
+        with open(temp_file.name) as fp:
+            self.set_output('contents', fp.read())
+
+
+@components(inputs=['file'], outputs=['contents', 'fp'])
+class ReadFileKeepOpen(Component):
+    def execute(self, inputs, **kwargs):
+        temp_file, = inputs['file']
+        fp = open(temp_file.name)
+        self.set_output('contents', fp.read())
+        fp.close()
+        # Like a local left in a Python script, can't be pickled
+        self.set_output('fp', fp)
+
+
+@components(inputs=['value'], outputs=['value'])
+class AsyncSleep(Component):
+    async def execute_async(self, inputs, **kwargs):
+        value, = inputs['value']
+        await asyncio.sleep(0.1)
+        self.set_output('value', value)
+
+
+@components(inputs=['name', 'seconds', 'after'], outputs=['done'])
+class Sleep(Component):
+    order = []
+
+    def execute(self, inputs, **kwargs):
+        name, = inputs['name']
+        seconds, = inputs['seconds']
+        Sleep.order.append(name)
+        time.sleep(float(seconds))
+        self.set_output('done', True)
+
+
+class Blob(object):
+    instances = weakref.WeakSet()
+
+    def __init__(self, value):
+        self.value = value
+        Blob.instances.add(self)
+
+
+@components(inputs=['value'], outputs=['blob'])
+class MakeBlob(Component):
+    def execute(self, inputs, **kwargs):
+        value, = inputs['value']
+        self.set_output('blob', Blob(value))
+
+
+@components(inputs=['blob'], outputs=['value', 'alive'])
+class UseBlob(Component):
+    def execute(self, inputs, **kwargs):
+        blob, = inputs['blob']
+        gc.collect()
+        self.set_output('value', blob.value)
+        self.set_output('alive', len(Blob.instances))
+
+
+@components(inputs=['count'], outputs=['numbers'])
+class Numbers(Component):
+    produced = 0
+
+    def execute(self, inputs, **kwargs):
+        count, = inputs['count']
+
+        def generate():
+            for i in range(count):
+                Numbers.produced += 1
+                yield i
+
+        self.set_output_stream('numbers', generate())
+
+
+@components(inputs=['numbers'], outputs=['sum', 'lag'])
+class SumStream(Component):
+    def execute(self, inputs, **kwargs):
+        numbers, = inputs['numbers']
+        total = 0
+        lag = 0
+        for i, n in enumerate(numbers):
+            # How far ahead of us the producer is
+            lag = max(lag, Numbers.produced - (i + 1))
+            total += n
+        self.set_output('sum', total)
+        self.set_output('lag', lag)
+
+
+@components(inputs=['log'], outputs=['done'])
+class LogRun(Component):
+    def execute(self, inputs, **kwargs):
+        log, = inputs['log']
+        with open(log, 'a') as fp:
+            fp.write('run\n')
+        time.sleep(0.2)
+        self.set_output('done', True)
+
+
+def run_log_workflow(cache_dir, log):
+    executor = Executor(DirectoryCache(cache_dir))
+    executor.add_components_loader(components)
+    executor.load_workflow(Workflow(
+        {'log': Step('log', {'type': 'LogRun'}, {'log': [log]})},
+        {},
+    ))
+    return executor.execute()['log']['done']
+
+
+class Counted(object):
+    pickled = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        Counted.pickled += 1
+        return Counted, (self.value,)
+
+
+@components(inputs=['value'], outputs=['counted'])
+class MakeCounted(Component):
+    def execute(self, inputs, **kwargs):
+        value, = inputs['value']
+        self.set_output('counted', Counted(value))
+
+
+@components(outputs=['list'])
+class MakeList(Component):
+    def execute(self, inputs, **kwargs):
+        self.set_output('list', list(range(100000)))
+
+
+@components(inputs=['value'], outputs=['list'])
+class Append(Component):
+    def execute(self, inputs, **kwargs):
+        value, = inputs['value']
+        value.append(-1)
+        self.set_output('list', value)
+
+
+@components(inputs=['value'], outputs=['length'])
+class Length(Component):
+    def execute(self, inputs, **kwargs):
+        value, = inputs['value']
+        self.set_output('length', len(value))
+
+
+@components(inputs=['size'], outputs=['data'])
+class RandomBytes(Component):
+    def execute(self, inputs, **kwargs):
+        size, = inputs['size']
+        self.set_output('data', os.urandom(int(size)))
+
+
+@components(inputs=['a', 'b'], outputs=['length'])
+class TotalLength(Component):
+    def execute(self, inputs, **kwargs):
+        (a,), (b,) = inputs['a'], inputs['b']
+        self.set_output('length', len(a) + len(b))
+
+
+@components(inputs=['value'], outputs=['same', 'wrapped'])
+class PassThrough(Component):
+    def execute(self, inputs, **kwargs):
+        value, = inputs['value']
+        self.set_output('same', value)
+        self.set_output('wrapped', {'value': value, 'other': [1, 2]})
+
+
+def make_workflow(width):
+    steps = {}
+    for i in range(width):
+        steps['c%d' % i] = Step('c%d' % i, {'type': 'Constant'},
+                                {'value': [str(i)]})
+        steps['a%d' % i] = Step('a%d' % i, {'type': 'Add'}, {
+            'a': [StepInputConnection('c%d' % i, 'value')],
+            'b': [StepInputConnection('c0', 'value')],
+        })
+    steps['total'] = Step('total', {'type': 'Add'}, {
+        'a': [StepInputConnection('a0', 'sum')],
+        'b': [StepInputConnection('a%d' % (width - 1), 'sum')],
+    })
+    return Workflow(steps, {})
+
+
+class TestExecution(unittest.TestCase):
+    def run_workflow(self, workflow, executor_cls=Executor, **kwargs):
+        cache = MemoryCache()
+        executor = executor_cls(cache, **kwargs)
+        executor.add_components_loader(components)
+        executor.load_workflow(workflow)
+        return executor.execute(), cache
+
+    def test_parallel(self):
+        """Test that parallel execution gets the same results."""
+        workflow = make_workflow(8)
+        serial_results, serial_cache = self.run_workflow(workflow)
+        start = time.perf_counter()
+        parallel_results, parallel_cache = self.run_workflow(
+            workflow, max_workers=8,
+        )
+        elapsed = time.perf_counter() - start
+        self.assertEqual(serial_results['total'], {'sum': 7})
+        self.assertEqual(parallel_results, serial_results)
+        self.assertEqual(set(parallel_cache.values),
+                         set(serial_cache.values))
+        # 9 Add steps of 50ms each, but only 2 levels (0.45s if serial)
+        self.assertLess(elapsed, 0.4)
+
+    def test_processes(self):
+        """Test executing steps in worker processes."""
+        workflow = make_workflow(4)
+        workflow.steps['file'] = Step('file', {'type': 'WriteFile'},
+                                      {'contents': ['hello']})
+        workflow.steps['read'] = Step('read', {'type': 'ReadFile'}, {
+            'file': [StepInputConnection('file', 'file')],
+        })
+        serial_results, serial_cache = self.run_workflow(workflow)
+        process_results, process_cache = self.run_workflow(
+            workflow, max_workers=2, backend='processes',
+        )
+        self.assertEqual(process_results['read'], {'contents': 'hello'})
+        self.assertEqual(process_results['total'], serial_results['total'])
+        self.assertEqual(set(process_cache.values),
+                         set(serial_cache.values))
+
+    def test_processes_unpicklable(self):
+        """Test worker processes with outputs that can't be pickled."""
+        workflow = Workflow(
+            {
+                'file': Step('file', {'type': 'WriteFile'},
+                             {'contents': ['hello']}),
+                'read': Step('read', {'type': 'ReadFileKeepOpen'}, {
+                    'file': [StepInputConnection('file', 'file')],
+                }),
+                'use': Step('use', {'type': 'PassThrough'}, {
+                    'value': [StepInputConnection('read', 'contents')],
+                }),
+            },
+            {},
+        )
+        with self.assertLogs('cacheflow.executor', 'WARNING') as logs:
+            results, _ = self.run_workflow(workflow, backend='processes')
+        self.assertEqual(results['use']['same'], 'hello')
+        self.assertIn("dropping them: fp", logs.output[0])
+
+        # Running in worker processes defaults to one per CPU
+        executor = Executor(MemoryCache(), backend='processes')
+        pool, max_running = executor._make_pool()
+        executor._shutdown_pool(pool)
+        self.assertEqual(max_running, os.cpu_count())
+
+    def test_async(self):
+        """Test executing async components concurrently."""
+        workflow = make_workflow(4)
+        for i in range(50):
+            workflow.steps['s%d' % i] = Step(
+                's%d' % i, {'type': 'AsyncSleep'},
+                {'value': [StepInputConnection('a%d' % (i % 4), 'sum')]},
+            )
+        start = time.perf_counter()
+        results, _ = self.run_workflow(workflow, executor_cls=AsyncExecutor)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(results['s5'], {'value': 1})
+        self.assertEqual(results['total'], {'sum': 3})
+        # 50 sleeps of 100ms each, over 5s if not concurrent
+        self.assertLess(elapsed, 2.0)
+
+        # Without an event loop, async components still work
+        results, _ = self.run_workflow(workflow)
+        self.assertEqual(results['s5'], {'value': 1})
+
+    def test_top_down(self):
+        """Test looking up steps from structural hashes."""
+        workflow = make_workflow(4)
+        cache = MemoryCache()
+
+        def run(workflow, cache, **kwargs):
+            executor = Executor(cache, top_down=True)
+            executor.add_components_loader(components)
+            executor.load_workflow(workflow)
+            Add.executed = 0
+            return executor.execute(**kwargs), Add.executed
+
+        results = {'a1': {'sum': 1}, 'a2': {'sum': 2}, 'total': {'sum': 3}}
+        self.assertEqual(run(workflow, cache), (results, 5))
+        self.assertEqual(
+            set(k[1] if len(k) > 1 else k[0] for k in cache.values),
+            {'output', 'manifest', 'step', 'durations'},
+        )
+        # Everything is found from the structural hash of the sinks
+        self.assertEqual(run(workflow, cache), (results, 0))
+        self.assertEqual(
+            run(workflow, cache, sinks=['a2']),
+            ({'a2': {'sum': 2}}, 0),
+        )
+
+        # Changing a leaf only re-runs the steps that depend on it
+        workflow.steps['c3'].inputs['value'] = ['5']
+        results['total'] = {'sum': 5}
+        self.assertEqual(run(workflow, cache), (results, 2))
+
+        # Steps that disappear from the cache get re-computed
+        workflow.steps['c3'].inputs['value'] = ['6']
+        results['total'] = {'sum': 6}
+        self.assertEqual(run(workflow, cache), (results, 2))
+
+        class ForgetfulCache(MemoryCache):
+            def retrieve(self, key, **kwargs):
+                if key[1:2] in (('output',), ('manifest',)):
+                    raise KeyError(key)
+                return super(ForgetfulCache, self).retrieve(key, **kwargs)
+
+        forgetful = ForgetfulCache()
+        forgetful.values = cache.values
+        self.assertEqual(run(workflow, forgetful), (results, 5))
+
+    def test_lazy(self):
+        """Test that outputs are only loaded from the cache when needed."""
+        workflow = make_workflow(4)
+        loaded = []
+
+        class RecordingCache(MemoryCache):
+            def retrieve(self, key, **kwargs):
+                value = super(RecordingCache, self).retrieve(key, **kwargs)
+                if key[1:2] == ('output',):
+                    loaded.append(key[0])
+                return value
+
+        cache = RecordingCache()
+        executor = Executor(cache)
+        executor.add_components_loader(components)
+        executor.load_workflow(workflow)
+        executor.execute()
+        loaded[:] = []
+        executor.execute()
+        self.assertEqual(loaded, [])
+        results = executor.execute(sinks=['total'])
+        self.assertEqual(loaded, [])
+        self.assertEqual(dict(results['total']), {'sum': 3})
+        self.assertEqual(len(loaded), 1)
+
+        # Changing a step loads only the outputs it uses
+        workflow.steps['total'].inputs['b'] = [
+            StepInputConnection('a2', 'sum'),
+        ]
+        executor.load_workflow(workflow)
+        results = executor.execute(sinks=['total'])
+        self.assertEqual(results, {'total': {'sum': 2}})
+        self.assertEqual(len(loaded), 3)
+
+    def test_output_entries(self):
+        """Test that each output is stored and loaded on its own."""
+        workflow = Workflow(
+            {
+                'make': Step('make', {'type': 'MakeCounted'},
+                             {'value': ['x']}),
+                'pass': Step('pass', {'type': 'PassThrough'},
+                             {'value': [StepInputConnection('make',
+                                                            'counted')]}),
+            },
+            {},
+        )
+        loaded = []
+
+        class RecordingCache(MemoryCache):
+            def retrieve(self, key, **kwargs):
+                value = super(RecordingCache, self).retrieve(key, **kwargs)
+                if key[1:2] in (('output',), ('outputs',)):
+                    loaded.append(key[1:])
+                return value
+
+        cache = RecordingCache()
+        executor = Executor(cache)
+        executor.add_components_loader(components)
+        executor.load_workflow(workflow)
+        executor.execute()
+        results = executor.execute(sinks=['pass'])
+        self.assertEqual(results['pass']['wrapped']['other'], [1, 2])
+        self.assertEqual(loaded, [('output', 'wrapped')])
+
+        # Entries from older versions, with all the outputs together
+        for key in [k for k in cache.values if k[1:] == ('manifest',)]:
+            manifest = cache.values[key]
+            cache.values[(key[0], 'outputs')] = {
+                name: (cache.values.pop((key[0], 'output', name)), hash)
+                for name, hash in manifest.items()
+            }
+        loaded[:] = []
+        results = executor.execute(sinks=['pass'])
+        self.assertEqual(results['pass']['same'].value, 'x')
+        self.assertEqual(results['pass']['wrapped']['other'], [1, 2])
+        self.assertEqual(loaded, [('outputs',)])
+
+    def test_release(self):
+        """Test that outputs are dropped once no longer needed."""
+        steps = {}
+        previous = ['0']
+        for i in range(5):
+            steps['make%d' % i] = Step('make%d' % i, {'type': 'MakeBlob'},
+                                       {'value': previous})
+            steps['use%d' % i] = Step('use%d' % i, {'type': 'UseBlob'}, {
+                'blob': [StepInputConnection('make%d' % i, 'blob')],
+            })
+            previous = [StepInputConnection('use%d' % i, 'value')]
+        workflow = Workflow(steps, {})
+
+        executor = Executor(NullCache())
+        executor.add_components_loader(components)
+        executor.load_workflow(workflow)
+        results = executor.execute(sinks=['use4'])
+        self.assertEqual(results, {'use4': {'value': '0', 'alive': 1}})
+        # By default, only the sinks' outputs are kept
+        results = executor.execute()
+        self.assertEqual(results, {'use4': {'value': '0', 'alive': 1}})
+
+        # With spilling, the values are loaded back from the cache
+        for cache in (NullCache(), MemoryCache()):
+            executor = Executor(cache, spill_outputs=True)
+            executor.add_components_loader(components)
+            executor.load_workflow(make_workflow(4))
+            results = executor.execute()
+            self.assertEqual(results['total'], {'sum': 3})
+
+    def test_priorities(self):
+        """Test that steps on the longest path get started first."""
+        steps = {
+            'slow1': Step('slow1', {'type': 'Sleep'},
+                          {'name': ['slow1'], 'seconds': ['0.1']}),
+            'slow2': Step('slow2', {'type': 'Sleep'}, {
+                'name': ['slow2'], 'seconds': ['0.1'],
+                'after': [StepInputConnection('slow1', 'done')],
+            }),
+        }
+        for i in range(10):
+            steps['fast%d' % i] = Step('fast%d' % i, {'type': 'Sleep'},
+                                       {'name': ['fast%d' % i],
+                                        'seconds': ['0.01']})
+        workflow = Workflow(steps, {})
+
+        class DurationsCache(MemoryCache):
+            def store(self, key, value, **kwargs):
+                if key == ('durations',):
+                    super(DurationsCache, self).store(key, value, **kwargs)
+
+        cache = DurationsCache()
+        for max_workers in (None, 2):
+            executor = Executor(cache, max_workers=max_workers)
+            executor.add_components_loader(components)
+            executor.load_workflow(workflow)
+            Sleep.order = []
+            executor.execute()
+            self.assertEqual(len(cache.values[('durations',)]), 12)
+            Sleep.order = []
+            executor.execute()
+            self.assertIn('slow1', Sleep.order[:max_workers or 1])
+
+    def test_trace(self):
+        """Test recording a trace of the execution."""
+        workflow = make_workflow(4)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for max_workers in (None, 4):
+                trace = Trace()
+                executor = Executor(DirectoryCache(cache_dir),
+                                    max_workers=max_workers, trace=trace)
+                executor.add_components_loader(components)
+                executor.load_workflow(workflow)
+                executor.execute()
+
+                fp = io.StringIO()
+                trace.write(fp)
+                events = json.loads(fp.getvalue())['traceEvents']
+                spans = {}
+                for event in events:
+                    if event['ph'] == 'X':
+                        spans.setdefault(event['name'], []).append(event)
+                        self.assertGreaterEqual(event['dur'], 0)
+                self.assertEqual(len(spans['step total']), 1)
+                self.assertEqual(len(spans['hash inputs']), 9)
+                self.assertEqual(len(spans['cache lookup']), 9)
+                self.assertTrue(all(e['args']['bytes'] > 0
+                                    for e in spans['hash']))
+                if max_workers is None:
+                    # First run, steps are executed and stored
+                    self.assertEqual(len(spans['execute']), 9)
+                    self.assertEqual(len(spans['cache store']), 9)
+                    self.assertTrue(all(e['args']['bytes'] > 0
+                                        for e in spans['pickle']))
+                    self.assertFalse(
+                        spans['step total'][0]['args']['cached'])
+                else:
+                    # Second run, everything comes from the cache
+                    self.assertNotIn('execute', spans)
+                    self.assertTrue(all(e['args']['bytes'] > 0
+                                        for e in spans['unpickle']))
+                    self.assertTrue(spans['step total'][0]['args']['cached'])
+
+    def test_stream(self):
+        """Test passing streams of chunks between steps."""
+        def workflow(*consumers):
+            steps = {
+                'numbers': Step('numbers', {'type': 'Numbers'},
+                                {'count': [100]}),
+            }
+            for name in consumers:
+                steps[name] = Step(name, {'type': 'SumStream'}, {
+                    'numbers': [StepInputConnection('numbers', 'numbers')],
+                })
+            return Workflow(steps, {})
+
+        for max_workers in (None, 4):
+            Numbers.produced = 0
+            cache = MemoryCache()
+            executor = Executor(cache, max_workers=max_workers)
+            executor.add_components_loader(components)
+
+            # Chunks are produced as they are read
+            executor.load_workflow(workflow('sum1', 'sum2'))
+            results = executor.execute()
+            self.assertEqual(results['sum1']['sum'], 4950)
+            self.assertEqual(results['sum2']['sum'], 4950)
+            self.assertEqual(Numbers.produced, 100)
+            self.assertEqual(
+                min(results['sum1']['lag'], results['sum2']['lag']),
+                0,
+            )
+            self.assertEqual(
+                len([k for k in cache.values if 'chunk' in k]),
+                100,
+            )
+
+            # Stream is read back from the cache
+            executor.load_workflow(workflow('sum3'))
+            results = executor.execute(['sum3', 'numbers'])
+            self.assertEqual(results['sum3']['sum'], 4950)
+            self.assertEqual(Numbers.produced, 100)
+            self.assertEqual(list(results['numbers']['numbers']),
+                             list(range(100)))
+
+        # Without a cache, a stream can only be read once
+        Numbers.produced = 0
+        executor = Executor(NullCache())
+        executor.add_components_loader(components)
+        executor.load_workflow(workflow('sum1'))
+        results = executor.execute(['sum1', 'numbers'])
+        self.assertEqual(results['sum1'], {'sum': 4950, 'lag': 0})
+        with self.assertRaises(RuntimeError):
+            list(results['numbers']['numbers'])
+
+        # Streams are read entirely to go to worker processes
+        results, _ = self.run_workflow(workflow('sum1'), max_workers=2,
+                                       backend='processes')
+        self.assertEqual(results['sum1']['sum'], 4950)
+
+    def test_single_flight(self):
+        """Test that concurrent executions don't compute a step twice."""
+        workflow = make_workflow(4)
+        cache = MemoryCache()
+
+        def run():
+            executor = Executor(cache, max_workers=4)
+            executor.add_components_loader(components)
+            executor.load_workflow(workflow)
+            return executor.execute()
+
+        Add.executed = 0
+        with concurrent.futures.ThreadPoolExecutor(3) as pool:
+            results = list(pool.map(lambda _: run(), range(3)))
+        self.assertEqual(results[0]['total'], {'sum': 3})
+        self.assertEqual(results[2], results[0])
+        self.assertEqual(Add.executed, 5)
+
+        # Across processes, through lock files
+        with tempfile.TemporaryDirectory() as cache_dir:
+            log = os.path.join(cache_dir, 'log')
+            with concurrent.futures.ProcessPoolExecutor(2) as pool:
+                futures = [
+                    pool.submit(run_log_workflow, cache_dir, log)
+                    for _ in range(2)
+                ]
+                self.assertEqual([f.result() for f in futures],
+                                 [True, True])
+            with open(log) as fp:
+                self.assertEqual(fp.read(), 'run\n')
+            self.assertFalse([f for f in os.listdir(cache_dir)
+                              if f.endswith('.lock')])
+
+    def test_hash_once(self):
+        """Test that values passed between steps are only hashed again if
+        they could have changed."""
+        workflow = Workflow(
+            {
+                'make': Step('make', {'type': 'MakeCounted'},
+                             {'value': ['x']}),
+                'pass': Step('pass', {'type': 'PassThrough'},
+                             {'value': [StepInputConnection('make',
+                                                            'counted')]}),
+            },
+            {},
+        )
+        Counted.pickled = 0
+        executor = Executor(MemoryCache())
+        executor.add_components_loader(components)
+        executor.load_workflow(workflow)
+        executor.execute()
+        # The step could have modified the object, both outputs hash it
+        self.assertEqual(Counted.pickled, 3)
+        cache = executor.cache.values
+        manifests = {
+            k[0]: v for k, v in cache.items() if k[1:] == ('manifest',)
+        }
+        make_hash = [v['counted'] for v in manifests.values()
+                     if 'counted' in v]
+        same_hash = [v['same'] for v in manifests.values() if 'same' in v]
+        self.assertEqual(make_hash, same_hash)
+
+        # Same results if computed without knowing the hashes
+        component = PassThrough(executor.pickling)
+        component.execute({'value': [Counted('x')]})
+        self.assertEqual(
+            [component.outputs[n][1] for n in ('same', 'wrapped')],
+            [v[n] for v in manifests.values() if 'same' in v
+             for n in ('same', 'wrapped')],
+        )
+
+    def test_equal_constants(self):
+        """Test that constants that are equal but different get different
+        hashes."""
+        pairs = [((1, 2), (True, 2.0)), (0.0, -0.0), (1, True)]
+        steps = {}
+        for i, pair in enumerate(pairs):
+            for j, value in enumerate(pair):
+                steps['c%d_%d' % (i, j)] = Step(
+                    'c%d_%d' % (i, j), {'type': 'Constant'},
+                    {'value': [value]},
+                )
+        executor = Executor(MemoryCache())
+        executor.add_components_loader(components)
+        executor.load_workflow(Workflow(steps, {}))
+        for i in range(len(pairs)):
+            self.assertNotEqual(executor.step_hashes['c%d_0' % i],
+                                executor.step_hashes['c%d_1' % i])
+
+    def test_mutated_input(self):
+        """Test outputting an input that the step modified."""
+        workflow = Workflow(
+            {
+                'make': Step('make', {'type': 'MakeList'}, {}),
+                'append': Step('append', {'type': 'Append'},
+                               {'value': [StepInputConnection('make',
+                                                              'list')]}),
+            },
+            {},
+        )
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                executor = Executor(DirectoryCache(cache_dir))
+                executor.add_components_loader(components)
+                executor.load_workflow(workflow)
+                results = executor.execute()
+                self.assertEqual(results['append']['list'][-1], -1)
+                self.assertEqual(len(results['append']['list']), 100001)
+
+    def test_mutated_input_tiered(self):
+        """Test modifying an input kept in the memory of a TieredCache."""
+        def workflow(consumer):
+            return Workflow(
+                {
+                    'make': Step('make', {'type': 'MakeList'}, {}),
+                    'use': Step('use', {'type': consumer},
+                                {'value': [StepInputConnection('make',
+                                                               'list')]}),
+                },
+                {},
+            )
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = TieredCache(DirectoryCache(cache_dir), 10000000)
+            for consumer in ('Append', 'Length'):
+                executor = Executor(cache)
+                executor.add_components_loader(components)
+                executor.load_workflow(workflow(consumer))
+                results = executor.execute()
+            self.assertEqual(results['use']['length'], 100000)
+
+            # The value on disk is right too
+            executor = Executor(DirectoryCache(cache_dir))
+            executor.add_components_loader(components)
+            executor.load_workflow(workflow('Length'))
+            self.assertEqual(executor.execute()['use']['length'], 100000)
+
+    def test_pinned_outputs(self):
+        """Test that outputs still to be loaded are not evicted."""
+        def workflow(size_b):
+            return Workflow(
+                {
+                    'a': Step('a', {'type': 'RandomBytes'},
+                              {'size': ['300000']}),
+                    'b': Step('b', {'type': 'RandomBytes'},
+                              {'size': [size_b]}),
+                    'use': Step('use', {'type': 'TotalLength'}, {
+                        'a': [StepInputConnection('a', 'data')],
+                        'b': [StepInputConnection('b', 'data')],
+                    }),
+                },
+                {},
+            )
+
+        def run(cache_dir, size_b, **kwargs):
+            executor = Executor(DirectoryCache(cache_dir, max_size=500000),
+                                **kwargs)
+            executor.add_components_loader(components)
+            executor.load_workflow(workflow(size_b))
+            return executor.execute()['use']['length']
+
+        # 'a' comes from the cache, storing 'b' goes over budget
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertEqual(run(cache_dir, '300000'), 600000)
+            self.assertEqual(run(cache_dir, '300001'), 600001)
+        # Spilled outputs
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertEqual(run(cache_dir, '300000', spill_outputs=True),
+                             600000)
+
+    def test_error(self):
+        """Test that errors in steps get raised."""
+        workflow = make_workflow(4)
+        workflow.steps['c2'].inputs['value'] = ['notanumber']
+        for max_workers in (None, 4):
+            with self.assertRaises(ValueError):
+                self.run_workflow(workflow, max_workers=max_workers)
@@ -1,5 +1,7 @@
 from cacheflow import python
+from cacheflow.cache import Pickling
 import sys
+import tempfile
 import unittest
 
 
@@ -64,3 +66,31 @@ class TestParsing(unittest.TestCase):
         self.assertEqual(res['inputs'], set())
         self.assertEqual(res['outputs'], {'d', 'h'})
         self.assertEqual(res['imports'], {'a.b.c', 'e.f.g'})
+
+
+class Counted(object):
+    pickled = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        Counted.pickled += 1
+        return Counted, (self.value,)
+
+
+class TestBuiltinPython(unittest.TestCase):
+    def test_hash_env(self):
+        """Test that the variables are not hashed again in the env."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            component = python.BuiltinPython(Pickling(temp_dir))
+            Counted.pickled = 0
+            component.execute({
+                'code': ['value = cls(2)\nother = [value.value, 3]\n'],
+                'cls': [Counted],
+            })
+        self.assertEqual(Counted.pickled, 1)
+        self.assertEqual(component.outputs['other'][0], [2, 3])
+        env, env_hash = component.outputs['env']
+        self.assertEqual(env['other'], [2, 3])
+        self.assertEqual(len(env_hash), 64)
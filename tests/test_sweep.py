@@ -0,0 +1,73 @@
+import unittest
+
+from cacheflow import Executor, Sweep
+from cacheflow.cache import MemoryCache
+
+from tests.test_executor import Add, components, make_workflow
+
+
+class TestSweep(unittest.TestCase):
+    def test_combined(self):
+        """Test building the combined workflow."""
+        workflow = make_workflow(4)
+        sweep = Sweep(workflow, [
+            ('c1', 'value', ['1', '2', '3']),
+            ('c3', 'value', ['5', '6']),
+        ])
+        self.assertEqual(
+            set(sweep.workflow.steps),
+            {
+                'c0', 'a0', 'c2', 'a2',
+                'c1#0', 'c1#1', 'c1#2', 'a1#0', 'a1#1', 'a1#2',
+                'c3#0', 'c3#1', 'a3#0', 'a3#1', 'total#0', 'total#1',
+            },
+        )
+        self.assertEqual(sweep.workflow.steps['c3#1'].inputs['value'],
+                         ['6'])
+        self.assertEqual(
+            repr(sweep.workflow.steps['total#1'].inputs['b']),
+            '[a3#1.sum]',
+        )
+        self.assertEqual(sweep.step_ids('a1'), ['a1#0', 'a1#0',
+                                                'a1#1', 'a1#1',
+                                                'a1#2', 'a1#2'])
+
+        with self.assertRaises(ValueError):
+            Sweep(workflow, [('nonexistent', 'value', ['1'])])
+
+    def test_execute(self):
+        """Test executing a sweep, running shared steps once."""
+        workflow = make_workflow(4)
+        sweep = Sweep(workflow, [
+            ('c1', 'value', ['1', '2', '3']),
+            ('c3', 'value', ['5', '6']),
+        ])
+        executor = Executor(MemoryCache(), max_workers=4)
+        executor.add_components_loader(components)
+        Add.executed = 0
+        table = sweep.execute(executor)
+        # a0 and a2 once, a1 three times, a3 and total twice; but a1 with
+        # c1=2 has the same inputs as a2, and comes from the cache
+        self.assertEqual(Add.executed, 8)
+
+        executor = Executor(MemoryCache())
+        executor.add_components_loader(components)
+        serial_table = sweep.execute(executor)
+        self.assertEqual(serial_table, table)
+        self.assertEqual(len(table), 6)
+        self.assertEqual(
+            table[('2', '6')],
+            {'a1': {'sum': 2}, 'a2': {'sum': 2}, 'total': {'sum': 6}},
+        )
+        self.assertEqual(
+            {c: r['total']['sum'] for c, r in table.items()},
+            {
+                ('1', '5'): 5, ('1', '6'): 6,
+                ('2', '5'): 5, ('2', '6'): 6,
+                ('3', '5'): 5, ('3', '6'): 6,
+            },
+        )
+
+        # Only some of the steps
+        table = sweep.execute(executor, sinks=['a1'])
+        self.assertEqual(table[('3', '5')], {'a1': {'sum': 3}})